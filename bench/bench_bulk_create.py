@@ -0,0 +1,67 @@
+import datetime
+import uuid
+
+from django.test import TestCase
+
+from sbts.ticket.models import Ticket, Comment
+
+from .utils import Stopwatch, env_int, report
+
+
+class CommentInsertBench(TestCase):
+    '''
+    コメントの挿入。create_cleanlyの繰り返し、bulk_create_cleanly、検
+    査なしのbulk_createを比較する。create_cleanlyは遅いので1/10の件数
+    で測る。
+    '''
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        t1_dt = datetime.datetime.fromisoformat('2023-10-23T23:20:00Z')
+        cls.tickets = [
+            Ticket.objects.create_cleanly(title=f'ticket {i}', created_at=t1_dt)
+            for i in range(100)
+        ]
+
+    def make_comments(self, n):
+        c_dt = datetime.datetime.fromisoformat('2023-10-24T00:00:00Z')
+        return [
+            Comment(key=uuid.uuid4(),
+                    comment='c' * (i % 1000 + 1),
+                    created_at=c_dt + datetime.timedelta(microseconds=i),
+                    username='shimon',
+                    ticket=self.tickets[i % len(self.tickets)])
+            for i in range(n)
+        ]
+
+    def test_create_cleanly(self):
+        n = env_int('SBTS_BENCH_COMMENTS', 100_000) // 10
+        comments = self.make_comments(n)
+        with Stopwatch() as sw:
+            for c in comments:
+                Comment.objects.create_cleanly(
+                    key=c.key, comment=c.comment, created_at=c.created_at,
+                    username=c.username, ticket=c.ticket)
+        report('comment_insert', method='create_cleanly', rows=n,
+               seconds=sw.elapsed, rows_per_sec=n / sw.elapsed)
+
+    def test_bulk_create_cleanly(self):
+        n = env_int('SBTS_BENCH_COMMENTS', 100_000)
+        batch_size = env_int('SBTS_BENCH_BATCH_SIZE', 1000)
+        comments = self.make_comments(n)
+        with Stopwatch() as sw:
+            Comment.objects.bulk_create_cleanly(comments, batch_size=batch_size)
+        report('comment_insert', method='bulk_create_cleanly', rows=n,
+               batch_size=batch_size, seconds=sw.elapsed,
+               rows_per_sec=n / sw.elapsed)
+
+    def test_bulk_create(self):
+        n = env_int('SBTS_BENCH_COMMENTS', 100_000)
+        batch_size = env_int('SBTS_BENCH_BATCH_SIZE', 1000)
+        comments = self.make_comments(n)
+        with Stopwatch() as sw:
+            Comment.objects.bulk_create(comments, batch_size=batch_size)
+        report('comment_insert', method='bulk_create', rows=n,
+               batch_size=batch_size, seconds=sw.elapsed,
+               rows_per_sec=n / sw.elapsed)
@@ -0,0 +1,60 @@
+import datetime
+import time
+
+from django.test import TestCase, RequestFactory
+from django.urls import reverse
+
+from sbts.core.middleware import CompressionMiddleware, brotli
+from sbts.ticket.models import Ticket, Comment
+
+from .utils import env_int, report
+
+
+class TicketPageCompressionBench(TestCase):
+    '''
+    コメントの多いチケットのページを圧縮したときの、転送量と圧縮にか
+    かるCPU時間。
+    '''
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        n = env_int('SBTS_BENCH_PAGE_COMMENTS', 1000)
+        t1_dt = datetime.datetime.fromisoformat('2023-10-23T23:20:00Z')
+        cls.ticket = Ticket.objects.create_cleanly(title='ticket 1', created_at=t1_dt)
+        Comment.objects.bulk_create_cleanly([
+            Comment(comment=f'comment {i}\n' + 'ログの抜粋 ' * (i % 50),
+                    created_at=t1_dt + datetime.timedelta(minutes=i),
+                    username='shimon',
+                    ticket=cls.ticket)
+            for i in range(n)
+        ])
+
+    def test_ticket_detail_page(self):
+        rounds = env_int('SBTS_BENCH_ROUNDS', 20)
+        url = reverse('page:ticket_detail_page', kwargs={'key': self.ticket.key})
+        page = self.client.get(url)
+        self.assertEqual(page.status_code, 200)
+
+        encodings = ['gzip'] + (['br'] if brotli is not None else [])
+        req_factory = RequestFactory()
+        for encoding in encodings:
+            req = req_factory.get(url, HTTP_ACCEPT_ENCODING=encoding)
+            middleware = CompressionMiddleware(lambda req: page)
+            start = time.process_time()
+            for _ in range(rounds):
+                # process_responseはレスポンスを書き換えるので、毎回元に戻す
+                content = page.content
+                resp = middleware(req)
+                compressed = resp.content
+                page.content = content
+                del page.headers['Content-Encoding']
+            cpu = (time.process_time() - start) / rounds
+
+            report('ticket_page_compression',
+                   comments=Comment.objects.count(),
+                   encoding=encoding,
+                   bytes=len(content),
+                   compressed_bytes=len(compressed),
+                   ratio=len(compressed) / len(content),
+                   cpu_ms=cpu * 1000)
@@ -0,0 +1,70 @@
+import datetime
+import random
+
+from django.test import override_settings
+from django.urls import reverse
+
+from sbts.core.test_utils import ObjectStorageTestCase
+from sbts.file.models import UploadedFile, upload_blob
+
+from .utils import Stopwatch, env_int, env_ints, report
+
+
+class RepeatReader:
+    '''
+    blockを繰り返してsize bytes返す。大きなブロブをメモリに載せずにアッ
+    プロードするため。
+    '''
+
+    def __init__(self, block, size):
+        self.block = block
+        self.remaining = size
+
+    def read(self, size=-1):
+        size = min(size if size >= 0 else self.remaining, self.remaining)
+        n = len(self.block)
+        data = (self.block * (size // n + 1))[:size]
+        self.remaining -= size
+        return data
+
+
+# 遅いリクエストのログで結果が読みにくくならないようにする
+@override_settings(PERF_SLOW_REQUEST_MS=float('inf'),
+                   PERF_SLOW_DB_QUERIES=float('inf'))
+class DownloadBench(ObjectStorageTestCase):
+    '''
+    大きなブロブのBlobViewでのダウンロードの時間を、1回のGETで読む場合
+    と、範囲に分けて先読みする場合で比べる。S3に保存する場合だけ意味が
+    ある。
+    '''
+
+    def test_download(self):
+        size = env_int('SBTS_BENCH_DOWNLOAD_SIZE', 1024 ** 3)
+        rounds = env_int('SBTS_BENCH_BLOB_ROUNDS', 3)
+        block_sizes = env_ints('SBTS_BENCH_PREFETCH_BLOCK_SIZES', '8388608')
+        depths = env_ints('SBTS_BENCH_PREFETCH_DEPTHS', '0,2,4,8')
+
+        # 圧縮されないように乱数にする
+        block = random.Random(env_int('SBTS_BENCH_SEED', 0)).randbytes(1024 ** 2)
+        key = upload_blob(RepeatReader(block, size), 'shimon')
+        lastmod = datetime.datetime.fromisoformat('2023-11-04T12:00:00Z')
+        UploadedFile.objects.create_from_s3(key, 'shimon', 'large.bin', lastmod)
+        url = reverse('page:file:blob', kwargs={'key': key})
+
+        for block_size in block_sizes:
+            for depth in depths:
+                with override_settings(FILE_DOWNLOAD_PREFETCH_MIN_SIZE=0,
+                                       FILE_DOWNLOAD_PREFETCH_BLOCK_SIZE=block_size,
+                                       FILE_DOWNLOAD_PREFETCH_DEPTH=depth):
+                    samples = []
+                    for _ in range(rounds):
+                        with Stopwatch() as sw:
+                            resp = self.client.get(url)
+                            n = sum(len(chunk) for chunk in resp.streaming_content)
+                        self.assertEqual(n, size)
+                        samples.append(sw.elapsed)
+
+                best = min(samples)
+                report('download', bytes=size, block_size=block_size, depth=depth,
+                       rounds=rounds, best_sec=best, mean_sec=sum(samples) / rounds,
+                       mb_per_sec=size / best / 1024 ** 2)
@@ -0,0 +1,30 @@
+import io
+
+from django.core.management import call_command
+
+from sbts.core.test_utils import ObjectStorageTestCase
+from sbts.file.models import UploadedFile
+from sbts.ticket.models import Ticket, Comment
+
+from .utils import Stopwatch, env_int, report
+
+
+class GenerateDataBench(ObjectStorageTestCase):
+    '''
+    generate_dataで合成データを作る速さ。
+    '''
+
+    def test_generate_data(self):
+        options = {
+            'seed': env_int('SBTS_BENCH_SEED', 0),
+            'tickets': env_int('SBTS_BENCH_TICKETS', 10_000),
+            'comments': env_int('SBTS_BENCH_COMMENTS', 1_000_000),
+            'files': env_int('SBTS_BENCH_FILES', 1000),
+            'workers': env_int('SBTS_BENCH_WORKERS', 16),
+        }
+        with Stopwatch() as sw:
+            call_command('generate_data', stderr=io.StringIO(), **options)
+
+        rows = Ticket.objects.count() + Comment.objects.count() + UploadedFile.objects.count()
+        report('generate_data', **options, seconds=sw.elapsed,
+               rows_per_sec=rows / sw.elapsed)
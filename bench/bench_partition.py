@@ -0,0 +1,89 @@
+import datetime
+import itertools
+import uuid
+
+from django.db import connection
+from django.db.models import Count
+from django.test import TestCase
+
+from sbts.core.synthetic import DataGenerator, copy_insert
+from sbts.ticket import partitions
+from sbts.ticket.models import Ticket, Comment
+
+from .utils import env_int, measure, report
+
+
+class CommentPartitionBench(TestCase):
+    '''
+    ticket_commentを普通のテーブルにしたときと、created_atで月ごとのパー
+    ティションにしたときの、挿入と読み出しの処理時間を比べる。
+
+    既定では5000万件のコメントを作るので、時間がかかる。チケットは
+    SBTS_BENCH_MONTHS月に散らばらせ、コメントはチケットの作成から30日
+    以内に書かれたことにする。
+    '''
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        gen = DataGenerator(seed=env_int('SBTS_BENCH_SEED', 0),
+                            comment_median_length=env_int('SBTS_BENCH_COMMENT_LENGTH', 200))
+        n_tickets = env_int('SBTS_BENCH_TICKETS', 100_000)
+        span = datetime.timedelta(days=30 * env_int('SBTS_BENCH_MONTHS', 36))
+        batch_size = env_int('SBTS_BENCH_BATCH_SIZE', 10000)
+
+        tickets = [Ticket(key=gen.key(), title=f'ticket {i}',
+                          created_at=gen.start + span * i / n_tickets)
+                   for i in range(n_tickets)]
+        copy_insert(Ticket, tickets)
+        comments = gen.comments([(t.key, t.created_at) for t in tickets],
+                                env_int('SBTS_BENCH_COMMENTS', 50_000_000),
+                                batch_size=batch_size)
+        while batch := list(itertools.islice(comments, batch_size)):
+            copy_insert(Comment, batch)
+
+        # コメントの多いチケットの先頭のコメントと、最後の月の1週間を読む
+        cls.busy_ticket = Ticket.objects.get(
+            key=Comment.objects.values('ticket').annotate(n=Count('key'))
+            .order_by('-n').values('ticket')[:1])
+        cls.range_start = gen.start + span - datetime.timedelta(days=30)
+        cls.limit = env_int('SBTS_BENCH_DETAIL_COMMENTS', 1000)
+        cls.rounds = env_int('SBTS_BENCH_ROUNDS', 50)
+        cls.comments = Comment.objects.count()
+
+    def rebuild(self, partitioned):
+        with connection.cursor() as cursor:
+            # 遅延した外部キーの検査が残っていると、テーブルを変えられない
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        partitions.rebuild(connection, partitioned)
+        with connection.cursor() as cursor:
+            cursor.execute('SET CONSTRAINTS ALL DEFERRED')
+            cursor.execute(f'ANALYZE {partitions.TABLE}')
+
+    def report(self, op, partitioned, result):
+        report('comment_partition', op=op,
+               layout='partitioned' if partitioned else 'plain',
+               comments=self.comments, **result)
+
+    def test_partition(self):
+        t_dt = self.range_start + datetime.timedelta(days=1)
+        # マイグレーションでパーティションにしてあるので、普通のテーブ
+        # ルから測る
+        for partitioned in [False, True]:
+            self.rebuild(partitioned)
+
+            def insert():
+                Comment.objects.create_cleanly(
+                    key=uuid.uuid4(), comment='c' * 200, created_at=t_dt,
+                    username='shimon', ticket=self.busy_ticket)
+
+            self.report('insert', partitioned, measure(insert, self.rounds))
+            self.report('sorted_comments', partitioned, measure(
+                lambda: list(self.busy_ticket.sorted_comments()[:self.limit]), self.rounds))
+            self.report('sorted_tickets_with_lastmod', partitioned, measure(
+                lambda: list(Ticket.objects.sorted_tickets_with_lastmod()[:50]), self.rounds))
+            self.report('created_at_range', partitioned, measure(
+                lambda: Comment.objects.filter(
+                    created_at__gte=self.range_start,
+                    created_at__lt=self.range_start + datetime.timedelta(days=7)).count(),
+                self.rounds))
@@ -0,0 +1,142 @@
+import datetime
+import io
+import random
+import uuid
+
+from django.contrib.auth.models import User
+from django.test import override_settings
+from django.urls import reverse
+
+from sbts.core.test_utils import ObjectStorageTestCase
+from sbts.file.models import UploadedFile, upload_blob
+from sbts.ticket.models import Ticket, Comment
+
+from .utils import env_int, env_ints, measure, report
+
+
+# 遅いリクエストのログで結果が読みにくくならないようにする
+@override_settings(PERF_SLOW_REQUEST_MS=float('inf'),
+                   PERF_SLOW_DB_QUERIES=float('inf'))
+class ViewLatencyBench(ObjectStorageTestCase):
+    '''
+    ミドルウェアを含めて、ビューごとの処理時間のパーセンタイルと、1秒
+    あたりの処理回数を測る。データの量はSBTS_BENCH_*で変えられ、同じ
+    SBTS_BENCH_SEEDなら同じデータになる。
+    '''
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        rng = random.Random(env_int('SBTS_BENCH_SEED', 0))
+        t_dt = datetime.datetime.fromisoformat('2023-10-23T23:20:00Z')
+
+        cls.user = User.objects.create_user('shimon', 'shimon@example.com', 'pw')
+        cls.tickets = Ticket.objects.bulk_create_cleanly([
+            Ticket(key=uuid.UUID(int=rng.getrandbits(128), version=4),
+                   title=f'ticket {i}',
+                   created_at=t_dt + datetime.timedelta(minutes=i))
+            for i in range(env_int('SBTS_BENCH_TICKETS', 200))
+        ])
+        Comment.objects.bulk_create_cleanly([
+            Comment(key=uuid.UUID(int=rng.getrandbits(128), version=4),
+                    comment='c' * rng.randint(1, 1000),
+                    created_at=t_dt + datetime.timedelta(seconds=i),
+                    username='shimon',
+                    ticket=rng.choice(cls.tickets))
+            for i in range(env_int('SBTS_BENCH_COMMENTS', 5000))
+        ])
+
+        # 詳細ページを測るチケット
+        cls.detail_ticket = Ticket.objects.create_cleanly(
+            title='detail', created_at=t_dt)
+        Comment.objects.bulk_create_cleanly([
+            Comment(key=uuid.UUID(int=rng.getrandbits(128), version=4),
+                    comment='c' * rng.randint(1, 1000),
+                    created_at=t_dt + datetime.timedelta(seconds=i),
+                    username='shimon',
+                    ticket=cls.detail_ticket)
+            for i in range(env_int('SBTS_BENCH_DETAIL_COMMENTS', 1000))
+        ])
+
+        # ファイルの一覧ページ用。ブロブは作らない
+        UploadedFile.objects.bulk_create_cleanly([
+            UploadedFile(key=uuid.UUID(int=rng.getrandbits(128), version=4),
+                         name=f'file{i}.bin',
+                         last_modified=t_dt,
+                         size=rng.randint(0, 1024 ** 3),
+                         username='shimon')
+            for i in range(env_int('SBTS_BENCH_FILES', 200))
+        ])
+
+        cls.rounds = env_int('SBTS_BENCH_ROUNDS', 50)
+        cls.blob_rounds = env_int('SBTS_BENCH_BLOB_ROUNDS', 10)
+        cls.blob_sizes = env_ints('SBTS_BENCH_FILE_SIZES', '1024,1048576,16777216')
+        cls.seed = env_int('SBTS_BENCH_SEED', 0)
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+
+    def get(self, url):
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        if resp.streaming:
+            b''.join(resp.streaming_content)
+        return resp
+
+    def report(self, view, result, **params):
+        report('view_latency', view=view, seed=self.seed, **params, **result)
+
+    def test_file_page(self):
+        url = reverse('page:file_page')
+        self.report('FilePageView', measure(lambda: self.get(url), self.rounds),
+                    files=UploadedFile.objects.count())
+
+    def test_ticket_page(self):
+        url = reverse('page:ticket_page')
+        self.report('TicketPageView', measure(lambda: self.get(url), self.rounds),
+                    tickets=Ticket.objects.count(), comments=Comment.objects.count())
+
+    def test_ticket_detail_page(self):
+        url = reverse('page:ticket_detail_page', kwargs={'key': self.detail_ticket.key})
+        self.report('TicketDetailPageView', measure(lambda: self.get(url), self.rounds),
+                    comments=self.detail_ticket.comment_set.count())
+
+    def test_comment(self):
+        url = reverse('page:comment')
+        data = {'key': self.detail_ticket.key, 'comment': 'c' * 500}
+
+        def post():
+            resp = self.client.post(url, data)
+            self.assertEqual(resp.status_code, 302)
+
+        self.report('CommentView', measure(post, self.rounds))
+
+    def test_upload(self):
+        url = reverse('page:file:upload')
+        rng = random.Random(self.seed)
+        for size in self.blob_sizes:
+            # 圧縮されないように乱数にする
+            content = rng.randbytes(size)
+
+            def post():
+                resp = self.client.post(url, content,
+                                        content_type='application/octet-stream')
+                self.assertEqual(resp.status_code, 200)
+
+            result = measure(post, self.blob_rounds)
+            self.report('UploadView', result, bytes=size,
+                        mb_per_sec=size * result['per_sec'] / 1024 ** 2)
+
+    def test_blob(self):
+        rng = random.Random(self.seed)
+        lastmod = datetime.datetime.fromisoformat('2023-11-04T12:00:00Z')
+        for size in self.blob_sizes:
+            key = upload_blob(io.BytesIO(rng.randbytes(size)), self.user.username)
+            UploadedFile.objects.create_from_s3(
+                key, self.user.username, f'{size}.bin', lastmod)
+            url = reverse('page:file:blob', kwargs={'key': key})
+
+            result = measure(lambda: self.get(url), self.blob_rounds)
+            self.report('BlobView', result, bytes=size,
+                        mb_per_sec=size * result['per_sec'] / 1024 ** 2)
@@ -0,0 +1,67 @@
+import json
+import math
+import os
+import time
+
+
+def env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+def report(name, **values):
+    '''
+    測定結果を1行のJSONとして標準出力に書く。
+    '''
+
+    print(json.dumps({'bench': name, **values}), flush=True)
+
+
+class Stopwatch:
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.perf_counter() - self.start
+
+
+def env_ints(name, default):
+    '''
+    カンマ区切りの整数のリスト。
+    '''
+
+    return [int(v) for v in os.environ.get(name, default).split(',')]
+
+
+def percentile(sorted_samples, p):
+    # 最近傍法
+    i = max(0, math.ceil(len(sorted_samples) * p / 100) - 1)
+    return sorted_samples[i]
+
+
+def measure(func, rounds, warmup=1):
+    '''
+    funcをrounds回呼び、1回ごとの所要時間のパーセンタイル(ミリ秒)と、
+    1秒あたりの回数を返す。最初のwarmup回は測らない。
+    '''
+
+    for _ in range(warmup):
+        func()
+
+    samples = []
+    with Stopwatch() as total:
+        for _ in range(rounds):
+            with Stopwatch() as sw:
+                func()
+            samples.append(sw.elapsed * 1000)
+
+    samples.sort()
+    return {
+        'rounds': rounds,
+        'p50_ms': percentile(samples, 50),
+        'p90_ms': percentile(samples, 90),
+        'p99_ms': percentile(samples, 99),
+        'mean_ms': sum(samples) / rounds,
+        'max_ms': samples[-1],
+        'per_sec': rounds / total.elapsed,
+    }
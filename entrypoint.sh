@@ -45,13 +45,35 @@ chown -R app:app /home/app/opt/sbts/config
 cd /home/app/var/sbts
 
 wait_pg
-wait_s3
 
-if ! doaws s3api head-bucket --bucket sbtsfile > /dev/null; then
-  doaws s3 mb s3://sbtsfile
+# ローカルに保存するときは、S3を使わない
+if [ "${SBTS_FILE_STORAGE:-s3}" = s3 ]; then
+  wait_s3
+
+  if ! doaws s3api head-bucket --bucket sbtsfile > /dev/null; then
+    doaws s3 mb s3://sbtsfile
+  fi
 fi
 
 MANAGEPY=/home/app/opt/sbts/manage.py
 
+# ジョブを実行するワーカー。マイグレーションはappが行うので、それを
+# 待ってから起動する
+if [ "${1:-}" = worker ]; then
+  for i in $(seq 0 4); do
+    if gosu app python "$MANAGEPY" migrate --check > /dev/null; then
+      exec gosu app python "$MANAGEPY" runworker
+    fi
+
+    echo 'sleep...'
+    sleep $((2 ** i))
+  done
+
+  echo 'worker: timed out' >&2
+  exit 1
+fi
+
 gosu app python "$MANAGEPY" migrate
+gosu app python "$MANAGEPY" create_comment_partitions
+gosu app python "$MANAGEPY" collectstatic --noinput --verbosity 0
 exec gosu app python "$MANAGEPY" runserver 0.0.0.0:8000
@@ -0,0 +1,16 @@
+#!/bin/sh
+
+set -eu
+
+if [ $# -eq 0 ]; then
+  set -- bench
+fi
+
+# SBTS_BENCH_*の環境変数をコンテナに渡す
+ENVOPTS=
+for name in $(env | sed -n 's/^\(SBTS_BENCH_[A-Z0-9_]*\)=.*/\1/p'); do
+  ENVOPTS="$ENVOPTS -e $name"
+done
+
+CODEDIR=/home/app/opt/sbts
+exec docker compose run --rm $ENVOPTS app gosu app "$CODEDIR/envw" python "$CODEDIR/manage.py" test -p 'bench_*.py' "$@"
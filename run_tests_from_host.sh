@@ -6,5 +6,11 @@ if [ $# -eq 0 ]; then
   set -- sbts
 fi
 
+# SBTS_FILE_STORAGE=localなら、ローカルの保存先でテストする
+ENVOPTS=
+if [ -n "${SBTS_FILE_STORAGE:-}" ]; then
+  ENVOPTS="-e SBTS_FILE_STORAGE"
+fi
+
 CODEDIR=/home/app/opt/sbts
-exec docker compose run --rm app gosu app "$CODEDIR/envw" python "$CODEDIR/manage.py" test "$@"
+exec docker compose run --rm $ENVOPTS app gosu app "$CODEDIR/envw" python "$CODEDIR/manage.py" test "$@"
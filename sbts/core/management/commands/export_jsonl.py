@@ -0,0 +1,58 @@
+from django.apps import apps
+from django.core import serializers
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+import sys
+
+from sbts.core.progress import Throughput
+
+
+DEFAULT_MODELS = ['ticket.Ticket', 'ticket.Comment', 'file.UploadedFile']
+
+
+class Command(BaseCommand):
+    help = ('チケット、コメント、ファイルのメタデータをJSON Lines'
+            '(dumpdata --format jsonlと同じ形式)で書き出す。'
+            'ファイルの中身(S3のオブジェクト)は含まない。')
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', default=DEFAULT_MODELS,
+                            help='app_label.ModelName。参照される側を先に並べる。')
+        parser.add_argument('-o', '--output', help='出力先。省略時は標準出力。')
+        parser.add_argument('--chunk-size', type=int, default=2000,
+                            help='サーバーサイドカーソルから一度に取り出す行数')
+
+    def handle(self, *args, **options):
+        models = [apps.get_model(label) for label in options['models']]
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as out:
+                self.export(models, out, options['chunk_size'])
+        else:
+            self.export(models, sys.stdout, options['chunk_size'])
+
+    def export(self, models, out, chunk_size):
+        serializer = serializers.get_serializer('jsonl')()
+        # autocommitのままだとPostgreSQLのサーバーサイドカーソルが
+        # WITH HOLDになり、DECLAREした時点で結果全体が実体化される。
+        # トランザクション内で読み出して、メモリ使用量を一定に保つ。
+        # すべてのモデルを1つのスナップショットから読み、書き出したコ
+        # メントのチケットが書き出されていないことがないようにする。
+        # 外側のトランザクションの中(テストなど)では、分離レベルを変え
+        # られないので、そのトランザクションのまま読む
+        outermost = not connection.in_atomic_block
+        with transaction.atomic():
+            if outermost:
+                with connection.cursor() as cursor:
+                    cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')
+            for model in models:
+                progress = Throughput(self.stderr, model._meta.label)
+                qs = model._base_manager.order_by('pk').iterator(chunk_size=chunk_size)
+                serializer.serialize(self.counted(qs, progress), stream=out)
+                progress.finish()
+
+    def counted(self, objs, progress):
+        for obj in objs:
+            yield obj
+            progress.add()
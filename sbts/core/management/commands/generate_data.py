@@ -0,0 +1,69 @@
+from django.core.management.base import BaseCommand
+
+import itertools
+
+from sbts.core.progress import Throughput
+from sbts.core.synthetic import DataGenerator, copy_insert, put_blobs
+from sbts.file.models import UploadedFile
+from sbts.ticket.models import Ticket, Comment
+
+
+class Command(BaseCommand):
+    help = ('規模の検証やベンチマークのための合成データを作る。同じ'
+            '--seedなら同じデータになる。行はbatch-size行ずつCOPYで挿'
+            '入し、ファイルの中身は並行してストレージに書く。')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--tickets', type=int, default=1000)
+        parser.add_argument('--comments', type=int, default=100_000)
+        parser.add_argument('--files', type=int, default=1000)
+        parser.add_argument('--username', default='synthetic')
+        parser.add_argument('--comment-median-length', type=int, default=200)
+        parser.add_argument('--comment-max-length', type=int, default=65535)
+        parser.add_argument('--file-median-size', type=int, default=64 * 1024)
+        parser.add_argument('--file-max-size', type=int, default=1024 ** 2)
+        parser.add_argument('--no-blobs', action='store_true',
+                            help='ファイルの中身をストレージに書かず、メタデータだけ作る')
+        parser.add_argument('--batch-size', type=int, default=10000)
+        parser.add_argument('--workers', type=int, default=16,
+                            help='ストレージに書くスレッドの数')
+
+    def handle(self, *args, **options):
+        gen = DataGenerator(
+            seed=options['seed'],
+            username=options['username'],
+            comment_median_length=options['comment_median_length'],
+            comment_max_length=options['comment_max_length'],
+            file_median_size=options['file_median_size'],
+            file_max_size=options['file_max_size'])
+        batch_size = options['batch_size']
+
+        # コメントを割り当てるために、チケットのキーと作成日時は覚えておく
+        tickets = []
+        progress = Throughput(self.stderr, Ticket._meta.label)
+        for batch in batched(gen.tickets(options['tickets']), batch_size):
+            progress.add(copy_insert(Ticket, batch))
+            tickets.extend((t.key, t.created_at) for t in batch)
+        progress.finish()
+
+        if tickets:
+            progress = Throughput(self.stderr, Comment._meta.label)
+            comments = gen.comments(tickets, options['comments'])
+            for batch in batched(comments, batch_size):
+                progress.add(copy_insert(Comment, batch))
+            progress.finish()
+
+        progress = Throughput(self.stderr, UploadedFile._meta.label)
+        for batch in batched(gen.files(options['files']), batch_size):
+            # 中身を書いてから行を挿入し、中身のない行を作らない
+            if not options['no_blobs']:
+                put_blobs(gen, batch, options['workers'])
+            progress.add(copy_insert(UploadedFile, batch))
+        progress.finish()
+
+
+def batched(iterable, n):
+    it = iter(iterable)
+    while batch := list(itertools.islice(it, n)):
+        yield batch
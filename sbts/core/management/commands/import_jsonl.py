@@ -0,0 +1,106 @@
+from django.core import serializers
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+import itertools
+import json
+import os
+
+from sbts.core.models import BulkValidationError
+from sbts.core.progress import Throughput
+
+
+class Command(BaseCommand):
+    help = ('export_jsonlで書き出したJSON Linesを、bulk_create_cleanlyで'
+            'batch-size行ずつ取り込む。バッチごとにチェックポイントを'
+            '記録するので、中断しても続きから再開できる。')
+
+    def add_arguments(self, parser):
+        parser.add_argument('input')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--checkpoint',
+                            help='チェックポイントのファイル。省略時は「入力.checkpoint」。')
+
+    def handle(self, *args, **options):
+        path = options['input']
+        checkpoint = options['checkpoint'] or f'{path}.checkpoint'
+        batch_size = options['batch_size']
+
+        done = self.load_checkpoint(checkpoint, path)
+        if done:
+            self.stderr.write(f'resuming after line {done}')
+
+        progress = None
+        with open(path, encoding='utf-8') as f:
+            lines = itertools.islice(enumerate(f, start=1), done, None)
+            for model, batch in self.batches(lines, batch_size):
+                if progress is None or progress.label != model._meta.label:
+                    if progress is not None:
+                        progress.finish()
+                    progress = Throughput(self.stderr, model._meta.label)
+                self.insert(model, batch)
+                done = batch[-1][0]
+                self.save_checkpoint(checkpoint, path, done)
+                progress.add(len(batch))
+
+        if progress is not None:
+            progress.finish()
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+
+    def batches(self, lines, batch_size):
+        '''
+        (行番号, オブジェクト)を、同じモデルごとにbatch_size件までまと
+        めて返す。
+        '''
+
+        model = None
+        batch = []
+        for lineno, line in lines:
+            if not line.strip():
+                continue
+            try:
+                obj = next(serializers.deserialize('jsonl', [line])).object
+            except serializers.base.DeserializationError as e:
+                raise CommandError(f'line {lineno}: {e.__cause__ or e}')
+            if batch and (type(obj) is not model or len(batch) >= batch_size):
+                yield model, batch
+                batch = []
+            model = type(obj)
+            batch.append((lineno, obj))
+        if batch:
+            yield model, batch
+
+    def insert(self, model, batch):
+        with transaction.atomic():
+            # チェックポイントを記録する前に中断した場合、同じバッチを
+            # もう一度取り込むことになるので、取り込み済みの行は飛ばす
+            existing = set(model._base_manager.filter(
+                pk__in=[obj.pk for _, obj in batch]).values_list('pk', flat=True))
+            rows = [(lineno, obj) for lineno, obj in batch if obj.pk not in existing]
+            try:
+                model._default_manager.bulk_create_cleanly(
+                    [obj for _, obj in rows], batch_size=len(batch))
+            except BulkValidationError as e:
+                errors = '\n'.join(
+                    f'line {rows[i][0]}: {error.message_dict}'
+                    for i, error in sorted(e.row_errors.items()))
+                raise CommandError(f'{model._meta.label}: validation failed\n{errors}')
+
+    def load_checkpoint(self, checkpoint, path):
+        try:
+            with open(checkpoint, encoding='utf-8') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return 0
+        if state['input'] != os.path.abspath(path):
+            raise CommandError(f'{checkpoint} is a checkpoint for {state["input"]}')
+        return state['line']
+
+    def save_checkpoint(self, checkpoint, path, line):
+        tmp = f'{checkpoint}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'input': os.path.abspath(path), 'line': line}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, checkpoint)
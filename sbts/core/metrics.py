@@ -0,0 +1,235 @@
+'''
+Prometheusのテキスト形式で読み出せる、プロセス内のメトリクス。
+
+各プロセスは値をメモリに持ち、METRICS_DIRが設定されていれば、プロセ
+スごとのファイルに書き出す。読み出すときはすべてのファイルの値を足し
+合わせるので、複数のワーカープロセスで動かしても全体の値が得られる。
+終了したプロセスのファイルも残して足し合わせるので、カウンターは再
+起動しても減らない。ゲージは、生きているプロセスの値だけを足す。
+'''
+
+from django.conf import settings
+
+import atexit
+import glob
+import json
+import math
+import os
+import threading
+import time
+import uuid
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.reset()
+
+    def reset(self):
+        '''
+        このプロセスの値を空にし、新しいファイルに書き出すようにする。
+        fork()した子プロセスで呼び、親と同じファイルに書いたり、親の値
+        を二重に数えたりしないようにする。
+        '''
+
+        self.samples = {}
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.flushed_at = 0.0
+        # pidは再利用されるので、プロセスごとに一意な名前にする
+        self.filename = f'{os.getpid()}-{uuid.uuid4().hex}.json'
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def add(self, updates):
+        with self.lock:
+            for key, value in updates:
+                self.samples[key] = self.samples.get(key, 0) + value
+            self.dirty = True
+        self.flush_if_due()
+
+    def set(self, updates):
+        with self.lock:
+            for key, value in updates:
+                self.samples[key] = value
+            self.dirty = True
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        '''
+        前に書き出してからMETRICS_FLUSH_INTERVAL秒たっていれば書き出す。
+        リクエストの終わりに呼び、リクエストごとにファイルを書かない。
+        '''
+
+        if time.monotonic() - self.flushed_at >= settings.METRICS_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        '''
+        METRICS_DIRに、このプロセスの値を書き出す。
+        '''
+
+        if not settings.METRICS_DIR or not self.dirty:
+            return
+        with self.lock:
+            samples = [[name, list(labels), value]
+                       for (name, labels), value in self.samples.items()]
+            self.dirty = False
+            self.flushed_at = time.monotonic()
+
+        os.makedirs(settings.METRICS_DIR, exist_ok=True)
+        path = os.path.join(settings.METRICS_DIR, self.filename)
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(samples, f)
+        os.replace(tmp, path)
+
+    def collect(self):
+        '''
+        すべてのプロセスの値を足し合わせる。
+        '''
+
+        if not settings.METRICS_DIR:
+            with self.lock:
+                return dict(self.samples)
+
+        self.flush()
+        gauges = {name for metric in self.metrics if metric.type == 'gauge'
+                  for name in metric.sample_names}
+        samples = {}
+        for path in glob.glob(os.path.join(settings.METRICS_DIR, '*.json')):
+            try:
+                with open(path) as f:
+                    rows = json.load(f)
+            except FileNotFoundError:
+                continue
+            alive = process_alive(os.path.basename(path))
+            for name, labels, value in rows:
+                if name in gauges and not alive:
+                    continue
+                key = (name, tuple(tuple(label) for label in labels))
+                samples[key] = samples.get(key, 0) + value
+        return samples
+
+    def exposition(self):
+        '''
+        Prometheusのテキスト形式にする。
+        '''
+
+        samples = self.collect()
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for (name, labels), value in sorted(samples.items(), key=sample_order):
+                if name in metric.sample_names:
+                    lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        with self.lock:
+            self.samples = {}
+            self.dirty = True
+
+
+def process_alive(filename):
+    '''
+    ファイル名のpidのプロセスが動いているか。
+    '''
+
+    try:
+        os.kill(int(filename.split('-', 1)[0]), 0)
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        # 他のユーザーのプロセス
+        pass
+    return True
+
+
+def sample_order(item):
+    (name, labels), _ = item
+    # バケットは境界の小さい順に並べる
+    return (name, [(k, float(v) if k == 'le' else v) for k, v in labels])
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in labels)
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+registry = Registry()
+# 最後に書き出してから変わった値を、終了するときに書き出す
+atexit.register(registry.flush)
+# 読み込んでからfork()するサーバーでも、子プロセスごとに分ける
+os.register_at_fork(after_in_child=registry.reset)
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.sample_names = {name}
+        registry.register(self)
+
+    def inc(self, amount=1, **labels):
+        registry.add([((self.name, tuple(sorted(labels.items()))), amount)])
+
+
+class Histogram:
+    type = 'histogram'
+
+    DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = [*buckets, math.inf]
+        self.sample_names = {f'{name}_bucket', f'{name}_sum', f'{name}_count'}
+        registry.register(self)
+
+    def observe(self, value, **labels):
+        labels = tuple(sorted(labels.items()))
+        # 足し合わせられるように、バケットは累積で数える
+        updates = [
+            ((f'{self.name}_bucket', labels + (('le', format_value(le)),)),
+             1 if value <= le else 0)
+            for le in self.buckets
+        ]
+        updates.append(((f'{self.name}_sum', labels), value))
+        updates.append(((f'{self.name}_count', labels), 1))
+        registry.add(updates)
+
+
+class Gauge:
+    '''
+    プロセスが持っている量(メモリの使用量など)。読み出すときは、動いて
+    いるプロセスの値を足し合わせる。終了したプロセスの値は数えない。
+    '''
+
+    type = 'gauge'
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.sample_names = {name}
+        registry.register(self)
+
+    def set(self, value, **labels):
+        registry.set([((self.name, tuple(sorted(labels.items()))), value)])
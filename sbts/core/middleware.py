@@ -0,0 +1,222 @@
+from django.conf import settings
+from django.db import connections
+from django.middleware.gzip import GZipMiddleware
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+from django.utils.text import compress_sequence, compress_string
+
+import cProfile
+import contextlib
+import json
+import logging
+import os
+import random
+import re
+import time
+import uuid
+
+try:
+    import brotli
+except ImportError:
+    # brotliがなければgzipだけで圧縮する
+    brotli = None
+
+from . import metrics
+from . import perf
+
+
+REQUEST_SECONDS = metrics.Histogram(
+    'sbts_request_duration_seconds',
+    'Request latency by URL name.')
+
+perf_logger = logging.getLogger('sbts.perf')
+
+# 前段のプロキシなどが付けたリクエストIDは、この形式なら引き継ぐ
+request_id_re = re.compile(r'[0-9A-Za-z._-]{1,64}')
+
+# django.middleware.gzipと同じく、q値は見ない
+accepts_br_re = re.compile(r'\bbr\b')
+accepts_gzip_re = re.compile(r'\bgzip\b')
+
+
+def brotli_sequence(sequence):
+    compressor = brotli.Compressor(quality=settings.COMPRESSION_BROTLI_QUALITY)
+    for item in sequence:
+        if data := compressor.process(item) + compressor.flush():
+            yield data
+    yield compressor.finish()
+
+
+class CompressionMiddleware(MiddlewareMixin):
+    '''
+    HTMLやJSONのレスポンスを、クライアントが受け取れればbrotliかgzip
+    で圧縮する。
+
+    圧縮するのはCOMPRESSION_CONTENT_TYPESのレスポンスだけで、ブロブ
+    (application/octet-stream)や、符号化済みのレスポンス、範囲リクエ
+    ストへのレスポンスはそのまま返す。ストリーミングするレスポンスは、
+    チャンクごとに圧縮して送る。
+    '''
+
+    def process_response(self, request, response):
+        if not self.compressible(request, response):
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        accept_encoding = request.headers.get('Accept-Encoding', '')
+        if brotli is not None and accepts_br_re.search(accept_encoding):
+            encoding = 'br'
+        elif accepts_gzip_re.search(accept_encoding):
+            encoding = 'gzip'
+        else:
+            return response
+
+        if response.streaming:
+            if encoding == 'br':
+                response.streaming_content = brotli_sequence(response.streaming_content)
+            else:
+                response.streaming_content = compress_sequence(
+                    response.streaming_content,
+                    max_random_bytes=GZipMiddleware.max_random_bytes)
+            # 圧縮後の長さは分からない
+            del response.headers['Content-Length']
+        else:
+            if encoding == 'br':
+                compressed = brotli.compress(
+                    response.content, quality=settings.COMPRESSION_BROTLI_QUALITY)
+            else:
+                compressed = compress_string(
+                    response.content,
+                    max_random_bytes=GZipMiddleware.max_random_bytes)
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response.headers['Content-Length'] = str(len(response.content))
+
+        # 圧縮した内容はバイト単位では元と一致しないので、弱いETagにする
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response.headers['ETag'] = 'W/' + etag
+
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    def compressible(self, request, response):
+        if response.has_header('Content-Encoding'):
+            return False
+        # 範囲リクエストのバイト位置は、圧縮前の内容を指す
+        if (response.status_code == 206
+                or response.has_header('Content-Range')
+                or 'Range' in request.headers):
+            return False
+
+        content_type = response.get('Content-Type', '').split(';')[0].strip().lower()
+        if content_type not in settings.COMPRESSION_CONTENT_TYPES:
+            return False
+
+        if response.streaming:
+            length = response.get('Content-Length')
+            return length is None or int(length) >= settings.COMPRESSION_MIN_SIZE
+        return len(response.content) >= settings.COMPRESSION_MIN_SIZE
+
+
+class PerfMiddleware:
+    '''
+    リクエストごとに、ビュー名、処理時間、データベースへの問い合わせ
+    の回数と時間、S3の呼び出しの回数と時間と転送量、テンプレートの描
+    画時間を記録する。処理時間はURLの名前ごとにメトリクスにも記録す
+    る。遅いリクエストと、PERF_LOG_SAMPLE_RATEの割合で選んだリクエス
+    トを、S3の呼び出しのスパンとともにsbts.perfロガーに1行のJSONで書
+    く。
+
+    リクエストにはIDを付け、X-Request-IDヘッダーで返す。ログの行もこ
+    のIDで突き合わせられる。
+
+    ストリーミングするレスポンスのボディを送る間の処理は含まない。
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request_id = request.headers.get('X-Request-ID', '')
+        if not request_id_re.fullmatch(request_id):
+            request_id = uuid.uuid4().hex
+        stats = request.perf = perf.RequestStats(request_id)
+        token = perf.current.set(stats)
+        start = time.perf_counter()
+        try:
+            with contextlib.ExitStack() as stack:
+                for conn in connections.all():
+                    stack.enter_context(conn.execute_wrapper(perf.db_wrapper))
+                response = self.get_response(request)
+        finally:
+            perf.current.reset(token)
+        stats.latency = time.perf_counter() - start
+
+        match = request.resolver_match
+        REQUEST_SECONDS.observe(stats.latency, view=match.view_name if match else '')
+        metrics.registry.flush_if_due()
+
+        self.log(request, response, stats)
+        response['X-Request-ID'] = request_id
+        return response
+
+    def process_template_response(self, request, response):
+        stats = request.perf
+        start = time.perf_counter()
+
+        def rendered(response):
+            stats.render_time += time.perf_counter() - start
+
+        response.add_post_render_callback(rendered)
+        return response
+
+    def log(self, request, response, stats):
+        slow = (stats.latency * 1000 >= settings.PERF_SLOW_REQUEST_MS
+                or stats.db_queries >= settings.PERF_SLOW_DB_QUERIES)
+        if not slow and random.random() >= settings.PERF_LOG_SAMPLE_RATE:
+            return
+
+        match = request.resolver_match
+        record = {
+            'request_id': stats.request_id,
+            'view': match.view_name if match else None,
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'slow': slow,
+            **stats.as_dict(),
+            's3_spans': stats.s3_spans[:settings.PERF_LOG_MAX_SPANS],
+        }
+        perf_logger.log(logging.WARNING if slow else logging.INFO,
+                        json.dumps(record, ensure_ascii=False))
+
+
+class ProfileMiddleware:
+    '''
+    管理者がX-Profileヘッダーを付けたリクエストをcProfileで計測し、
+    PERF_PROFILE_DIRに「リクエストID.prof」の名前で書き出す。
+    PERF_PROFILE_DIRがNoneなら何もしない。
+
+    request.userとリクエストIDを使うので、AuthenticationMiddlewareと
+    PerfMiddlewareより後に置く。
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if (not settings.PERF_PROFILE_DIR
+                or 'X-Profile' not in request.headers
+                or not request.user.is_staff):
+            return self.get_response(request)
+
+        profiler = cProfile.Profile()
+        response = profiler.runcall(self.get_response, request)
+
+        os.makedirs(settings.PERF_PROFILE_DIR, exist_ok=True)
+        name = f'{request.perf.request_id}.prof'
+        profiler.dump_stats(os.path.join(settings.PERF_PROFILE_DIR, name))
+        response['X-Profile'] = name
+        return response
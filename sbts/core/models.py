@@ -1,3 +1,28 @@
+from django.core.exceptions import ValidationError
+from django.db import models, router
+
+
+class BulkValidationError(ValidationError):
+    '''
+    bulk_create_cleanlyで検査に失敗した行がある場合に送出する。
+    row_errorsは、失敗した行の番号をキー、その行のValidationErrorを値
+    とする辞書。nrowsは検査した行数。
+    '''
+
+    def __init__(self, row_errors, nrows):
+        super().__init__(f'{len(row_errors)} of {nrows} row(s) failed validation')
+        self.row_errors = row_errors
+        self.nrows = nrows
+
+    def message_dicts(self):
+        '''
+        各行のエラーを行の順に並べて返す。エラーのない行は空辞書。
+        '''
+
+        return [self.row_errors[i].message_dict if i in self.row_errors else {}
+                for i in range(self.nrows)]
+
+
 class CleanOpeManagerMixin:
     '''
     モデルのマネージャークラスで使用する。フィールドの検査(full_clean)
@@ -10,7 +35,106 @@ class CleanOpeManagerMixin:
             kwargs[self.field.name] = self.instance
         obj = self.model(*args, **kwargs)
         obj.full_clean()
-        return self.create(*args, **kwargs)
+        # 検査したオブジェクトをそのまま挿入する(createと同じ処理)。
+        # self.dbは読み出し用なので、書き込み用の接続を選ぶ
+        obj.save(force_insert=True,
+                 using=self._db or router.db_for_write(self.model, instance=obj))
+        return obj
+
+    def bulk_create_cleanly(self, objs, batch_size=1000):
+        '''
+        create_cleanlyの一括版。すべてのオブジェクトを検査してから、
+        batch_size件ずつbulk_createで挿入する。検査に失敗した行があれ
+        ば何も挿入せず、BulkValidationErrorを送出する。
+
+        full_cleanは外部キーの存在と一意性の検査で1行ごとに問い合わせ
+        るので、それらはbatch_size件ずつまとめて問い合わせる。
+        '''
+
+        objs = list(objs)
+        fks = [f for f in self.model._meta.concrete_fields if f.many_to_one]
+        uniques = [f for f in self.model._meta.concrete_fields if f.unique]
+        row_errors = [{} for _ in objs]
+
+        for obj, errors in zip(objs, row_errors):
+            if hasattr(self, 'instance') and hasattr(self, 'field'):
+                # RelatedManager
+                setattr(obj, self.field.name, self.instance)
+            try:
+                obj.full_clean(exclude=[f.name for f in fks], validate_unique=False)
+            except ValidationError as e:
+                e.update_error_dict(errors)
+            for f in fks:
+                try:
+                    value = f.to_python(getattr(obj, f.attname))
+                    # 参照先の存在以外を検査する
+                    models.Field.validate(f, value, obj)
+                    f.run_validators(value)
+                    setattr(obj, f.attname, value)
+                except ValidationError as e:
+                    errors.setdefault(f.name, []).extend(e.error_list)
+
+        # レプリカは遅れるので、挿入する先で確かめる
+        using = self._db or router.db_for_write(self.model)
+        seen = {f.name: set() for f in uniques}
+        for start in range(0, len(objs), batch_size):
+            batch = range(start, min(start + batch_size, len(objs)))
+            for f in fks:
+                self._check_related_exist(f, objs, row_errors, batch, using)
+            for f in uniques:
+                self._check_unique(f, objs, row_errors, batch, seen[f.name], using)
+
+        if any(row_errors):
+            raise BulkValidationError({
+                i: ValidationError(errors)
+                for i, errors in enumerate(row_errors) if errors
+            }, len(objs))
+
+        return self.bulk_create(objs, batch_size=batch_size)
+
+    def _check_related_exist(self, field, objs, row_errors, batch, using):
+        rows = [i for i in batch
+                if field.name not in row_errors[i]
+                and getattr(objs[i], field.attname) is not None]
+        if not rows:
+            return
+        target = field.remote_field.field_name
+        values = {getattr(objs[i], field.attname) for i in rows}
+        found = set(
+            field.remote_field.model._base_manager.using(using)
+            .complex_filter(field.get_limit_choices_to())
+            .filter(**{f'{target}__in': values})
+            .values_list(target, flat=True))
+        for i in rows:
+            value = getattr(objs[i], field.attname)
+            if value not in found:
+                row_errors[i].setdefault(field.name, []).append(ValidationError(
+                    field.error_messages['invalid'],
+                    code='invalid',
+                    params={
+                        'model': field.remote_field.model._meta.verbose_name,
+                        'pk': value,
+                        'field': target,
+                        'value': value,
+                    }))
+
+    def _check_unique(self, field, objs, row_errors, batch, seen, using):
+        rows = [i for i in batch
+                if field.name not in row_errors[i]
+                and getattr(objs[i], field.attname) is not None]
+        if not rows:
+            return
+        values = [getattr(objs[i], field.attname) for i in rows]
+        found = set(
+            self.model._base_manager.using(using)
+            .filter(**{f'{field.attname}__in': values})
+            .values_list(field.attname, flat=True))
+        for i, value in zip(rows, values):
+            # 挿入しようとしている行同士の重複も検査する(先の行を優先)
+            if value in found or value in seen:
+                row_errors[i].setdefault(field.name, []).append(
+                    objs[i].unique_error_message(self.model, (field.name,)))
+            seen.add(value)
 
 
 class CleanOpeModelMixin:
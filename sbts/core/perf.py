@@ -0,0 +1,109 @@
+'''
+リクエストごとの性能の計測。PerfMiddlewareが処理中のリクエストの
+RequestStatsをcurrentに設定し、データベースとS3の呼び出しをそこに記録
+する。S3の呼び出しは、1回ずつスパンとしても記録する。
+'''
+
+import boto3
+
+import contextvars
+import time
+
+
+current = contextvars.ContextVar('sbts_request_stats', default=None)
+
+
+class RequestStats:
+    def __init__(self, request_id=None):
+        self.request_id = request_id
+        self.latency = 0.0
+        self.db_queries = 0
+        self.db_time = 0.0
+        self.s3_calls = 0
+        self.s3_time = 0.0
+        self.s3_bytes = 0
+        self.s3_spans = []
+        self.render_time = 0.0
+
+    def as_dict(self):
+        return {
+            'latency_ms': round(self.latency * 1000, 3),
+            'db_queries': self.db_queries,
+            'db_ms': round(self.db_time * 1000, 3),
+            's3_calls': self.s3_calls,
+            's3_ms': round(self.s3_time * 1000, 3),
+            's3_bytes': self.s3_bytes,
+            'render_ms': round(self.render_time * 1000, 3),
+        }
+
+
+def db_wrapper(execute, sql, params, many, context):
+    '''
+    connection.execute_wrapperに渡す。
+    '''
+
+    stats = current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.db_queries += 1
+        stats.db_time += time.perf_counter() - start
+
+
+def s3_before_parameter_build(params, context, **kwargs):
+    if current.get() is None:
+        return
+    context['sbts_key'] = params.get('Key')
+
+
+def s3_before_call(model, params, context, **kwargs):
+    if current.get() is None:
+        return
+    context['sbts_start'] = time.perf_counter()
+    context['sbts_operation'] = model.name
+    body = params.get('body')
+    context['sbts_bytes'] = len(body) if isinstance(body, (bytes, bytearray)) else 0
+
+
+def s3_after_call(context, http_response=None, parsed=None, exception=None,
+                  **kwargs):
+    stats = current.get()
+    if stats is None or 'sbts_start' not in context:
+        return
+    # 読み出すボディは、呼び出しの後で読むので時間には含まれない
+    elapsed = time.perf_counter() - context['sbts_start']
+    nbytes = context['sbts_bytes']
+    if parsed and 'Body' in parsed:
+        nbytes += parsed.get('ContentLength', 0)
+
+    stats.s3_calls += 1
+    stats.s3_time += elapsed
+    stats.s3_bytes += nbytes
+    stats.s3_spans.append({
+        'operation': context['sbts_operation'],
+        'key': context.get('sbts_key'),
+        'bytes': nbytes,
+        'retries': context.get('retries', {}).get('attempt', 1) - 1,
+        'ms': round(elapsed * 1000, 3),
+        'status': http_response.status_code if http_response is not None else None,
+        'error': type(exception).__name__ if exception is not None else None,
+    })
+
+
+def install():
+    '''
+    S3のクライアントにフックを登録する。boto3.clientで作るクライアン
+    トは、作った時点の既定のセッションのフックを引き継ぐので、アプリ
+    ケーションの起動時に呼ぶ。
+    '''
+
+    boto3.setup_default_session()
+    events = boto3.DEFAULT_SESSION.events
+    events.register('before-parameter-build.s3', s3_before_parameter_build)
+    events.register('before-call.s3', s3_before_call)
+    events.register('after-call.s3', s3_after_call)
+    events.register('after-call-error.s3', s3_after_call)
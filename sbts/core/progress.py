@@ -0,0 +1,29 @@
+import time
+
+
+class Throughput:
+    '''
+    処理した行数を数え、毎秒の行数を一定間隔でstreamに報告する。
+    '''
+
+    def __init__(self, stream, label, interval=5.0):
+        self.stream = stream
+        self.label = label
+        self.interval = interval
+        self.rows = 0
+        self.start = self.last_report = time.monotonic()
+
+    def add(self, n=1):
+        self.rows += n
+        now = time.monotonic()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report(now)
+
+    def finish(self):
+        self.report(time.monotonic())
+
+    def report(self, now):
+        elapsed = now - self.start
+        rate = self.rows / elapsed if elapsed > 0 else 0.0
+        self.stream.write(f'{self.label}: {self.rows} rows, {elapsed:.1f} s, {rate:.0f} rows/s')
@@ -0,0 +1,174 @@
+'''
+読み取り専用のレプリカへの振り分け。
+
+replica_readsを真にしたビューへのGETとHEADは、DATABASE_REPLICASから
+順番に選んだ、健全なレプリカから読む。レプリカに読ませるのは
+DATABASE_REPLICA_APP_LABELSのモデルだけで、セッションや認証は、書い
+たすぐあとに読むのでプライマリから読む。
+
+レプリカは遅れて追いつくので、pins_primaryを真にしたビューにPOSTした
+ユーザーには、DATABASE_PRIMARY_PIN_SECONDSの間、Cookieでプライマリか
+ら読ませる。リダイレクトした先のページで、自分の書いたものが見える。
+'''
+
+from django.conf import settings
+from django.db import DatabaseError, DEFAULT_DB_ALIAS, connections
+
+import contextvars
+import itertools
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+PIN_COOKIE = 'sbts_primary'
+
+
+class Route:
+    '''
+    リクエストで読む先のレプリカ。aliasがNoneならプライマリから読む。
+    '''
+
+    alias = None
+
+
+_route = contextvars.ContextVar('sbts_replica_route', default=Route())
+
+
+class ReplicaPool:
+    '''
+    レプリカを順番に選ぶ。確かめて使えなかったレプリカは、
+    DATABASE_REPLICA_RETRY_SECONDSの間選ばない。
+    '''
+
+    # レプリカの遅れ(秒)。受け取ったWALをすべて適用していれば、プラ
+    # イマリに書き込みがなくて最後の適用から時間が経っていても遅れてい
+    # ない。スタンバイでなければNULL
+    lag_query = '''
+        SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+               END
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        # エイリアス -> 次に確かめる時刻
+        self.checked = {}
+        # エイリアス -> 選ばない期限
+        self.down = {}
+
+    def choose(self):
+        '''
+        レプリカのエイリアスを返す。使えるものがなければNoneを返す。
+        '''
+
+        replicas = settings.DATABASE_REPLICAS
+        if not replicas:
+            return None
+        start = next(self.counter)
+        for i in range(len(replicas)):
+            alias = replicas[(start + i) % len(replicas)]
+            if self.healthy(alias):
+                return alias
+        return None
+
+    def healthy(self, alias):
+        now = time.monotonic()
+        with self.lock:
+            if self.down.get(alias, 0) > now:
+                return False
+            if self.checked.get(alias, 0) > now:
+                return True
+
+        ok = self.check(alias)
+        with self.lock:
+            if ok:
+                self.down.pop(alias, None)
+                self.checked[alias] = now + settings.DATABASE_REPLICA_CHECK_INTERVAL
+            else:
+                self.down[alias] = now + settings.DATABASE_REPLICA_RETRY_SECONDS
+                self.checked.pop(alias, None)
+        return ok
+
+    def check(self, alias):
+        '''
+        つながり、遅れがDATABASE_REPLICA_MAX_LAG秒以内か。
+        '''
+
+        try:
+            with connections[alias].cursor() as cursor:
+                cursor.execute(self.lag_query)
+                lag, = cursor.fetchone()
+        except DatabaseError:
+            logger.warning('replica %s is unavailable', alias, exc_info=True)
+            return False
+        if lag is not None and lag > settings.DATABASE_REPLICA_MAX_LAG:
+            logger.warning('replica %s is %.1f seconds behind', alias, lag)
+            return False
+        return True
+
+    def reset(self):
+        with self.lock:
+            self.counter = itertools.count()
+            self.checked.clear()
+            self.down.clear()
+
+
+pool = ReplicaPool()
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        alias = _route.get().alias
+        if alias is not None and model._meta.app_label in settings.DATABASE_REPLICA_APP_LABELS:
+            return alias
+        return None
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # レプリカはプライマリと同じデータを持つ
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in settings.DATABASE_REPLICAS:
+            return False
+        return None
+
+
+class ReplicaMiddleware:
+    '''
+    ビューの属性を見て、読む先のレプリカを選び、POSTしたユーザーをプ
+    ライマリに固定する。
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.pins_primary = False
+        token = _route.set(Route())
+        try:
+            response = self.get_response(request)
+        finally:
+            _route.reset(token)
+
+        if request.pins_primary and response.status_code < 400:
+            response.set_cookie(PIN_COOKIE, '1',
+                                max_age=settings.DATABASE_PRIMARY_PIN_SECONDS,
+                                httponly=True, samesite='Lax')
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view_class = getattr(view_func, 'view_class', None)
+        if request.method == 'POST':
+            request.pins_primary = getattr(view_class, 'pins_primary', False)
+        elif (request.method in ('GET', 'HEAD')
+                and getattr(view_class, 'replica_reads', False)
+                and PIN_COOKIE not in request.COOKIES):
+            _route.get().alias = pool.choose()
+        return None
@@ -0,0 +1,67 @@
+'''
+collectstaticで集める静的ファイルの保存先。
+'''
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+
+import gzip
+import os
+
+try:
+    import brotli
+except ImportError:
+    # brotliがなければ.gzだけを作る
+    brotli = None
+
+
+# 拡張子 -> Content-Encoding。先にあるものを優先して返す
+ENCODINGS = {'.br': 'br', '.gz': 'gzip'}
+
+# 圧縮して縮むファイル
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.map', '.svg', '.txt', '.json', '.html', '.xml')
+
+
+def compressed_variants(data):
+    '''
+    (拡張子, 圧縮したデータ)を返す。元より縮まないものは返さない。
+    '''
+
+    variants = [('.gz', gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append(('.br', brotli.compress(data, quality=11)))
+    return [(ext, c) for ext, c in variants if len(c) < len(data)]
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    '''
+    内容のハッシュを付けた名前でも集め、圧縮できるファイルには、前もっ
+    て圧縮した.gzと.brを並べて置く。StaticViewは、クライアントが受け
+    取れれば圧縮した方を返す。
+    '''
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+
+        for name in sorted({*paths, *self.hashed_files.values()}):
+            if name.endswith(COMPRESSIBLE_EXTENSIONS) and self.exists(name):
+                self.compress(name)
+
+    def compress(self, name):
+        path = self.path(name)
+        with open(path, 'rb') as f:
+            data = f.read()
+        variants = dict(compressed_variants(data))
+        for ext in ENCODINGS:
+            if ext not in variants:
+                # 前に集めたときの古いものを返さないようにする
+                try:
+                    os.remove(path + ext)
+                except FileNotFoundError:
+                    pass
+                continue
+            tmp = f'{path}{ext}.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(variants[ext])
+            os.replace(tmp, path + ext)
@@ -0,0 +1,156 @@
+'''
+規模の検証やベンチマークに使う、合成データの生成。同じseedなら同じデー
+タになる。
+'''
+
+from django.db import connections, transaction
+
+import concurrent.futures
+import datetime
+import functools
+import itertools
+import math
+import random
+import uuid
+
+from sbts.file.models import UploadedFile
+from sbts.file.storage import get_storage
+from sbts.ticket.models import Ticket, Comment
+
+
+WORDS = [
+    'バグ', '再現', '手順', 'ログ', '確認', '修正', 'しました', 'です', 'が',
+    'を', 'に', 'は', 'テスト', '環境', 'リリース', '原因', '調査', '中',
+    'error', 'timeout', 'null', 'request', 'response', 'stack', 'trace',
+    'at', 'line', '404', '500', 'OK', '\n',
+]
+
+DEFAULT_START = datetime.datetime.fromisoformat('2020-01-01T00:00:00Z')
+
+
+class DataGenerator:
+    '''
+    チケット、コメント、ファイルのオブジェクトを作る。
+
+    コメントの数はチケットごとに偏らせ(パレート分布)、コメントの長さ
+    とファイルの大きさは対数正規分布にする。
+    '''
+
+    def __init__(self, seed=0, username='synthetic', start=DEFAULT_START,
+                 comment_median_length=200, comment_max_length=65535,
+                 file_median_size=64 * 1024, file_max_size=1024 ** 2):
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.username = username
+        self.start = start
+        self.comment_mu = math.log(comment_median_length)
+        self.comment_max_length = comment_max_length
+        self.file_mu = math.log(file_median_size)
+        self.file_max_size = file_max_size
+
+        # コメントの本文は、この文字列から切り出す
+        words = []
+        length = 0
+        while length < comment_max_length * 2:
+            w = self.rng.choice(WORDS)
+            words.append(w)
+            length += len(w) + 1
+        self.text = ' '.join(words)
+
+    def key(self):
+        return uuid.UUID(int=self.rng.getrandbits(128), version=4)
+
+    def tickets(self, n):
+        for i in range(n):
+            yield Ticket(key=self.key(),
+                         title=f'チケット {i}',
+                         created_at=self.start + datetime.timedelta(minutes=i))
+
+    def comments(self, tickets, n, batch_size=10000):
+        '''
+        ticketsは(key, created_at)のリスト。コメントは、チケットの作成
+        から30日以内に書かれたことにする。
+        '''
+
+        cum_weights = list(itertools.accumulate(
+            self.rng.paretovariate(1.16) for _ in tickets))
+        for start in range(0, n, batch_size):
+            chosen = self.rng.choices(tickets, cum_weights=cum_weights,
+                                      k=min(batch_size, n - start))
+            for key, created_at in chosen:
+                yield Comment(
+                    key=self.key(),
+                    comment=self.comment_text(),
+                    created_at=created_at + datetime.timedelta(
+                        seconds=self.rng.randrange(30 * 24 * 60 * 60)),
+                    username=self.username,
+                    ticket_id=key)
+
+    def comment_text(self):
+        length = int(self.rng.lognormvariate(self.comment_mu, 1.5))
+        length = min(max(length, 1), self.comment_max_length)
+        offset = self.rng.randrange(len(self.text) - length)
+        return self.text[offset:offset + length]
+
+    def files(self, n):
+        for i in range(n):
+            size = int(self.rng.lognormvariate(self.file_mu, 2))
+            yield UploadedFile(
+                key=self.key(),
+                name=f'file{i}.{self.rng.choice(["log", "txt", "png", "zip"])}',
+                last_modified=self.start + datetime.timedelta(minutes=i),
+                size=min(size, self.file_max_size),
+                username=self.username)
+
+    def blob(self, file):
+        '''
+        ファイルの中身。圧縮されないように乱数で作り、キーで切り出す位
+        置を変える。
+        '''
+
+        offset = file.key.int % 65536
+        return self.blob_pool[offset:offset + file.size]
+
+    @functools.cached_property
+    def blob_pool(self):
+        # 中身を作るかどうかで他のデータが変わらないように、別の乱数列
+        # を使う
+        return random.Random(self.seed).randbytes(self.file_max_size + 65536)
+
+
+def copy_insert(model, objs, using='default'):
+    '''
+    objsをCOPYで挿入する。検査はしないので、正しいデータにしか使わな
+    い。挿入した行数を返す。
+    '''
+
+    conn = connections[using]
+    fields = model._meta.concrete_fields
+    qn = conn.ops.quote_name
+    columns = ', '.join(qn(f.column) for f in fields)
+    n = 0
+    with transaction.atomic(using=using), conn.cursor() as cursor:
+        with cursor.copy(f'COPY {qn(model._meta.db_table)} ({columns}) FROM STDIN') as copy:
+            for obj in objs:
+                copy.write_row([f.get_db_prep_save(getattr(obj, f.attname), conn)
+                                for f in fields])
+                n += 1
+    return n
+
+
+def put_blobs(generator, files, workers):
+    '''
+    ファイルの中身を、workers個のスレッドで並行してストレージに書く。
+    '''
+
+    storage = get_storage()
+    # スレッドを始める前に作っておく
+    generator.blob_pool
+
+    def put(file):
+        storage.put(str(file.key), generator.blob(file))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        # 例外があれば送出させる
+        for _ in pool.map(put, files):
+            pass
@@ -1,24 +1,108 @@
-import subprocess
-from subprocess import DEVNULL
+import contextlib
+import json
+import os
+import tempfile
 import uuid
 
-from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
 from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 
-import boto3
+from sbts.file.storage import get_storage
 
 
-@override_settings(S3_BUCKET_FILE='test-{}'.format(uuid.uuid4()))
+_test_id = uuid.uuid4()
+
+
+# settings.FILE_STORAGEのどちらの保存先でも、テストごとに空の保存先を使う
+@override_settings(
+    S3_BUCKET_FILE=f'test-{_test_id}',
+    S3_BUCKET_FILE_COLD=f'test-{_test_id}-cold',
+    FILE_STORAGE_DIR=os.path.join(tempfile.gettempdir(), f'sbts-test-{_test_id}'))
 class ObjectStorageTestCase(TestCase):
     def setUp(self):
         super().setUp()
-        s3client = boto3.client('s3', endpoint_url=settings.S3_ENDPOINT)
-        s3client.create_bucket(Bucket=settings.S3_BUCKET_FILE)
+        get_storage().create()
 
     def tearDown(self):
         super().tearDown()
-        # コマンドの方が手っ取り早い
-        # https://docs.aws.amazon.com/AmazonS3/latest/userguide/delete-bucket.html
-        cmd = ['aws', '--endpoint-url', f'{settings.S3_ENDPOINT}',
-               's3', 'rb', f's3://{settings.S3_BUCKET_FILE}', '--force']
-        subprocess.run(cmd, stdout=DEVNULL, check=True)
+        get_storage().destroy()
+
+
+class QueryGuardMixin:
+    '''
+    ビューの問い合わせの回数の上限と、問い合わせの実行計画を検査する。
+    TestCaseと一緒に継承する。
+    '''
+
+    @contextlib.contextmanager
+    def assertMaxQueries(self, num, using=DEFAULT_DB_ALIAS):
+        '''
+        ブロックの中での問い合わせがnum回以下であること。assertNumQueries
+        と違い、回数が減っても失敗しない。
+        '''
+
+        with CaptureQueriesContext(connections[using]) as ctx:
+            yield ctx
+
+        queries = '\n'.join(f'{i}. {q["sql"]}'
+                            for i, q in enumerate(ctx.captured_queries, start=1))
+        self.assertLessEqual(
+            len(ctx), num,
+            f'{len(ctx)} queries executed, at most {num} expected\n{queries}')
+
+    def assertNoSeqScan(self, queryset, tables):
+        '''
+        querysetの実行計画に、tablesのSeq Scanがないこと。
+
+        小さいテーブルでは索引があってもSeq Scanが選ばれるので、
+        enable_seqscanをoffにして計画を立てさせる。それでもSeq Scanに
+        なるのは、使える索引がないときだけなので、データの量によらずに
+        大きいテーブルでの計画を検査できる。パーティションにしたテーブ
+        ルでは、各パーティションのSeq Scanも検査する。
+        '''
+
+        tables = [*tables, *partition_names(queryset.db, tables)]
+        plan = explain(queryset)
+        seqscans = [node['Relation Name'] for node in plan_nodes(plan)
+                    if node['Node Type'] == 'Seq Scan'
+                    and node['Relation Name'] in tables]
+        self.assertEqual(
+            seqscans, [],
+            f'sequential scan in plan\n{json.dumps(plan, indent=2)}')
+
+
+def explain(queryset):
+    '''
+    querysetの実行計画を、EXPLAIN (FORMAT JSON)の木で返す。
+    '''
+
+    sql, params = queryset.query.sql_with_params()
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute('SET enable_seqscan = off')
+        try:
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            return cursor.fetchone()[0][0]['Plan']
+        finally:
+            cursor.execute('RESET enable_seqscan')
+
+
+def partition_names(using, tables):
+    '''
+    tablesのパーティションの名前。
+    '''
+
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            'SELECT c.relname FROM pg_inherits i '
+            'JOIN pg_class c ON c.oid = i.inhrelid '
+            'JOIN pg_class p ON p.oid = i.inhparent '
+            'WHERE p.relname = ANY(%s)',
+            [list(tables)])
+        return [name for name, in cursor.fetchall()]
+
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
@@ -0,0 +1,822 @@
+import datetime
+import gzip
+import io
+import json
+import os
+import pstats
+import tempfile
+import uuid
+from unittest import skipIf, skipUnless
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connections
+from django.http import FileResponse, HttpResponse, JsonResponse, \
+    StreamingHttpResponse
+from django.test import TestCase, TransactionTestCase, RequestFactory, \
+    override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.template import Context, Template
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from sbts.file.models import UploadedFile, upload_blob
+from sbts.file.storage import NotFound, S3Storage, get_storage
+from sbts.ticket.models import Ticket, Comment
+
+from . import metrics
+from . import replica
+from . import staticfiles
+from .middleware import CompressionMiddleware, brotli
+from .synthetic import DataGenerator
+from .test_utils import ObjectStorageTestCase
+
+
+class JsonlExportImportTest(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'dump.jsonl')
+
+    def tearDown(self):
+        super().tearDown()
+        self.tmpdir.cleanup()
+
+    def create_data(self):
+        t1_dt = datetime.datetime.fromisoformat('2023-10-23T23:20:00Z')
+        t1 = Ticket.objects.create_cleanly(title='ticket 1', created_at=t1_dt)
+        t2 = Ticket.objects.create_cleanly(title='ticket 2', created_at=t1_dt)
+        for i in range(5):
+            c_dt = datetime.datetime.fromisoformat('2023-10-24T09:00:00Z') + datetime.timedelta(minutes=i)
+            (t1 if i % 2 else t2).comment_set.create_cleanly(
+                comment=f'comment {i}\n改行', created_at=c_dt, username='shimon')
+        lastmod = datetime.datetime.fromisoformat('2023-11-04T12:00:00Z')
+        UploadedFile.objects.create_cleanly(
+            name='hello.txt', last_modified=lastmod, size=6, username='shimon')
+
+    def snapshot(self):
+        return (
+            list(Ticket.objects.order_by('pk').values()),
+            list(Comment.objects.order_by('pk').values()),
+            list(UploadedFile.objects.order_by('pk').values()),
+        )
+
+    def delete_all(self):
+        Ticket.objects.all().delete()
+        UploadedFile.objects.all().delete()
+
+    def test_roundtrip(self):
+        self.create_data()
+        before = self.snapshot()
+
+        call_command('export_jsonl', output=self.path, chunk_size=2, stderr=io.StringIO())
+        with open(self.path, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 2 + 5 + 1)
+        self.assertEqual(json.loads(lines[0])['model'], 'ticket.ticket')
+
+        self.delete_all()
+        stderr = io.StringIO()
+        call_command('import_jsonl', self.path, batch_size=3, stderr=stderr)
+
+        self.assertEqual(self.snapshot(), before)
+        self.assertIn('rows/s', stderr.getvalue())
+        self.assertFalse(os.path.exists(f'{self.path}.checkpoint'))
+
+    def test_resume(self):
+        '''
+        チェックポイントより後の行だけを取り込む
+        '''
+
+        self.create_data()
+        before = self.snapshot()
+        call_command('export_jsonl', output=self.path, stderr=io.StringIO())
+
+        # 3行目まで取り込んだところで中断したことにする
+        Comment.objects.all().delete()
+        UploadedFile.objects.all().delete()
+        with open(f'{self.path}.checkpoint', 'w', encoding='utf-8') as f:
+            json.dump({'input': os.path.abspath(self.path), 'line': 3}, f)
+        with open(self.path, encoding='utf-8') as f:
+            third = json.loads(f.read().splitlines()[2])
+        Comment.objects.filter(pk=third['pk']).delete()
+
+        call_command('import_jsonl', self.path, batch_size=2, stderr=io.StringIO())
+
+        comments = before[1]
+        self.assertQuerySetEqual(
+            Comment.objects.order_by('pk').values_list('pk', flat=True),
+            [c['key'] for c in comments if str(c['key']) != third['pk']])
+        self.assertEqual(self.snapshot()[2], before[2])
+
+    def test_already_imported(self):
+        '''
+        取り込み済みの行は飛ばす(チェックポイントの記録前に中断した場合)
+        '''
+
+        self.create_data()
+        before = self.snapshot()
+        call_command('export_jsonl', output=self.path, stderr=io.StringIO())
+
+        call_command('import_jsonl', self.path, stderr=io.StringIO())
+
+        self.assertEqual(self.snapshot(), before)
+
+    def test_invalid(self):
+        '''
+        検査に失敗した行があれば、その行番号を示して中断する
+        '''
+
+        self.create_data()
+        call_command('export_jsonl', output=self.path, stderr=io.StringIO())
+        self.delete_all()
+
+        with open(self.path, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        row = json.loads(lines[1])
+        row['fields']['title'] = ''
+        lines[1] = json.dumps(row)
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+
+        with self.assertRaisesRegex(CommandError, 'line 2'):
+            call_command('import_jsonl', self.path, stderr=io.StringIO())
+        self.assertQuerySetEqual(Ticket.objects.all(), [])
+
+
+class JsonlExportSnapshotTest(TransactionTestCase):
+    def test_snapshot(self):
+        '''
+        すべてのモデルを、読み取り専用の1つのスナップショットから書き出す
+        '''
+
+        t1_dt = datetime.datetime.fromisoformat('2023-10-23T23:20:00Z')
+        t1 = Ticket.objects.create_cleanly(title='ticket 1', created_at=t1_dt)
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                CaptureQueriesContext(connections['default']) as ctx:
+            path = os.path.join(tmpdir, 'dump.jsonl')
+            call_command('export_jsonl', output=path, stderr=io.StringIO())
+            with open(path, encoding='utf-8') as f:
+                lines = f.read().splitlines()
+
+        sqls = [q['sql'] for q in ctx.captured_queries]
+        self.assertEqual(sqls[:2], ['BEGIN', 'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY'])
+        self.assertEqual(json.loads(lines[0])['pk'], str(t1.key))
+
+
+class CompressionMiddlewareTest(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.req_factory = RequestFactory()
+
+    def process(self, response, **headers):
+        req = self.req_factory.get('/', **headers)
+        return CompressionMiddleware(lambda req: response)(req)
+
+    def html(self, size=4096):
+        return HttpResponse(b'<p>hello.</p>' * (size // 13))
+
+    def test_gzip(self):
+        orig = self.html()
+        content = orig.content
+        resp = self.process(orig, HTTP_ACCEPT_ENCODING='gzip, deflate')
+
+        self.assertEqual(resp['Content-Encoding'], 'gzip')
+        self.assertEqual(resp['Vary'], 'Accept-Encoding')
+        self.assertEqual(int(resp['Content-Length']), len(resp.content))
+        self.assertEqual(gzip.decompress(resp.content), content)
+
+    @skipIf(brotli is None, 'brotli is not installed')
+    def test_brotli(self):
+        orig = self.html()
+        content = orig.content
+        resp = self.process(orig, HTTP_ACCEPT_ENCODING='gzip, deflate, br')
+
+        self.assertEqual(resp['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(resp.content), content)
+
+    def test_json(self):
+        orig = JsonResponse({'comments': ['hello.'] * 1000})
+        content = orig.content
+        resp = self.process(orig, HTTP_ACCEPT_ENCODING='gzip')
+
+        self.assertEqual(resp['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(resp.content), content)
+
+    def test_not_accepted(self):
+        resp = self.process(self.html())
+
+        self.assertFalse(resp.has_header('Content-Encoding'))
+        self.assertEqual(resp['Vary'], 'Accept-Encoding')
+
+    def test_small(self):
+        resp = self.process(self.html(size=100), HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse(resp.has_header('Content-Encoding'))
+
+    def test_streaming(self):
+        chunks = [b'{"key": "%d"}\n' % i for i in range(1000)]
+        orig = StreamingHttpResponse(iter(chunks), content_type='text/html')
+        resp = self.process(orig, HTTP_ACCEPT_ENCODING='gzip')
+
+        self.assertEqual(resp['Content-Encoding'], 'gzip')
+        self.assertFalse(resp.has_header('Content-Length'))
+        self.assertEqual(gzip.decompress(b''.join(resp.streaming_content)),
+                         b''.join(chunks))
+
+    def test_octet_stream(self):
+        '''
+        ブロブは圧縮しない
+        '''
+
+        orig = FileResponse(io.BytesIO(b'a' * 4096),
+                            content_type='application/octet-stream')
+        resp = self.process(orig, HTTP_ACCEPT_ENCODING='gzip')
+
+        self.assertFalse(resp.has_header('Content-Encoding'))
+        self.assertEqual(b''.join(resp.streaming_content), b'a' * 4096)
+
+    def test_range(self):
+        resp = self.process(self.html(), HTTP_ACCEPT_ENCODING='gzip',
+                            HTTP_RANGE='bytes=0-99')
+        self.assertFalse(resp.has_header('Content-Encoding'))
+
+        orig = self.html()
+        orig.status_code = 206
+        orig['Content-Range'] = f'bytes 0-{len(orig.content) - 1}/10000'
+        resp = self.process(orig, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse(resp.has_header('Content-Encoding'))
+
+    def test_already_encoded(self):
+        orig = self.html()
+        orig['Content-Encoding'] = 'gzip'
+        content = orig.content
+        resp = self.process(orig, HTTP_ACCEPT_ENCODING='gzip')
+
+        self.assertEqual(resp.content, content)
+
+    def test_etag(self):
+        orig = self.html()
+        orig['ETag'] = '"abc"'
+        resp = self.process(orig, HTTP_ACCEPT_ENCODING='gzip')
+
+        self.assertEqual(resp['ETag'], 'W/"abc"')
+
+    def test_page(self):
+        '''
+        MIDDLEWAREに組み込まれている
+        '''
+
+        t1_dt = datetime.datetime.fromisoformat('2023-10-23T23:20:00Z')
+        t1 = Ticket.objects.create_cleanly(title='ticket 1', created_at=t1_dt)
+        for i in range(50):
+            t1.comment_set.create_cleanly(
+                comment=f'comment {i}', created_at=t1_dt, username='shimon')
+
+        resp = self.client.get(
+            reverse('page:ticket_detail_page', kwargs={'key': t1.key}),
+            HTTP_ACCEPT_ENCODING='gzip')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp['Content-Encoding'], 'gzip')
+        self.assertIn(b'comment 49', gzip.decompress(resp.content))
+
+
+class PerfMiddlewareTest(ObjectStorageTestCase):
+    def create_ticket(self):
+        t1_dt = datetime.datetime.fromisoformat('2023-10-23T23:20:00Z')
+        t1 = Ticket.objects.create_cleanly(title='ticket 1', created_at=t1_dt)
+        t1.comment_set.create_cleanly(
+            comment='comment 1', created_at=t1_dt, username='shimon')
+        return t1
+
+    @override_settings(PERF_SLOW_REQUEST_MS=0)
+    def test_slow(self):
+        t1 = self.create_ticket()
+        with self.assertLogs('sbts.perf', 'WARNING') as cm:
+            resp = self.client.get(
+                reverse('page:ticket_detail_page', kwargs={'key': t1.key}))
+
+        self.assertEqual(resp.status_code, 200)
+        record = json.loads(cm.records[0].getMessage())
+        self.assertEqual(record['view'], 'page:ticket_detail_page')
+        self.assertEqual(record['method'], 'GET')
+        self.assertEqual(record['status'], 200)
+        self.assertIs(record['slow'], True)
+        self.assertGreater(record['latency_ms'], 0)
+        self.assertGreater(record['db_queries'], 0)
+        self.assertGreater(record['render_ms'], 0)
+        self.assertEqual(record['s3_calls'], 0)
+
+    @override_settings(PERF_SLOW_DB_QUERIES=1)
+    def test_slow_db_queries(self):
+        t1 = self.create_ticket()
+        with self.assertLogs('sbts.perf', 'WARNING'):
+            self.client.get(
+                reverse('page:ticket_detail_page', kwargs={'key': t1.key}))
+
+    @skipUnless(import_string(settings.FILE_STORAGE) is S3Storage, 'not using S3Storage')
+    @override_settings(PERF_SLOW_REQUEST_MS=0)
+    def test_s3(self):
+        content = b'hello.'
+        key = upload_blob(io.BytesIO(content), 'shimon')
+        lastmod = datetime.datetime.fromisoformat('2023-11-04T12:00:00Z')
+        UploadedFile.objects.create_from_s3(key, 'shimon', 'hello.txt', lastmod)
+
+        with self.assertLogs('sbts.perf', 'WARNING') as cm:
+            resp = self.client.get(reverse('page:file:blob', kwargs={'key': key}))
+            self.assertEqual(b''.join(resp.streaming_content), content)
+
+        record = json.loads(cm.records[0].getMessage())
+        self.assertEqual(record['view'], 'page:file:blob')
+        self.assertEqual(record['s3_calls'], 1)
+        self.assertEqual(record['s3_bytes'], len(content))
+        self.assertGreater(record['s3_ms'], 0)
+        self.assertEqual(record['request_id'], resp['X-Request-ID'])
+        span, = record['s3_spans']
+        self.assertEqual(span['operation'], 'GetObject')
+        self.assertEqual(span['key'], str(key))
+        self.assertEqual(span['bytes'], len(content))
+        self.assertEqual(span['retries'], 0)
+        self.assertEqual(span['status'], 200)
+        self.assertIsNone(span['error'])
+
+    def test_request_id(self):
+        resp = self.client.get('/no/such/page/')
+        self.assertRegex(resp['X-Request-ID'], r'^[0-9a-f]{32}$')
+
+        resp = self.client.get('/no/such/page/', HTTP_X_REQUEST_ID='from-proxy.1')
+        self.assertEqual(resp['X-Request-ID'], 'from-proxy.1')
+
+        resp = self.client.get('/no/such/page/', HTTP_X_REQUEST_ID='a b')
+        self.assertNotEqual(resp['X-Request-ID'], 'a b')
+
+    def test_profile(self):
+        '''
+        管理者がX-Profileヘッダーを付けたリクエストだけを計測する
+        '''
+
+        t1 = self.create_ticket()
+        url = reverse('page:ticket_detail_page', kwargs={'key': t1.key})
+        with tempfile.TemporaryDirectory() as tmpdir, \
+             override_settings(PERF_PROFILE_DIR=tmpdir):
+            self.client.force_login(User.objects.create_user('shimon'))
+            resp = self.client.get(url, HTTP_X_PROFILE='1')
+            self.assertFalse(resp.has_header('X-Profile'))
+
+            self.client.force_login(
+                User.objects.create_user('admin', is_staff=True))
+            resp = self.client.get(url)
+            self.assertFalse(resp.has_header('X-Profile'))
+            resp = self.client.get(url, HTTP_X_PROFILE='1')
+
+            self.assertEqual(resp['X-Profile'], f'{resp["X-Request-ID"]}.prof')
+            self.assertEqual(os.listdir(tmpdir), [resp['X-Profile']])
+            stats = pstats.Stats(os.path.join(tmpdir, resp['X-Profile']))
+            self.assertGreater(stats.total_calls, 0)
+
+    def test_not_slow(self):
+        t1 = self.create_ticket()
+        with self.assertNoLogs('sbts.perf'):
+            self.client.get(
+                reverse('page:ticket_detail_page', kwargs={'key': t1.key}))
+
+    @override_settings(PERF_LOG_SAMPLE_RATE=1.0)
+    def test_sampled(self):
+        with self.assertLogs('sbts.perf', 'INFO') as cm:
+            self.client.get('/no/such/page/')
+
+        self.assertEqual(cm.records[0].levelname, 'INFO')
+        record = json.loads(cm.records[0].getMessage())
+        self.assertIsNone(record['view'])
+        self.assertEqual(record['status'], 404)
+        self.assertIs(record['slow'], False)
+
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.registry.clear()
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        super().tearDown()
+        self.tmpdir.cleanup()
+
+    def test_exposition(self):
+        counter = metrics.Counter('test_requests_total', 'Test counter.')
+        histogram = metrics.Histogram('test_seconds', 'Test histogram.',
+                                      buckets=(0.1, 1))
+        self.addCleanup(metrics.registry.metrics.remove, counter)
+        self.addCleanup(metrics.registry.metrics.remove, histogram)
+
+        counter.inc(status='200')
+        counter.inc(2, status='200')
+        counter.inc(status='404')
+        histogram.observe(0.5)
+        histogram.observe(2)
+
+        lines = metrics.registry.exposition().splitlines()
+        i = lines.index('# TYPE test_requests_total counter')
+        self.assertEqual(lines[i + 1:i + 3], [
+            'test_requests_total{status="200"} 3',
+            'test_requests_total{status="404"} 1',
+        ])
+        i = lines.index('# TYPE test_seconds histogram')
+        self.assertEqual(lines[i + 1:i + 6], [
+            'test_seconds_bucket{le="0.1"} 0',
+            'test_seconds_bucket{le="1"} 1',
+            'test_seconds_bucket{le="+Inf"} 2',
+            'test_seconds_count 2',
+            'test_seconds_sum 2.5',
+        ])
+
+    def test_multiprocess(self):
+        '''
+        METRICS_DIRにある、他のプロセスの値と足し合わせる
+        '''
+
+        counter = metrics.Counter('test_requests_total', 'Test counter.')
+        self.addCleanup(metrics.registry.metrics.remove, counter)
+
+        with override_settings(METRICS_DIR=self.tmpdir.name):
+            with open(os.path.join(self.tmpdir.name, '1-other.json'), 'w') as f:
+                json.dump([['test_requests_total', [['status', '200']], 5]], f)
+            counter.inc(status='200')
+            counter.inc(status='404')
+
+            samples = metrics.registry.collect()
+
+        self.assertEqual(samples[('test_requests_total', (('status', '200'),))], 6)
+        self.assertEqual(samples[('test_requests_total', (('status', '404'),))], 1)
+
+    def test_gauge(self):
+        gauge = metrics.Gauge('test_bytes', 'Test gauge.')
+        self.addCleanup(metrics.registry.metrics.remove, gauge)
+
+        with override_settings(METRICS_DIR=self.tmpdir.name):
+            with open(os.path.join(self.tmpdir.name, '1-other.json'), 'w') as f:
+                json.dump([['test_bytes', [], 5]], f)
+            gauge.set(10)
+            gauge.set(3)
+
+            lines = metrics.registry.exposition().splitlines()
+
+        i = lines.index('# TYPE test_bytes gauge')
+        self.assertEqual(lines[i + 1], 'test_bytes 8')
+
+    def test_gauge_dead_process(self):
+        '''
+        終了したプロセスのゲージは足さず、カウンターは足す
+        '''
+
+        gauge = metrics.Gauge('test_bytes', 'Test gauge.')
+        counter = metrics.Counter('test_requests_total', 'Test counter.')
+        self.addCleanup(metrics.registry.metrics.remove, gauge)
+        self.addCleanup(metrics.registry.metrics.remove, counter)
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+        with override_settings(METRICS_DIR=self.tmpdir.name):
+            with open(os.path.join(self.tmpdir.name, f'{pid}-dead.json'), 'w') as f:
+                json.dump([['test_bytes', [], 5], ['test_requests_total', [], 2]], f)
+            gauge.set(3)
+            counter.inc()
+
+            samples = metrics.registry.collect()
+
+        self.assertEqual(samples[('test_bytes', ())], 3)
+        self.assertEqual(samples[('test_requests_total', ())], 3)
+
+    def test_fork(self):
+        '''
+        fork()した子プロセスは、親の値を持たず別のファイルに書き出す
+        '''
+
+        counter = metrics.Counter('test_requests_total', 'Test counter.')
+        self.addCleanup(metrics.registry.metrics.remove, counter)
+        counter.inc()
+
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            os.write(w, json.dumps([metrics.registry.filename,
+                                    len(metrics.registry.samples)]).encode())
+            os._exit(0)
+        os.close(w)
+        os.waitpid(pid, 0)
+        with os.fdopen(r) as f:
+            filename, nsamples = json.load(f)
+
+        self.assertTrue(filename.startswith(f'{pid}-'))
+        self.assertNotEqual(filename, metrics.registry.filename)
+        self.assertEqual(nsamples, 0)
+        self.assertEqual(metrics.registry.samples[('test_requests_total', ())], 1)
+
+    def test_view(self):
+        self.client.get('/no/such/page/')
+        resp = self.client.get(reverse('metrics'))
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn('sbts_request_duration_seconds_count{view=""} 1',
+                      resp.content.decode().splitlines())
+
+    def test_view_forbidden(self):
+        '''
+        許可していないアドレスからは、スタッフのユーザーしか読めない
+        '''
+
+        resp = self.client.get(reverse('metrics'), REMOTE_ADDR='192.0.2.1')
+        self.assertEqual(resp.status_code, 403)
+
+        with override_settings(METRICS_ALLOWED_NETWORKS=['192.0.2.0/24']):
+            resp = self.client.get(reverse('metrics'), REMOTE_ADDR='192.0.2.1')
+            self.assertEqual(resp.status_code, 200)
+
+        User.objects.create_user('admin', 'admin@example.com', 'pw', is_staff=True)
+        self.client.login(username='admin', password='pw')
+        resp = self.client.get(reverse('metrics'), REMOTE_ADDR='192.0.2.1')
+        self.assertEqual(resp.status_code, 200)
+
+    def test_flush_interval(self):
+        '''
+        METRICS_FLUSH_INTERVALがたつまでは、リクエストごとに書き出さない
+        '''
+
+        counter = metrics.Counter('test_requests_total', 'Test counter.')
+        self.addCleanup(metrics.registry.metrics.remove, counter)
+        path = os.path.join(self.tmpdir.name, metrics.registry.filename)
+
+        with override_settings(METRICS_DIR=self.tmpdir.name, METRICS_FLUSH_INTERVAL=3600):
+            metrics.registry.flush()
+            counter.inc()
+            self.client.get('/no/such/page/')
+            with open(path) as f:
+                self.assertNotIn('test_requests_total', f.read())
+
+            metrics.registry.flushed_at -= 3600
+            self.client.get('/no/such/page/')
+            with open(path) as f:
+                self.assertIn('test_requests_total', f.read())
+
+
+class StaticFilesTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # rest_frameworkの分もあり時間がかかるので、1回だけ集める
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.static_settings = override_settings(
+            STATIC_ROOT=cls.tmpdir.name,
+            STORAGES={
+                **settings.STORAGES,
+                'staticfiles': {
+                    'BACKEND': 'sbts.core.staticfiles.CompressedManifestStaticFilesStorage',
+                },
+            })
+        cls.static_settings.enable()
+        call_command('collectstatic', interactive=False, verbosity=0)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.static_settings.disable()
+        cls.tmpdir.cleanup()
+        super().tearDownClass()
+
+    def hashed_url(self, name):
+        return Template(f'{{% load static %}}{{% static "{name}" %}}').render(Context())
+
+    def test_collectstatic(self):
+        url = self.hashed_url('page/style.css')
+        self.assertRegex(url, r'^/static/page/style\.[0-9a-f]{12}\.css$')
+
+        path = os.path.join(self.tmpdir.name, url.removeprefix('/static/'))
+        with open(path, 'rb') as f:
+            content = f.read()
+        with open(path + '.gz', 'rb') as f:
+            self.assertEqual(gzip.decompress(f.read()), content)
+        if staticfiles.brotli is not None:
+            with open(path + '.br', 'rb') as f:
+                self.assertEqual(staticfiles.brotli.decompress(f.read()), content)
+
+    def test_hashed(self):
+        url = self.hashed_url('page/file.js')
+        resp = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp['Content-Encoding'], 'gzip')
+        self.assertEqual(resp['Vary'], 'Accept-Encoding')
+        self.assertEqual(resp['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertIn('javascript', resp['Content-Type'])
+        with staticfiles_storage.open(url.removeprefix('/static/')) as f:
+            self.assertEqual(gzip.decompress(b''.join(resp.streaming_content)), f.read())
+
+    @skipIf(staticfiles.brotli is None, 'brotli is not installed')
+    def test_brotli(self):
+        resp = self.client.get(self.hashed_url('page/style.css'),
+                               headers={'Accept-Encoding': 'gzip, br'})
+        self.assertEqual(resp['Content-Encoding'], 'br')
+        b''.join(resp.streaming_content)
+
+    def test_identity(self):
+        url = self.hashed_url('page/style.css')
+        resp = self.client.get(url)
+
+        self.assertNotIn('Content-Encoding', resp)
+        self.assertEqual(resp['Vary'], 'Accept-Encoding')
+        self.assertTrue(resp['Content-Type'].startswith('text/css'))
+        with staticfiles_storage.open(url.removeprefix('/static/')) as f:
+            self.assertEqual(b''.join(resp.streaming_content), f.read())
+
+    def test_unhashed(self):
+        '''
+        ハッシュを付けていない名前は、毎回確かめさせる
+        '''
+
+        resp = self.client.get('/static/page/style.css')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp['Cache-Control'], 'no-cache')
+        b''.join(resp.streaming_content)
+
+    def test_not_found(self):
+        self.assertEqual(self.client.get('/static/page/nothing.css').status_code, 404)
+        self.assertEqual(self.client.get('/static/page/').status_code, 404)
+        self.assertEqual(self.client.get('/static/../../etc/passwd').status_code, 404)
+        self.assertEqual(self.client.get('/static/%2e%2e/%2e%2e/etc/passwd').status_code, 404)
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaTest(TransactionTestCase):
+    '''
+    テスト用の設定のreplicaは、同じデータベースへの別の接続。書いた
+    ものを別の接続から読めるように、トランザクションでテストを包まな
+    い。
+    '''
+
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        super().setUp()
+        replica.pool.reset()
+        self.user_shimon = User.objects.create_user('shimon', 'shimon@example.com', 'pw')
+        Ticket.objects.create_cleanly(key=uuid.uuid4(), title='first',
+                                      created_at=timezone.now())
+
+    def get(self, url):
+        with CaptureQueriesContext(connections['default']) as on_default, \
+                CaptureQueriesContext(connections['replica']) as on_replica:
+            resp = self.client.get(url)
+        return resp, on_default, on_replica
+
+    def ticket_queries(self, ctx):
+        return [q['sql'] for q in ctx.captured_queries if 'ticket_ticket' in q['sql']]
+
+    def test_read_from_replica(self):
+        resp, on_default, on_replica = self.get(reverse('page:ticket_page'))
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertContains(resp, 'first')
+        self.assertEqual(self.ticket_queries(on_default), [])
+        self.assertNotEqual(self.ticket_queries(on_replica), [])
+
+    def test_write_to_primary(self):
+        '''
+        POSTはプライマリから読み書きし、そのあとしばらくはGETもプライ
+        マリから読む
+        '''
+
+        self.client.force_login(self.user_shimon)
+        with CaptureQueriesContext(connections['replica']) as on_replica:
+            resp = self.client.post(reverse('page:ticket'), {'title': 'second'})
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(len(on_replica), 0)
+        cookie = resp.cookies[replica.PIN_COOKIE]
+        self.assertEqual(cookie['max-age'], settings.DATABASE_PRIMARY_PIN_SECONDS)
+
+        resp, on_default, on_replica = self.get(resp['Location'])
+        self.assertContains(resp, 'second')
+        self.assertNotEqual(self.ticket_queries(on_default), [])
+        self.assertEqual(len(on_replica), 0)
+
+    def test_unhealthy(self):
+        '''
+        つながらないレプリカは選ばず、しばらく確かめ直さない
+        '''
+
+        conn = connections['replica']
+        conn.close()
+        port = conn.settings_dict['PORT']
+        conn.settings_dict['PORT'] = 1
+        self.addCleanup(conn.settings_dict.__setitem__, 'PORT', port)
+
+        # つながらないので、replicaの問い合わせは記録できない
+        with self.assertLogs('sbts.core.replica', 'WARNING'), \
+                CaptureQueriesContext(connections['default']) as on_default:
+            resp = self.client.get(reverse('page:ticket_page'))
+        self.assertContains(resp, 'first')
+        self.assertNotEqual(self.ticket_queries(on_default), [])
+
+        with self.assertNoLogs('sbts.core.replica', 'WARNING'), \
+                CaptureQueriesContext(connections['default']) as on_default:
+            resp = self.client.get(reverse('page:ticket_page'))
+        self.assertNotEqual(self.ticket_queries(on_default), [])
+
+    def test_create_cleanly(self):
+        '''
+        レプリカから読んでいる間も、挿入と一括挿入の検査はプライマリで
+        する
+        '''
+
+        token = replica._route.set(replica.Route())
+        replica._route.get().alias = 'replica'
+        try:
+            with CaptureQueriesContext(connections['replica']) as on_replica:
+                Ticket.objects.create_cleanly(key=uuid.uuid4(), title='second',
+                                              created_at=timezone.now())
+            self.assertFalse([q for q in on_replica.captured_queries
+                              if q['sql'].startswith('INSERT')])
+            with CaptureQueriesContext(connections['replica']) as on_replica:
+                Ticket.objects.bulk_create_cleanly([
+                    Ticket(key=uuid.uuid4(), title='third', created_at=timezone.now())])
+            self.assertEqual(len(on_replica), 0)
+        finally:
+            replica._route.reset(token)
+        self.assertEqual(Ticket.objects.count(), 3)
+
+    @override_settings(DATABASE_REPLICAS=['replica', 'default'])
+    def test_round_robin(self):
+        self.assertEqual([replica.pool.choose() for _ in range(4)],
+                         ['replica', 'default', 'replica', 'default'])
+
+        replica.pool.down['replica'] = float('inf')
+        self.assertEqual([replica.pool.choose() for _ in range(2)], ['default', 'default'])
+        replica.pool.down['default'] = float('inf')
+        self.assertIsNone(replica.pool.choose())
+
+    def test_lag(self):
+        '''
+        遅れがDATABASE_REPLICA_MAX_LAG秒を超えたレプリカは選ばない。テ
+        スト用のreplicaはスタンバイではないので、遅れの問い合わせを差し
+        替える
+        '''
+
+        pool = replica.ReplicaPool()
+        self.assertTrue(pool.check('replica'))
+
+        pool.lag_query = f'SELECT {settings.DATABASE_REPLICA_MAX_LAG + 1}'
+        with self.assertLogs('sbts.core.replica', 'WARNING'):
+            self.assertFalse(pool.check('replica'))
+        pool.lag_query = f'SELECT {settings.DATABASE_REPLICA_MAX_LAG}'
+        self.assertTrue(pool.check('replica'))
+
+
+class GenerateDataTest(ObjectStorageTestCase):
+    def test_ok(self):
+        call_command('generate_data', tickets=10, comments=200, files=5,
+                     comment_max_length=1000, file_max_size=4096,
+                     batch_size=64, workers=2, stderr=io.StringIO())
+
+        self.assertEqual(Ticket.objects.count(), 10)
+        self.assertEqual(Comment.objects.count(), 200)
+        self.assertEqual(UploadedFile.objects.count(), 5)
+        for c in Comment.objects.all():
+            self.assertLessEqual(len(c.comment), 1000)
+            c.full_clean()
+
+        storage = get_storage()
+        for f in UploadedFile.objects.all():
+            self.assertLessEqual(f.size, 4096)
+            with storage.open(str(f.key)) as blob:
+                self.assertEqual(len(blob.read()), f.size)
+
+    def test_no_blobs(self):
+        call_command('generate_data', tickets=1, comments=1, files=3,
+                     no_blobs=True, stderr=io.StringIO())
+
+        self.assertEqual(UploadedFile.objects.count(), 3)
+        for f in UploadedFile.objects.all():
+            with self.assertRaises(NotFound):
+                get_storage().open(str(f.key))
+
+    def test_seed(self):
+        '''
+        同じseedなら同じデータになる
+        '''
+
+        def generate(seed):
+            gen = DataGenerator(seed=seed)
+            tickets = [(t.key, t.created_at) for t in gen.tickets(10)]
+            comments = [(c.key, c.comment, c.created_at, c.ticket_id)
+                        for c in gen.comments(tickets, 100)]
+            files = [(f.key, f.name, f.size) for f in gen.files(10)]
+            return tickets, comments, files
+
+        self.assertEqual(generate(1), generate(1))
+        self.assertNotEqual(generate(1), generate(2))
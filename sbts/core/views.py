@@ -0,0 +1,84 @@
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.exceptions import PermissionDenied, SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import patch_vary_headers
+from django.views import View
+
+import ipaddress
+import mimetypes
+import os
+
+from . import metrics
+from .middleware import accepts_br_re, accepts_gzip_re
+from .staticfiles import ENCODINGS
+
+
+class MetricsView(View):
+    '''
+    Prometheusのテキスト形式でメトリクスを返す。スタッフのユーザーか、
+    METRICS_ALLOWED_NETWORKSのアドレスからしか読めない。
+    '''
+
+    def get(self, request, *args, **kwargs):
+        if not (request.user.is_staff or self.allowed(request.META.get('REMOTE_ADDR', ''))):
+            raise PermissionDenied()
+        return HttpResponse(metrics.registry.exposition(),
+                            content_type='text/plain; version=0.0.4; charset=utf-8')
+
+    def allowed(self, addr):
+        try:
+            addr = ipaddress.ip_address(addr)
+        except ValueError:
+            return False
+        return any(addr in ipaddress.ip_network(net.strip(), strict=False)
+                   for net in settings.METRICS_ALLOWED_NETWORKS if net.strip())
+
+
+class StaticView(View):
+    '''
+    collectstaticでSTATIC_ROOTに集めた静的ファイルを返す。DEBUGのとき
+    はrunserverが先に返すので、ここには来ない。
+
+    内容のハッシュを付けた名前のファイルは変わらないので、
+    STATIC_CACHE_CONTROLで長期間キャッシュさせる。前もって圧縮した.br
+    や.gzがあれば、クライアントが受け取れればそちらを返す。
+    '''
+
+    accepts = {'br': accepts_br_re, 'gzip': accepts_gzip_re}
+
+    def get(self, request, *args, **kwargs):
+        name = kwargs['path']
+        try:
+            path = safe_join(settings.STATIC_ROOT, name)
+        except SuspiciousFileOperation:
+            raise Http404()
+        if not os.path.isfile(path):
+            raise Http404()
+
+        accept_encoding = request.headers.get('Accept-Encoding', '')
+        variants = [(ext, encoding) for ext, encoding in ENCODINGS.items()
+                    if os.path.isfile(path + ext)]
+        encoding = None
+        for ext, enc in variants:
+            if self.accepts[enc].search(accept_encoding):
+                path, encoding = path + ext, enc
+                break
+
+        content_type, _ = mimetypes.guess_type(name)
+        resp = FileResponse(open(path, 'rb'),
+                            content_type=content_type or 'application/octet-stream')
+        if encoding is not None:
+            resp['Content-Encoding'] = encoding
+        if variants:
+            patch_vary_headers(resp, ['Accept-Encoding'])
+        if name in self.hashed_names():
+            resp['Cache-Control'] = settings.STATIC_CACHE_CONTROL
+        else:
+            # ハッシュを付けていない名前は、中身が変わりうる
+            resp['Cache-Control'] = 'no-cache'
+        return resp
+
+    def hashed_names(self):
+        return set(getattr(staticfiles_storage, 'hashed_files', {}).values())
@@ -1,6 +1,15 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save
 
 
 class FileConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'sbts.file'
+
+    def ready(self):
+        from .cache import discard_deleted
+        from .metacache import invalidate_changed
+        from .models import UploadedFile
+        post_delete.connect(discard_deleted, sender=UploadedFile)
+        post_save.connect(invalidate_changed, sender=UploadedFile)
+        post_delete.connect(invalidate_changed, sender=UploadedFile)
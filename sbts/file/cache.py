@@ -0,0 +1,208 @@
+'''
+よく読まれるブロブの、ローカルディスクへのキャッシュ。
+
+ブロブはキーごとに中身が変わらないので、UploadedFile.keyをそのままファ
+イル名にし、消すのはUploadedFileを消したときと、FILE_CACHE_MAX_SIZE
+を超えたときだけにする。最近使った順(mtime)で古いものから追い出すの
+で、同じディレクトリを複数のプロセスで共有できる。
+
+キャッシュにないブロブは、いつも通り返しながら、読んだ分を一時ファイ
+ルにも書き、最後まで読んだらキャッシュに入れる。保存先からは1回しか読
+まない。保存したまま(圧縮していれば圧縮したまま)入れる。
+'''
+
+from django.conf import settings
+
+import logging
+import os
+import threading
+import uuid
+
+from . import metrics
+from .storage import Blob
+
+
+logger = logging.getLogger(__name__)
+
+
+class BlobCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # このプロセスで入れている途中のキー
+        self.filling = set()
+
+    @property
+    def enabled(self):
+        return bool(settings.FILE_CACHE_DIR)
+
+    def path(self, key):
+        return os.path.join(settings.FILE_CACHE_DIR, str(key))
+
+    def cacheable(self, storage, file):
+        # ローカルに保存したブロブは、キャッシュしても速くならない
+        return (self.enabled
+                and file.size <= settings.FILE_CACHE_MAX_FILE_SIZE
+                and storage.local_path(str(file.key)) is None)
+
+    def open(self, key):
+        '''
+        キャッシュにあれば開いたファイルを、なければNoneを返す。
+        '''
+
+        try:
+            f = open(self.path(key), 'rb')
+        except FileNotFoundError:
+            metrics.CACHE_REQUESTS.inc(result='miss')
+            return None
+        metrics.CACHE_REQUESTS.inc(result='hit')
+        try:
+            # 最近使ったことにする
+            os.utime(f.fileno())
+        except OSError:
+            pass
+        return f
+
+    def tee(self, blob, key):
+        '''
+        読んだ分をキャッシュにも入れるBlobを返す。同じキーを入れている
+        途中なら、blobをそのまま返す。
+        '''
+
+        with self.lock:
+            if key in self.filling:
+                return blob
+            self.filling.add(key)
+        try:
+            os.makedirs(settings.FILE_CACHE_DIR, exist_ok=True)
+            tmp = os.path.join(settings.FILE_CACHE_DIR, f'.{uuid.uuid4().hex}.tmp')
+            f = open(tmp, 'wb')
+        except OSError:
+            logger.exception('failed to fill blob cache: %s', key)
+            metrics.CACHE_FILL_ERRORS.inc()
+            self.done(key)
+            return blob
+        return Blob(Tee(self, key, blob, f), blob.size, blob.content_type)
+
+    def done(self, key):
+        with self.lock:
+            self.filling.discard(key)
+
+    def fill(self, storage, key):
+        '''
+        ブロブを読んでキャッシュに入れる。
+        '''
+
+        try:
+            blob = storage.open(str(key))
+        except Exception:
+            logger.exception('failed to fill blob cache: %s', key)
+            metrics.CACHE_FILL_ERRORS.inc()
+            return
+        with self.tee(blob, key) as blob:
+            while blob.read(settings.FILE_DOWNLOAD_BLOCK_SIZE):
+                pass
+
+    def evict(self):
+        '''
+        FILE_CACHE_MAX_SIZEに収まるまで、使ったのが古い順に消す。
+        '''
+
+        entries = []
+        total = 0
+        with os.scandir(settings.FILE_CACHE_DIR) as it:
+            for entry in it:
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= settings.FILE_CACHE_MAX_SIZE:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # 他のプロセスが消した
+                pass
+            else:
+                metrics.CACHE_EVICTIONS.inc()
+                metrics.CACHE_EVICTED_BYTES.inc(size)
+            total -= size
+
+    def discard(self, key):
+        if not self.enabled:
+            return
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+
+
+class Tee:
+    '''
+    読んだ分をキャッシュの一時ファイルにも書くファイル。size bytesを読
+    み終えたらキャッシュに入れ、その前に閉じたら捨てる。
+    '''
+
+    def __init__(self, cache, key, blob, tmp):
+        self.cache = cache
+        self.key = key
+        self.file = blob.file
+        self.size = blob.size
+        self.tmp = tmp
+        self.written = 0
+
+    def read(self, size=-1):
+        chunk = self.file.read(size)
+        if self.tmp is not None:
+            try:
+                self.tmp.write(chunk)
+                self.written += len(chunk)
+                if self.written >= self.size:
+                    self.finish()
+            except OSError:
+                logger.exception('failed to fill blob cache: %s', self.key)
+                metrics.CACHE_FILL_ERRORS.inc()
+                self.abandon()
+        return chunk
+
+    def finish(self):
+        tmp, self.tmp = self.tmp, None
+        tmp.close()
+        os.replace(tmp.name, self.cache.path(self.key))
+        self.cache.done(self.key)
+        metrics.CACHE_FILLS.inc()
+        self.cache.evict()
+
+    def abandon(self):
+        tmp, self.tmp = self.tmp, None
+        tmp.close()
+        try:
+            os.remove(tmp.name)
+        except FileNotFoundError:
+            pass
+        self.cache.done(self.key)
+
+    def close(self):
+        try:
+            self.file.close()
+        finally:
+            if self.tmp is not None:
+                self.abandon()
+
+
+blob_cache = BlobCache()
+
+
+def discard_deleted(sender, instance, **kwargs):
+    '''
+    UploadedFileのpost_deleteに接続する。
+    '''
+
+    blob_cache.discard(instance.key)
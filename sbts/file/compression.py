@@ -0,0 +1,96 @@
+'''
+ログやダンプのような、よく縮むファイルを圧縮して保存する。
+'''
+
+from django.conf import settings
+
+import gzip
+import re
+import zlib
+
+
+IDENTITY = ''
+GZIP = 'gzip'
+ENCODING_CHOICES = [
+    (IDENTITY, 'Identity'),
+    (GZIP, 'gzip'),
+]
+
+# django.middleware.gzipと同じく、q値は見ない
+accepts_gzip_re = re.compile(r'\bgzip\b')
+
+
+def choose_encoding(head):
+    '''
+    ブロブの先頭(head)を試しに圧縮してみて、保存するときの圧縮方式を
+    選ぶ。画像や圧縮済みのファイルのように縮まないものは、そのまま保
+    存する。
+    '''
+
+    if not settings.FILE_COMPRESSION or len(head) < settings.FILE_COMPRESSION_MIN_SIZE:
+        return IDENTITY
+    sample = head[:settings.FILE_COMPRESSION_SAMPLE_SIZE]
+    if len(zlib.compress(sample, 1)) > len(sample) * settings.FILE_COMPRESSION_MAX_RATIO:
+        return IDENTITY
+    return GZIP
+
+
+class PartWriter:
+    '''
+    書かれたデータを、S3のマルチパートアップロードのパートの大きさに
+    区切る。encodingがGZIPなら、gzipで圧縮しながら区切る。
+    '''
+
+    def __init__(self, encoding, part_size):
+        self.part_size = part_size
+        self.buf = bytearray()
+        if encoding == GZIP:
+            self.compressor = zlib.compressobj(
+                settings.FILE_COMPRESSION_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        else:
+            self.compressor = None
+
+    def write(self, data):
+        '''
+        データを書き、大きさがそろったパートのリストを返す。
+        '''
+
+        if self.compressor:
+            data = self.compressor.compress(data)
+        self.buf += data
+        return self.take_parts(self.part_size)
+
+    def close(self):
+        '''
+        残りのデータを、最後のパートとして返す。
+        '''
+
+        if self.compressor:
+            self.buf += self.compressor.flush()
+        return self.take_parts(1)
+
+    def take_parts(self, min_size):
+        parts = []
+        while self.buf and len(self.buf) >= min_size:
+            parts.append(bytes(self.buf[:self.part_size]))
+            del self.buf[:self.part_size]
+        return parts
+
+
+def accepts(request, encoding):
+    '''
+    クライアントが、encodingで符号化したまま受け取れるか。
+    '''
+
+    return (encoding == GZIP
+            and bool(accepts_gzip_re.search(request.headers.get('Accept-Encoding', ''))))
+
+
+def open_blob(body, encoding):
+    '''
+    S3から読んだボディを、元の内容を読むファイルオブジェクトにする。
+    '''
+
+    if encoding == GZIP:
+        return gzip.GzipFile(fileobj=body, mode='rb')
+    return body
@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from sbts.file.storage import get_storage
+from sbts.file.tiering import cold_files, move_to_cold
+
+
+class Command(BaseCommand):
+    help = ('しばらくダウンロードされていないブロブを、コールドストレー'
+            'ジに移す。cronなどで定期的に実行する。')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.FILE_COLD_AFTER_DAYS,
+                            help='この日数ダウンロードされていないブロブを移す')
+        parser.add_argument('--limit', type=int, default=None,
+                            help='1回に移すブロブの数の上限')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='移すブロブを表示するだけにする')
+
+    def handle(self, *args, **options):
+        storage = get_storage()
+        now = timezone.now()
+        files = cold_files(options['days'], now)[:options['limit']]
+        for file in files.iterator():
+            if not options['dry_run'] \
+                    and not move_to_cold(file, options['days'], now, storage):
+                continue
+            self.stdout.write(f'{file.key} {file.name}')
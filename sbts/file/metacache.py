@@ -0,0 +1,140 @@
+'''
+BlobViewが使うUploadedFileの属性の、プロセス内のキャッシュ。
+
+同じ添付ファイルを何度もダウンロードされても、データベースに問い合わ
+せないようにする。UploadedFileの属性はキーごとにほとんど変わらないの
+で、作ったときと消したときに捨て、あとはFILE_METADATA_CACHE_TTL秒で
+期限切れにする。ないキーも、別のプロセスで作られることがあるので、短
+いFILE_METADATA_CACHE_NEGATIVE_TTL秒だけ覚えておく。
+'''
+
+from django.conf import settings
+
+import collections
+import sys
+import threading
+import time
+
+from . import metrics
+
+
+# BlobViewが使う属性だけを持つ
+BlobMeta = collections.namedtuple(
+    'BlobMeta', ['key', 'name', 'size', 'last_modified', 'encoding', 'tier', 'last_accessed'])
+
+FIELDS = BlobMeta._fields
+
+
+def entry_size(key, meta):
+    '''
+    エントリーのおおよそのメモリの使用量。
+    '''
+
+    size = sys.getsizeof(key) + sys.getsizeof((0.0, meta))
+    if meta is not None:
+        size += sys.getsizeof(meta) + sum(sys.getsizeof(v) for v in meta)
+    return size
+
+
+class MetadataCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # キー -> (期限, BlobMetaかNone, 使用量)。古く使った順
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        # 捨てた回数。問い合わせている間に捨てたものを入れないため
+        self.generation = 0
+
+    def get(self, key):
+        '''
+        keyのBlobMetaを返す。UploadedFileがなければ
+        UploadedFile.DoesNotExistを送出する。
+        '''
+
+        from .models import UploadedFile
+
+        key = str(key)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(key)
+            else:
+                entry = None
+            generation = self.generation
+
+        if entry is not None:
+            metrics.METADATA_CACHE_REQUESTS.inc(result='hit')
+            meta = entry[1]
+        else:
+            metrics.METADATA_CACHE_REQUESTS.inc(result='miss')
+            row = UploadedFile.objects.filter(key=key).values_list(*FIELDS).first()
+            meta = None if row is None else BlobMeta(*row)
+            self.put(key, meta, now, generation)
+
+        if meta is None:
+            raise UploadedFile.DoesNotExist()
+        return meta
+
+    def put(self, key, meta, now, generation):
+        if settings.FILE_METADATA_CACHE_SIZE <= 0:
+            return
+        if meta is None:
+            expires = now + settings.FILE_METADATA_CACHE_NEGATIVE_TTL
+        else:
+            expires = now + settings.FILE_METADATA_CACHE_TTL
+        size = entry_size(key, meta)
+
+        with self.lock:
+            if generation != self.generation:
+                return
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[2]
+            self.entries[key] = (expires, meta, size)
+            self.nbytes += size
+            while len(self.entries) > settings.FILE_METADATA_CACHE_SIZE:
+                _, (_, _, evicted) = self.entries.popitem(last=False)
+                self.nbytes -= evicted
+            self.report()
+
+    def replace(self, meta):
+        '''
+        覚えているmetaを、期限はそのままで置き換える。
+        '''
+
+        key = str(meta.key)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] is not None:
+                self.entries[key] = (entry[0], meta, entry[2])
+
+    def invalidate(self, key):
+        with self.lock:
+            self.generation += 1
+            old = self.entries.pop(str(key), None)
+            if old is not None:
+                self.nbytes -= old[2]
+            self.report()
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.nbytes = 0
+            self.report()
+
+    def report(self):
+        metrics.METADATA_CACHE_ENTRIES.set(len(self.entries))
+        metrics.METADATA_CACHE_BYTES.set(self.nbytes)
+
+
+metadata_cache = MetadataCache()
+
+
+def invalidate_changed(sender, instance, **kwargs):
+    '''
+    UploadedFileのpost_saveとpost_deleteに接続する。
+    '''
+
+    metadata_cache.invalidate(instance.key)
@@ -0,0 +1,59 @@
+from sbts.core.metrics import Counter, Gauge, Histogram
+
+
+UPLOAD_BYTES = Counter(
+    'sbts_upload_bytes_total',
+    'Bytes received by S3Uploader.upload (before compression).')
+UPLOAD_STORED_BYTES = Counter(
+    'sbts_upload_stored_bytes_total',
+    'Bytes stored to S3 by S3Uploader.upload (after compression).')
+UPLOAD_PART_SECONDS = Histogram(
+    'sbts_upload_part_seconds',
+    'Latency of each S3 UploadPart call.',
+    buckets=(.01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30))
+UPLOAD_PARTS = Histogram(
+    'sbts_upload_parts',
+    'Number of parts per multipart upload.',
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 1024, 10000))
+S3_ERRORS = Counter(
+    'sbts_s3_errors_total',
+    'S3 calls that raised an error.')
+DOWNLOAD_BYTES = Counter(
+    'sbts_download_bytes_total',
+    'Bytes sent by BlobView.')
+DOWNLOAD_TTFB_SECONDS = Histogram(
+    'sbts_download_ttfb_seconds',
+    'Time from the start of BlobView to its first body chunk.')
+DOWNLOAD_REQUESTS = Counter(
+    'sbts_download_requests_total',
+    'BlobView requests by status code.')
+CACHE_REQUESTS = Counter(
+    'sbts_blob_cache_requests_total',
+    'Blob cache lookups by result (hit or miss).')
+CACHE_FILLS = Counter(
+    'sbts_blob_cache_fills_total',
+    'Blobs copied into the blob cache.')
+CACHE_FILL_ERRORS = Counter(
+    'sbts_blob_cache_fill_errors_total',
+    'Blob cache fills that failed.')
+CACHE_EVICTIONS = Counter(
+    'sbts_blob_cache_evictions_total',
+    'Blobs evicted from the blob cache.')
+CACHE_EVICTED_BYTES = Counter(
+    'sbts_blob_cache_evicted_bytes_total',
+    'Bytes evicted from the blob cache.')
+METADATA_CACHE_REQUESTS = Counter(
+    'sbts_metadata_cache_requests_total',
+    'BlobView metadata cache lookups by result (hit or miss).')
+METADATA_CACHE_ENTRIES = Gauge(
+    'sbts_metadata_cache_entries',
+    'Entries in the BlobView metadata cache, including negative entries.')
+METADATA_CACHE_BYTES = Gauge(
+    'sbts_metadata_cache_bytes',
+    'Approximate memory used by the BlobView metadata cache.')
+COLD_MOVES = Counter(
+    'sbts_blob_cold_moves_total',
+    'Blobs moved to cold storage by move_cold_blobs.')
+RESTORES = Counter(
+    'sbts_blob_restores_total',
+    'Restores of cold blobs by result (requested or completed).')
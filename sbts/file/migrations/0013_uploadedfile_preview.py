@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-19 17:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('file', '0012_alter_uploadedfile_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadedfile',
+            name='preview',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
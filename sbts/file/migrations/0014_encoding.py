@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-19 17:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('file', '0013_uploadedfile_preview'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='s3uploader',
+            name='encoding',
+            field=models.CharField(blank=True, choices=[('', 'Identity'), ('gzip', 'gzip')], default='', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='uploadedfile',
+            name='encoding',
+            field=models.CharField(blank=True, choices=[('', 'Identity'), ('gzip', 'gzip')], default='', max_length=16),
+        ),
+    ]
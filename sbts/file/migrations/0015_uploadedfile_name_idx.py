@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-19 17:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('file', '0014_encoding'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='uploadedfile',
+            index=models.Index(fields=['name', 'last_modified', 'key'], name='uploadedfile_name_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.7 on 2026-10-19 18:42
+
+from django.db import migrations, models
+import sbts.file.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('file', '0015_uploadedfile_name_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadedfile',
+            name='last_accessed',
+            field=models.DateTimeField(default=sbts.file.models.access_time),
+        ),
+        migrations.AddField(
+            model_name='uploadedfile',
+            name='tier',
+            field=models.IntegerField(choices=[(0, 'Hot'), (1, 'Cold'), (2, 'Restoring')], default=0),
+        ),
+        migrations.AddIndex(
+            model_name='uploadedfile',
+            index=models.Index(fields=['tier', 'last_accessed'], name='uploadedfile_tier_idx'),
+        ),
+    ]
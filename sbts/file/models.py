@@ -1,10 +1,24 @@
 from django.conf import settings
 from django.db import models, transaction
+from django.utils import timezone
+import time
 import uuid
-import boto3
 
 from sbts.core.models import CleanOpeManagerMixin, CleanOpeModelMixin
 
+from . import compression
+from . import metrics
+from .storage import get_storage
+
+
+def access_time():
+    '''
+    last_accessedに書く日時。export_jsonlで書き出すとミリ秒未満は落
+    ちるので、秒までにする。
+    '''
+
+    return timezone.now().replace(microsecond=0)
+
 
 class UploadedFile(models.Model, CleanOpeModelMixin):
     class Manager(models.Manager, CleanOpeManagerMixin):
@@ -22,22 +36,55 @@ class UploadedFile(models.Model, CleanOpeModelMixin):
                     name=filename,
                     last_modified=last_modified,
                     size=uploader.size,
+                    encoding=uploader.encoding,
                     username=username,
                     **kwargs)
                 uploader.delete()
 
+                # tasksはこのモジュールに依存するので、ここで読み込む
+                from .tasks import generate_preview
+                generate_preview.enqueue(key=str(file.key))
+
                 return file
 
     class Meta:
         default_manager_name = 'objects'
+        indexes = [
+            # ファイルの一覧の並び順
+            models.Index(fields=['name', 'last_modified', 'key'],
+                         name='uploadedfile_name_idx'),
+            # move_cold_blobsで移すブロブを探す
+            models.Index(fields=['tier', 'last_accessed'],
+                         name='uploadedfile_tier_idx'),
+        ]
 
     objects = Manager()
 
+    # ブロブの保存先の層。COLDとRESTORINGのブロブは読めない
+    HOT = 0
+    COLD = 1
+    RESTORING = 2
+    TIER_CHOICES = [
+        (HOT, 'Hot'),
+        (COLD, 'Cold'),
+        (RESTORING, 'Restoring'),
+    ]
+
     key = models.UUIDField(primary_key=True, default=uuid.uuid4)
     name = models.CharField(max_length=255)
     last_modified = models.DateTimeField()
     size = models.BigIntegerField()
     username = models.CharField(max_length=150)
+    # プレビューのContent-Type。プレビューがなければ空文字列。
+    preview = models.CharField(max_length=64, blank=True, default='')
+    # S3に保存した内容の圧縮方式。圧縮していなければ空文字列。sizeは
+    # 圧縮する前の大きさ。
+    encoding = models.CharField(max_length=16, blank=True, default='',
+                                choices=compression.ENCODING_CHOICES)
+    tier = models.IntegerField(choices=TIER_CHOICES, default=HOT)
+    # 最後にダウンロードされた日時。FILE_LAST_ACCESSED_RESOLUTIONごとに
+    # しか更新しない
+    last_accessed = models.DateTimeField(default=access_time)
 
 
 # 内部用
@@ -60,12 +107,13 @@ class S3Uploader(models.Model, CleanOpeModelMixin):
     key = models.UUIDField(primary_key=True, default=uuid.uuid4)
     status = models.IntegerField(choices=STATUS_CHOICES)
     size = models.BigIntegerField(null=True, blank=True, default=None)
+    encoding = models.CharField(max_length=16, blank=True, default='',
+                                choices=compression.ENCODING_CHOICES)
     username = models.CharField(max_length=150)
 
     @classmethod
     def upload(cls, blob, username):
         key = uuid.uuid4()
-        size = 0
 
         with transaction.atomic(durable=True):
             cls.objects.create_cleanly(
@@ -73,58 +121,65 @@ class S3Uploader(models.Model, CleanOpeModelMixin):
                 status=cls.UPLOADING,
                 username=username)
 
-        s3client = boto3.client('s3', endpoint_url=settings.S3_ENDPOINT)
-
-        resp = s3client.create_multipart_upload(
-            Bucket=settings.S3_BUCKET_FILE,
-            Key=str(key))
-        upload_id = resp['UploadId']
-
-        multipart_upload = {
-            'Parts': []
-        }
-        partnum = 1  # 1 ~ 10,000
-        while chunk := blob.read(settings.S3_CHUNK_SIZE):
-            part = s3client.upload_part(
-                Body=chunk,
-                Bucket=settings.S3_BUCKET_FILE,
-                Key=str(key),
-                PartNumber=partnum,
-                UploadId=upload_id)
-            multipart_upload['Parts'].append({
-                'ETag': part['ETag'],
-                'PartNumber': partnum,
-            })
-            partnum += 1
-            size += len(chunk)
-
-        # 空ファイルの場合
-        if partnum == 1:
-            part = s3client.upload_part(
-                Body=b'',
-                Bucket=settings.S3_BUCKET_FILE,
-                Key=str(key),
-                PartNumber=partnum,
-                UploadId=upload_id)
-            multipart_upload['Parts'].append({
-                'ETag': part['ETag'],
-                'PartNumber': partnum,
-            })
-
-        s3client.complete_multipart_upload(
-            Bucket=settings.S3_BUCKET_FILE,
-            Key=str(key),
-            MultipartUpload=multipart_upload,
-            UploadId=upload_id)
+        storage = get_storage()
+        try:
+            encoding, size, nparts, stored = cls.upload_to_storage(storage, key, blob)
+        except storage.errors:
+            metrics.S3_ERRORS.inc(operation='upload')
+            raise
+        metrics.UPLOAD_BYTES.inc(size)
+        metrics.UPLOAD_STORED_BYTES.inc(stored)
+        metrics.UPLOAD_PARTS.observe(nparts)
 
         with transaction.atomic(durable=True):
             uploader = cls.objects.get(key=key, status=cls.UPLOADING)
             uploader.status = cls.COMPLETED
             uploader.size = size
+            uploader.encoding = encoding
             uploader.save_cleanly()
 
         return key
 
+    @classmethod
+    def upload_to_storage(cls, storage, key, blob):
+        '''
+        ブロブをstorageに書き、圧縮方式、元の大きさ、パートの数、保存
+        した大きさを返す。
+        '''
+
+        upload = storage.multipart(str(key))
+        size = 0
+        stored = 0
+        nparts = 0
+
+        def write_part(body):
+            nonlocal stored, nparts
+            start = time.perf_counter()
+            upload.write(body)
+            metrics.UPLOAD_PART_SECONDS.observe(time.perf_counter() - start)
+            stored += len(body)
+            nparts += 1
+
+        try:
+            # 先頭のチャンクを見て、圧縮して保存するかを決める
+            chunk = blob.read(settings.S3_CHUNK_SIZE)
+            encoding = compression.choose_encoding(chunk)
+            writer = compression.PartWriter(encoding, settings.S3_CHUNK_SIZE)
+            while chunk:
+                for part in writer.write(chunk):
+                    write_part(part)
+                size += len(chunk)
+                chunk = blob.read(settings.S3_CHUNK_SIZE)
+            for part in writer.close():
+                write_part(part)
+
+            upload.complete()
+        except BaseException:
+            upload.abort()
+            raise
+
+        return encoding, size, nparts, stored
+
 
 def upload_blob(blob, username):
     return S3Uploader.upload(blob, username)
@@ -0,0 +1,59 @@
+'''
+大きなブロブの先読み。1回のGETで順に読むと、速さが1本の接続で決まる
+ので、範囲に分けて複数の接続で並行して読む。
+'''
+
+import collections
+import concurrent.futures
+import contextvars
+
+
+def prefetch(storage, name, size, block_size, depth):
+    '''
+    nameの先頭からsize bytesを、block_sizeずつの範囲で順に返すジェネ
+    レーターを返す。返したブロックを送っている間も、depth個先までの範
+    囲を並行して読んでおく。メモリはおよそblock_size * (depth + 1)使う。
+
+    最初のブロックは呼び出したときに読み終えるので、ないブロブや読め
+    ないブロブは、応答を始める前にここで例外になる。途中で閉じると、
+    まだ始まっていない読み出しは取り消す。
+    '''
+
+    def fetch(start):
+        with storage.open(name, start, min(start + block_size, size)) as blob:
+            return blob.read()
+
+    starts = iter(range(0, size, block_size))
+    pool = concurrent.futures.ThreadPoolExecutor(
+        max_workers=depth, thread_name_prefix='sbts-prefetch')
+    pending = collections.deque()
+
+    def submit():
+        start = next(starts, None)
+        if start is not None:
+            # S3の呼び出しをリクエストの計測に含める
+            ctx = contextvars.copy_context()
+            pending.append(pool.submit(ctx.run, fetch, start))
+
+    def blocks(first):
+        try:
+            if first is not None:
+                yield first
+            while pending:
+                block = pending.popleft().result()
+                submit()
+                yield block
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    try:
+        for _ in range(depth):
+            submit()
+        first = None
+        if pending:
+            first = pending.popleft().result()
+            submit()
+    except BaseException:
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    return blocks(first)
@@ -0,0 +1,104 @@
+from django.conf import settings
+
+import io
+
+try:
+    from PIL import Image
+except ImportError:
+    # Pillowがなければ画像のサムネイルは作らない
+    Image = None
+
+from . import compression
+from .models import UploadedFile
+from .storage import get_storage
+
+
+IMAGE_SIGNATURES = [
+    b'\x89PNG\r\n\x1a\n',
+    b'\xff\xd8\xff',
+    b'GIF87a',
+    b'GIF89a',
+]
+
+
+def preview_key(key):
+    '''
+    プレビューを保存するストレージでの名前
+    '''
+
+    return f'previews/{key}'
+
+
+def is_text(head):
+    if b'\0' in head:
+        return False
+    try:
+        # 末尾で途切れた文字は許容する
+        head.decode('utf-8')
+    except UnicodeDecodeError as e:
+        return e.start >= len(head) - 3 and e.reason == 'unexpected end of data'
+    return True
+
+
+def text_excerpt(head):
+    '''
+    テキストの先頭を、なるべく行の区切りで切り出す。
+    '''
+
+    head = head[:settings.FILE_PREVIEW_TEXT_SIZE]
+    if (pos := head.rfind(b'\n')) > 0:
+        head = head[:pos + 1]
+    return head.decode('utf-8', errors='ignore').encode('utf-8')
+
+
+def thumbnail(blob):
+    with Image.open(blob) as img:
+        img.thumbnail(settings.FILE_PREVIEW_THUMBNAIL_SIZE)
+        out = io.BytesIO()
+        img.convert('RGB').save(out, 'JPEG', quality=85)
+        return out.getvalue()
+
+
+def generate_preview(key):
+    '''
+    画像ならサムネイル、テキストなら先頭の抜粋を作り、ストレージに保
+    存する。
+    どちらでもなければ何もしない。
+    '''
+
+    file = UploadedFile.objects.get(key=key)
+    storage = get_storage()
+
+    if file.size == 0:
+        return
+
+    if file.encoding:
+        # 圧縮したブロブは、先頭から展開して読む
+        body = storage.open(str(key))
+        try:
+            head = compression.open_blob(body, file.encoding).read(
+                settings.FILE_PREVIEW_TEXT_SIZE)
+        finally:
+            body.close()
+    else:
+        with storage.open(str(key), 0, settings.FILE_PREVIEW_TEXT_SIZE) as body:
+            head = body.read()
+
+    if any(head.startswith(sig) for sig in IMAGE_SIGNATURES):
+        if Image is None or file.size > settings.FILE_PREVIEW_IMAGE_MAX_SIZE:
+            return
+        body = storage.open(str(key))
+        try:
+            content = thumbnail(io.BytesIO(
+                compression.open_blob(body, file.encoding).read()))
+        finally:
+            body.close()
+        content_type = 'image/jpeg'
+    elif is_text(head):
+        content = text_excerpt(head)
+        content_type = 'text/plain; charset=utf-8'
+    else:
+        return
+
+    storage.put(preview_key(key), content, content_type)
+    UploadedFile.objects.filter(key=key).update(preview=content_type)
@@ -0,0 +1,487 @@
+'''
+ブロブの保存先。settings.FILE_STORAGEのクラスをget_storageで作って使
+う。
+
+S3Storageは、S3(開発環境ではMinIO)に保存する。LocalStorageは、1台で
+動かす小さな環境向けに、FILE_STORAGE_DIRのファイルに保存する。どちら
+もnameは、ブロブのキーの文字列か、preview_keyの値。
+'''
+
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import ImproperlyConfigured
+from django.urls import reverse
+from django.utils.module_loading import import_string
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+
+import os
+import shutil
+import time
+import uuid
+
+
+class NotFound(Exception):
+    pass
+
+
+class Archived(NotFound):
+    '''
+    ブロブはアーカイブしてあり、restoreで戻すまで読めない。
+    '''
+
+
+class Blob:
+    '''
+    openで開いたブロブ。fileから読めるのはsize bytes。
+    '''
+
+    def __init__(self, file, size, content_type=None):
+        self.file = file
+        self.size = size
+        self.content_type = content_type
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Storage:
+    # 保存先へのアクセスの失敗として数える例外
+    errors = ()
+
+    def create(self):
+        '''
+        保存先(バケットやディレクトリ)がなければ作る。
+        '''
+
+        raise NotImplementedError
+
+    def multipart(self, name):
+        '''
+        パートに分けて書く。write(part)で順に書き、complete()で確定す
+        る。失敗したらabort()で書きかけを消す。
+        '''
+
+        raise NotImplementedError
+
+    def put(self, name, content, content_type=None):
+        raise NotImplementedError
+
+    def open(self, name, start=0, end=None):
+        '''
+        nameの[start, end)を読むBlobを返す。endがNoneなら末尾まで。な
+        ければNotFoundを、アーカイブしてあればArchivedを送出する。
+        '''
+
+        raise NotImplementedError
+
+    def check(self, name):
+        '''
+        nameを読めるか、読まずに確かめる。なければNotFoundを、アーカイ
+        ブしてあればArchivedを送出する。
+        '''
+
+        raise NotImplementedError
+
+    def delete(self, name):
+        raise NotImplementedError
+
+    def archive(self, name):
+        '''
+        nameを安い保存先に移す。移したあとは、restoreするまで読めない。
+        '''
+
+        raise NotImplementedError
+
+    def restore(self, name):
+        '''
+        アーカイブしたnameを戻す。戻し終えて読めるようになればTrue、
+        戻している途中ならFalseを返すので、あとでまた呼ぶ。
+        '''
+
+        raise NotImplementedError
+
+    def presign(self, name, expires=3600):
+        '''
+        認証なしでexpires秒の間nameを読めるURLを返す。
+        '''
+
+        raise NotImplementedError
+
+    def local_path(self, name):
+        '''
+        nameをファイルとして保存していれば、そのパスを返す。
+        '''
+
+        return None
+
+    def destroy(self):
+        '''
+        保存先を中身ごと消す。テスト用。
+        '''
+
+        raise NotImplementedError
+
+
+def get_storage():
+    return import_string(settings.FILE_STORAGE)()
+
+
+def range_header(start, end):
+    if end is None:
+        return f'bytes={start}-'
+    return f'bytes={start}-{end - 1}'
+
+
+class S3Storage(Storage):
+    '''
+    S3_BUCKET_FILEのバケットに保存する。
+
+    アーカイブしたブロブは、S3_BUCKET_FILE_COLDのバケットに移し、
+    FILE_COLD_STORAGE_CLASSがあればそのストレージクラスにする。
+    S3_BUCKET_FILE_COLDがNoneなら、同じバケットのままストレージクラス
+    だけ変える。MinIOはGLACIERなどのストレージクラスを受け付けないので、
+    別のバケットに移すだけにする。
+    '''
+
+    errors = (BotoCoreError, ClientError)
+
+    def __init__(self):
+        self.bucket = settings.S3_BUCKET_FILE
+        self.cold_bucket = settings.S3_BUCKET_FILE_COLD or self.bucket
+        self.client = boto3.client(
+            's3', endpoint_url=settings.S3_ENDPOINT,
+            config=Config(max_pool_connections=settings.S3_MAX_POOL_CONNECTIONS))
+
+    def create(self):
+        for bucket in {self.bucket, self.cold_bucket}:
+            try:
+                self.client.head_bucket(Bucket=bucket)
+            except ClientError:
+                self.client.create_bucket(Bucket=bucket)
+
+    def multipart(self, name):
+        return S3Multipart(self, name)
+
+    def put(self, name, content, content_type=None):
+        kwargs = {'ContentType': content_type} if content_type else {}
+        self.client.put_object(Body=content, Bucket=self.bucket, Key=name, **kwargs)
+
+    def open(self, name, start=0, end=None):
+        kwargs = {}
+        if start or end is not None:
+            kwargs['Range'] = range_header(start, end)
+        try:
+            s3obj = self.client.get_object(Bucket=self.bucket, Key=name, **kwargs)
+        except self.client.exceptions.NoSuchKey:
+            if self.cold_bucket != self.bucket and self.head(self.cold_bucket, name):
+                raise Archived(name)
+            raise NotFound(name)
+        except self.client.exceptions.InvalidObjectState:
+            raise Archived(name)
+        return Blob(s3obj['Body'], s3obj['ContentLength'], s3obj.get('ContentType'))
+
+    def check(self, name):
+        head = self.head(self.bucket, name)
+        if head is None:
+            if self.cold_bucket != self.bucket and self.head(self.cold_bucket, name):
+                raise Archived(name)
+            raise NotFound(name)
+        if (head.get('StorageClass') in ('GLACIER', 'DEEP_ARCHIVE')
+                and 'ongoing-request="false"' not in head.get('Restore', '')):
+            raise Archived(name)
+
+    def head(self, bucket, name):
+        '''
+        オブジェクトのHeadObjectの結果を、なければNoneを返す。
+        '''
+
+        try:
+            return self.client.head_object(Bucket=bucket, Key=name)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                raise
+            return None
+
+    def delete(self, name):
+        for bucket in {self.bucket, self.cold_bucket}:
+            self.client.delete_object(Bucket=bucket, Key=name)
+
+    def archive(self, name):
+        storage_class = settings.FILE_COLD_STORAGE_CLASS
+        if self.cold_bucket == self.bucket and not storage_class:
+            raise ImproperlyConfigured(
+                'S3_BUCKET_FILE_COLD or FILE_COLD_STORAGE_CLASS is required to archive blobs')
+        self.copy(name, self.bucket, self.cold_bucket, storage_class)
+        if self.cold_bucket != self.bucket:
+            self.client.delete_object(Bucket=self.bucket, Key=name)
+
+    def restore(self, name):
+        '''
+        アーカイブのストレージクラスのオブジェクトは、RestoreObjectで
+        一時的に読めるようにしてから、STANDARDで元のバケットにコピーし
+        直して戻す。一時的に読めるようになるまで、数分から数時間かかる。
+        '''
+
+        head = self.head(self.cold_bucket, name)
+        if self.cold_bucket == self.bucket:
+            if head is None:
+                raise NotFound(name)
+            if head.get('StorageClass', 'STANDARD') == 'STANDARD':
+                return True
+        elif head is None:
+            # 戻し終えている
+            if self.head(self.bucket, name) is None:
+                raise NotFound(name)
+            return True
+        if 'ongoing-request="true"' in head.get('Restore', ''):
+            return False
+        try:
+            self.copy(name, self.cold_bucket, self.bucket, 'STANDARD')
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('InvalidObjectState',
+                                                   'ObjectNotInActiveTierError'):
+                raise
+            self.client.restore_object(
+                Bucket=self.cold_bucket, Key=name,
+                RestoreRequest={
+                    'Days': settings.FILE_RESTORE_DAYS,
+                    'GlacierJobParameters': {'Tier': settings.FILE_RESTORE_TIER},
+                })
+            return False
+        if self.cold_bucket != self.bucket:
+            self.client.delete_object(Bucket=self.cold_bucket, Key=name)
+        return True
+
+    def copy(self, name, src_bucket, dst_bucket, storage_class=None):
+        # 5GiBを超えるオブジェクトは、マネージドコピーがパートに分けて
+        # コピーする
+        extra_args = {'StorageClass': storage_class} if storage_class else {}
+        self.client.copy({'Bucket': src_bucket, 'Key': name}, dst_bucket, name,
+                         ExtraArgs=extra_args)
+
+    def presign(self, name, expires=3600):
+        return self.client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': self.bucket, 'Key': name},
+            ExpiresIn=expires)
+
+    def destroy(self):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for bucket in {self.bucket, self.cold_bucket}:
+            for page in paginator.paginate(Bucket=bucket):
+                objects = [{'Key': o['Key']} for o in page.get('Contents', [])]
+                if objects:
+                    self.client.delete_objects(
+                        Bucket=bucket, Delete={'Objects': objects})
+            self.client.delete_bucket(Bucket=bucket)
+
+
+class S3Multipart:
+    def __init__(self, storage, name):
+        self.storage = storage
+        self.name = name
+        self.upload_id = storage.client.create_multipart_upload(
+            Bucket=storage.bucket, Key=name)['UploadId']
+        self.parts = []
+
+    def write(self, part):
+        partnum = len(self.parts) + 1  # 1 ~ 10,000
+        resp = self.storage.client.upload_part(
+            Body=part,
+            Bucket=self.storage.bucket,
+            Key=self.name,
+            PartNumber=partnum,
+            UploadId=self.upload_id)
+        self.parts.append({
+            'ETag': resp['ETag'],
+            'PartNumber': partnum,
+        })
+
+    def complete(self):
+        # 空ファイルの場合
+        if not self.parts:
+            self.write(b'')
+
+        self.storage.client.complete_multipart_upload(
+            Bucket=self.storage.bucket,
+            Key=self.name,
+            MultipartUpload={'Parts': self.parts},
+            UploadId=self.upload_id)
+
+    def abort(self):
+        self.storage.client.abort_multipart_upload(
+            Bucket=self.storage.bucket, Key=self.name, UploadId=self.upload_id)
+
+
+class LocalStorage(Storage):
+    '''
+    FILE_STORAGE_DIRのファイルに保存する。書きかけのファイルは.uploads
+    に置き、fsyncしてから名前を変えるので、途中で落ちても中途半端なブ
+    ロブは見えない。読み出すBlobのfileは本物のファイルなので、
+    FileResponseからwsgi.file_wrapper(os.sendfile)で送れる。
+
+    アーカイブしたブロブは、FILE_COLD_STORAGE_DIR(Noneなら.cold)に移す。
+    '''
+
+    errors = (OSError,)
+
+    def __init__(self):
+        self.root = settings.FILE_STORAGE_DIR
+        self.cold_root = settings.FILE_COLD_STORAGE_DIR or os.path.join(self.root, '.cold')
+
+    def path(self, name, root=None):
+        root = root or self.root
+        path = os.path.normpath(os.path.join(root, name))
+        if os.path.commonpath([root, path]) != os.path.normpath(root):
+            raise ValueError(name)
+        return path
+
+    def local_path(self, name):
+        return self.path(name)
+
+    def create(self):
+        os.makedirs(os.path.join(self.root, '.uploads'), exist_ok=True)
+
+    def multipart(self, name):
+        self.create()
+        return LocalMultipart(self, name)
+
+    def put(self, name, content, content_type=None):
+        # 読み出すときのContent-Typeは呼び出し側が知っているので、保存
+        # しない
+        upload = self.multipart(name)
+        try:
+            upload.write(content)
+            upload.complete()
+        except BaseException:
+            upload.abort()
+            raise
+
+    def open(self, name, start=0, end=None):
+        try:
+            f = open(self.path(name), 'rb')
+        except FileNotFoundError:
+            if os.path.exists(self.path(name, self.cold_root)):
+                raise Archived(name)
+            raise NotFound(name)
+
+        size = os.fstat(f.fileno()).st_size
+        end = size if end is None else min(end, size)
+        if start == 0 and end == size:
+            return Blob(f, size)
+        f.seek(start)
+        return Blob(LimitedReader(f, max(end - start, 0)), max(end - start, 0))
+
+    def check(self, name):
+        if not os.path.exists(self.path(name)):
+            if os.path.exists(self.path(name, self.cold_root)):
+                raise Archived(name)
+            raise NotFound(name)
+
+    def delete(self, name):
+        for path in [self.path(name), self.path(name, self.cold_root)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def archive(self, name):
+        self.move(self.path(name), self.path(name, self.cold_root))
+
+    def restore(self, name):
+        if not os.path.exists(self.path(name)):
+            self.move(self.path(name, self.cold_root), self.path(name))
+        return True
+
+    def move(self, src, dst):
+        # 別のファイルシステムならコピーして消す
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        shutil.move(src, dst)
+
+    def presign(self, name, expires=3600):
+        token = signing.dumps({'name': name, 'exp': time.time() + expires},
+                              salt=SIGNING_SALT)
+        return reverse('page:file:signed_blob', kwargs={'token': token})
+
+    def destroy(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+        shutil.rmtree(self.cold_root, ignore_errors=True)
+
+
+SIGNING_SALT = 'sbts.file.storage.LocalStorage'
+
+
+def unsign(token):
+    '''
+    LocalStorage.presignのtokenからnameを取り出す。改ざんや期限切れは
+    signing.BadSignatureを送出する。
+    '''
+
+    data = signing.loads(token, salt=SIGNING_SALT)
+    if data['exp'] < time.time():
+        raise signing.SignatureExpired(token)
+    return data['name']
+
+
+class LocalMultipart:
+    def __init__(self, storage, name):
+        self.storage = storage
+        self.path = storage.path(name)
+        self.tmp = os.path.join(storage.root, '.uploads', uuid.uuid4().hex)
+        self.f = open(self.tmp, 'wb')
+
+    def write(self, part):
+        self.f.write(part)
+
+    def complete(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        os.replace(self.tmp, self.path)
+        # 名前の変更も永続化する
+        fd = os.open(os.path.dirname(self.path), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def abort(self):
+        self.f.close()
+        try:
+            os.remove(self.tmp)
+        except FileNotFoundError:
+            pass
+
+
+class LimitedReader:
+    '''
+    fileの現在位置からsize bytesだけ読む。
+    '''
+
+    def __init__(self, file, size):
+        self.file = file
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
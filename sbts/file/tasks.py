@@ -0,0 +1,24 @@
+from django.conf import settings
+
+from sbts.task.models import Job
+from sbts.task.tasks import task
+
+from . import previews
+from . import tiering
+
+
+@task
+def generate_preview(key):
+    previews.generate_preview(key)
+
+
+@task
+def restore_blob(key):
+    '''
+    コールドストレージのブロブを戻す。戻している途中なら、
+    FILE_RESTORE_POLL_INTERVAL秒後にまた確かめる。
+    '''
+
+    if not tiering.restore(key):
+        Job.objects.enqueue(restore_blob.task_name, {'key': key},
+                            delay=settings.FILE_RESTORE_POLL_INTERVAL)
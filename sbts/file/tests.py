@@ -1,26 +1,254 @@
 import datetime
+import gzip
 import io
 import json
+import os
 import random
 import string
+import time
+import tempfile
+import urllib.request
 import uuid
+import zipfile
 from email.message import EmailMessage
+from unittest import skipIf, skipUnless
 
 from django.db import transaction
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser, User
-from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist, ValidationError
+from django.core.management import call_command
+from django.http import Http404
 from django.test import TestCase, RequestFactory, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.module_loading import import_string
 
 from rest_framework.test import APIRequestFactory
 
-import boto3
 from botocore.exceptions import EndpointConnectionError
 
+from sbts.core.metrics import registry
 from sbts.core.test_utils import ObjectStorageTestCase
+from sbts.task.models import Job
+from sbts.task.tasks import run_one
 
+from . import compression
+from . import tiering
+from .cache import blob_cache
+from .metacache import metadata_cache
 from .models import upload_blob, S3Uploader, UploadedFile
-from .views import BlobView, UploadView
+from .prefetch import prefetch
+from .previews import Image, generate_preview
+from .storage import Archived, LocalStorage, NotFound, S3Storage, get_storage
+from .tasks import restore_blob
+from .views import ArchiveView, BlobView, PreviewView, SignedBlobView, UploadView
+
+
+class StorageTest(ObjectStorageTestCase):
+    '''
+    settings.FILE_STORAGEの保存先で確認する。
+    '''
+
+    def setUp(self):
+        super().setUp()
+        self.storage = get_storage()
+
+    def test_multipart(self):
+        # S3では、最後以外のパートは5MiB以上にする
+        part1 = random.Random(0).randbytes(settings.S3_CHUNK_SIZE)
+        upload = self.storage.multipart('a')
+        upload.write(part1)
+        upload.write(b'hello.')
+        upload.complete()
+
+        with self.storage.open('a') as blob:
+            self.assertEqual(blob.size, len(part1) + 6)
+            self.assertEqual(blob.read(), part1 + b'hello.')
+
+    def test_multipart_abort(self):
+        upload = self.storage.multipart('a')
+        upload.write(b'hello.')
+        upload.abort()
+
+        with self.assertRaises(NotFound):
+            self.storage.open('a')
+
+    def test_range(self):
+        self.storage.put('a', b'0123456789')
+
+        with self.storage.open('a', 2, 5) as blob:
+            self.assertEqual(blob.size, 3)
+            self.assertEqual(blob.read(), b'234')
+        with self.storage.open('a', 7) as blob:
+            self.assertEqual(blob.size, 3)
+            self.assertEqual(blob.read(), b'789')
+
+    def test_nested_name(self):
+        self.storage.put('previews/a', b'hello.', 'text/plain')
+
+        with self.storage.open('previews/a') as blob:
+            self.assertEqual(blob.read(), b'hello.')
+
+    def test_delete(self):
+        self.storage.put('a', b'hello.')
+        self.storage.delete('a')
+
+        with self.assertRaises(NotFound):
+            self.storage.open('a')
+
+    def test_not_found(self):
+        with self.assertRaises(NotFound):
+            self.storage.open('a')
+
+    def test_archive(self):
+        self.storage.put('a', b'hello.')
+        self.storage.archive('a')
+        with self.assertRaises(Archived):
+            self.storage.open('a')
+
+        # S3では、一時的に読めるようにしてから戻す
+        for _ in range(2):
+            if self.storage.restore('a'):
+                break
+        else:
+            self.fail('not restored')
+        with self.storage.open('a') as blob:
+            self.assertEqual(blob.read(), b'hello.')
+        self.assertTrue(self.storage.restore('a'))
+
+    def test_check(self):
+        self.storage.put('a', b'hello.')
+        self.storage.check('a')
+        with self.assertRaises(NotFound):
+            self.storage.check('b')
+        self.storage.archive('a')
+        with self.assertRaises(Archived):
+            self.storage.check('a')
+
+    def test_delete_archived(self):
+        self.storage.put('a', b'hello.')
+        self.storage.archive('a')
+        self.storage.delete('a')
+        with self.assertRaises(NotFound):
+            self.storage.open('a')
+
+    @skipUnless(import_string(settings.FILE_STORAGE) is S3Storage, 'not using S3Storage')
+    @override_settings(S3_BUCKET_FILE_COLD=None, FILE_COLD_STORAGE_CLASS=None)
+    def test_archive_not_configured(self):
+        storage = get_storage()
+        storage.put('a', b'hello.')
+        with self.assertRaises(ImproperlyConfigured):
+            storage.archive('a')
+
+
+# MinIOはGLACIERなどのストレージクラスを受け付けず、アーカイブしたオブ
+# ジェクトのGETも失敗しないので、ストレージクラスを変えるテストは、対
+# 応したS3(AWSやmoto)で、SBTS_TEST_S3_STORAGE_CLASSESを設定したときだけ
+# 実行する
+@skipUnless(import_string(settings.FILE_STORAGE) is S3Storage
+            and os.environ.get('SBTS_TEST_S3_STORAGE_CLASSES'),
+            'S3 storage classes are not available')
+class S3StorageClassTest(ObjectStorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.storage = get_storage()
+
+    def archive_and_restore(self):
+        storage = get_storage()
+        storage.put('a', b'hello.')
+        storage.archive('a')
+        with self.assertRaises(Archived):
+            storage.open('a')
+        with self.assertRaises(Archived):
+            storage.check('a')
+        for _ in range(2):
+            if storage.restore('a'):
+                break
+        else:
+            self.fail('not restored')
+        storage.check('a')
+        with storage.open('a') as blob:
+            self.assertEqual(blob.read(), b'hello.')
+        head = storage.head(storage.bucket, 'a')
+        self.assertEqual(head.get('StorageClass', 'STANDARD'), 'STANDARD')
+        return storage
+
+    @override_settings(FILE_COLD_STORAGE_CLASS='GLACIER')
+    def test_cold_bucket(self):
+        storage = self.archive_and_restore()
+        self.assertIsNone(storage.head(storage.cold_bucket, 'a'))
+
+    @override_settings(S3_BUCKET_FILE_COLD=None, FILE_COLD_STORAGE_CLASS='GLACIER')
+    def test_same_bucket(self):
+        self.archive_and_restore()
+
+
+@override_settings(FILE_STORAGE='sbts.file.storage.LocalStorage')
+class LocalStorageTest(ObjectStorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.storage = get_storage()
+        self.req_factory = RequestFactory()
+
+    def test_no_partial_file(self):
+        '''
+        completeするまでは、書きかけのファイルは見えない
+        '''
+
+        upload = self.storage.multipart('a')
+        upload.write(b'hello.')
+        with self.assertRaises(NotFound):
+            self.storage.open('a')
+
+        upload.complete()
+        self.assertEqual(os.listdir(os.path.join(self.storage.root, '.uploads')), [])
+
+    def test_outside_root(self):
+        with self.assertRaises(ValueError):
+            self.storage.open('../a')
+
+    def test_sendfile(self):
+        '''
+        BlobViewは、wsgi.file_wrapperで送れるようにファイルをそのまま
+        渡す
+        '''
+
+        registry.clear()
+        content = random.Random(0).randbytes(4096)
+        key = upload_blob(io.BytesIO(content), 'shimon')
+        lastmod = datetime.datetime.fromisoformat('2023-11-04T12:00:00Z')
+        UploadedFile.objects.create_from_s3(key, 'shimon', 'a.bin', lastmod)
+
+        req = self.req_factory.get('/')
+        req.user = AnonymousUser()
+        resp = BlobView.as_view()(req, key=key)
+
+        self.assertIsInstance(resp.file_to_stream, io.BufferedReader)
+        self.assertEqual(resp.file_to_stream.name, self.storage.path(str(key)))
+        self.assertEqual(int(resp['Content-Length']), len(content))
+        self.assertEqual(b''.join(resp.streaming_content), content)
+        self.assertEqual(registry.collect()[('sbts_download_bytes_total', ())], len(content))
+
+    def test_presign(self):
+        self.storage.put('a', b'hello.')
+        url = self.storage.presign('a')
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(b''.join(resp.streaming_content), b'hello.')
+
+        req = self.req_factory.get('/')
+        req.user = AnonymousUser()
+        with self.assertRaises(Http404):
+            SignedBlobView.as_view()(req, token='invalid')
+
+    def test_presign_expired(self):
+        self.storage.put('a', b'hello.')
+        url = self.storage.presign('a', expires=-1)
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 404)
 
 
 class UploadFileTest(ObjectStorageTestCase):
@@ -35,10 +263,9 @@ class UploadFileTest(ObjectStorageTestCase):
         blob = io.BytesIO(content)
         key = upload_blob(blob, self.user_shimon.username)
 
-        s3client = boto3.client('s3', endpoint_url=settings.S3_ENDPOINT)
-        s3obj = s3client.get_object(Bucket=settings.S3_BUCKET_FILE, Key=str(key))
+        blob = get_storage().open(str(key))
 
-        self.assertEqual(s3obj['Body'].read(), content)
+        self.assertEqual(blob.read(), content)
         o1 = S3Uploader.objects.get(key=key)
         self.assertQuerySetEqual(S3Uploader.objects.all(), [o1])
         self.assertEqual(o1.status, S3Uploader.COMPLETED)
@@ -54,10 +281,9 @@ class UploadFileTest(ObjectStorageTestCase):
         blob = io.BytesIO(content)
         key = upload_blob(blob, self.user_shimon.username)
 
-        s3client = boto3.client('s3', endpoint_url=settings.S3_ENDPOINT)
-        s3obj = s3client.get_object(Bucket=settings.S3_BUCKET_FILE, Key=str(key))
+        blob = get_storage().open(str(key))
 
-        self.assertEqual(s3obj['Body'].read(), content)
+        self.assertEqual(blob.read(), content)
         o1 = S3Uploader.objects.get(key=key)
         self.assertQuerySetEqual(S3Uploader.objects.all(), [o1])
         self.assertEqual(o1.status, S3Uploader.COMPLETED)
@@ -73,10 +299,9 @@ class UploadFileTest(ObjectStorageTestCase):
         blob = io.BytesIO(content)
         key = upload_blob(blob, self.user_shimon.username)
 
-        s3client = boto3.client('s3', endpoint_url=settings.S3_ENDPOINT)
-        s3obj = s3client.get_object(Bucket=settings.S3_BUCKET_FILE, Key=str(key))
+        blob = get_storage().open(str(key))
 
-        self.assertEqual(s3obj['Body'].read(), content)
+        self.assertEqual(blob.read(), content)
         o1 = S3Uploader.objects.get(key=key)
         self.assertQuerySetEqual(S3Uploader.objects.all(), [o1])
         self.assertEqual(o1.status, S3Uploader.COMPLETED)
@@ -92,16 +317,66 @@ class UploadFileTest(ObjectStorageTestCase):
         blob = io.BytesIO(content)
         key = upload_blob(blob, self.user_shimon.username)
 
-        s3client = boto3.client('s3', endpoint_url=settings.S3_ENDPOINT)
-        s3obj = s3client.get_object(Bucket=settings.S3_BUCKET_FILE, Key=str(key))
+        blob = get_storage().open(str(key))
 
-        self.assertEqual(s3obj['Body'].read(), content)
+        self.assertEqual(blob.read(), content)
         o1 = S3Uploader.objects.get(key=key)
         self.assertQuerySetEqual(S3Uploader.objects.all(), [o1])
         self.assertEqual(o1.status, S3Uploader.COMPLETED)
         self.assertEqual(o1.username, self.user_shimon.username)
         self.assertEqual(o1.size, len(content))
 
+    def test_metrics(self):
+        registry.clear()
+        content = b'hello.'
+        upload_blob(io.BytesIO(content), self.user_shimon.username)
+
+        samples = registry.collect()
+        self.assertEqual(samples[('sbts_upload_bytes_total', ())], len(content))
+        self.assertEqual(samples[('sbts_upload_parts_count', ())], 1)
+        self.assertEqual(samples[('sbts_upload_part_seconds_count', ())], 1)
+
+    def test_compress(self):
+        '''
+        よく縮むデータはgzipで圧縮して保存し、sizeは元の大きさにする
+        '''
+
+        content = b''.join(b'%d: GET /tickets/ 200\n' % i for i in range(10000))
+        key = upload_blob(io.BytesIO(content), self.user_shimon.username)
+
+        blob = get_storage().open(str(key))
+
+        stored = blob.read()
+        self.assertLess(len(stored), len(content) // 4)
+        self.assertEqual(gzip.decompress(stored), content)
+        o1 = S3Uploader.objects.get(key=key)
+        self.assertEqual(o1.encoding, compression.GZIP)
+        self.assertEqual(o1.size, len(content))
+
+    def test_compress_incompressible(self):
+        '''
+        縮まないデータはそのまま保存する
+        '''
+
+        content = random.Random(2).randbytes(4096)
+        key = upload_blob(io.BytesIO(content), self.user_shimon.username)
+
+        blob = get_storage().open(str(key))
+
+        self.assertEqual(blob.read(), content)
+        self.assertEqual(S3Uploader.objects.get(key=key).encoding, compression.IDENTITY)
+
+    @override_settings(FILE_COMPRESSION=False)
+    def test_compress_disabled(self):
+        content = b'a' * 4096
+        key = upload_blob(io.BytesIO(content), self.user_shimon.username)
+
+        blob = get_storage().open(str(key))
+
+        self.assertEqual(blob.read(), content)
+        self.assertEqual(S3Uploader.objects.get(key=key).encoding, compression.IDENTITY)
+
+    @skipUnless(import_string(settings.FILE_STORAGE) is S3Storage, 'not using S3Storage')
     @override_settings(S3_ENDPOINT=settings.S3_INVALID_ENDPOINT)
     def test_no_s3(self):
         '''
@@ -258,6 +533,80 @@ class BlobViewTest(ObjectStorageTestCase):
         self.assertEqual(b''.join(resp.streaming_content), content)
         self.assertEqual(resp.status_code, 200)
 
+    def test_metrics(self):
+        registry.clear()
+        content = b'hello.'
+        key = upload_blob(io.BytesIO(content), self.user_shimon.username)
+        lastmod = datetime.datetime.fromisoformat('2023-11-04T12:00:00Z')
+        UploadedFile.objects.create_from_s3(
+            key, self.user_shimon.username, 'hello.txt', lastmod)
+
+        req = self.req_factory.get('/')
+        req.user = AnonymousUser()
+        resp = BlobView.as_view()(req, key=key)
+        b''.join(resp.streaming_content)
+        with self.assertRaises(Http404):
+            BlobView.as_view()(req, key=uuid.uuid4())
+
+        samples = registry.collect()
+        self.assertEqual(samples[('sbts_download_bytes_total', ())], len(content))
+        self.assertEqual(samples[('sbts_download_ttfb_seconds_count', ())], 1)
+        self.assertEqual(samples[('sbts_download_requests_total', (('status', '200'),))], 1)
+        self.assertEqual(samples[('sbts_download_requests_total', (('status', '404'),))], 1)
+
+    def create_compressed(self, content, fname):
+        key = upload_blob(io.BytesIO(content), self.user_shimon.username)
+        lastmod = datetime.datetime.fromisoformat('2023-11-04T12:00:00Z')
+        f = UploadedFile.objects.create_from_s3(
+            key, self.user_shimon.username, fname, lastmod)
+        self.assertEqual(f.encoding, compression.GZIP)
+        return f
+
+    def test_gzip_accepted(self):
+        '''
+        gzipを受け取れるクライアントには、圧縮したまま返す
+        '''
+
+        content = b'hello.\n' * 1000
+        f1 = self.create_compressed(content, 'hello.log')
+
+        req = self.req_factory.get('/', HTTP_ACCEPT_ENCODING='gzip, deflate, br')
+        req.user = AnonymousUser()
+        resp = BlobView.as_view()(req, key=f1.key)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp['Content-Encoding'], 'gzip')
+        self.assertEqual(resp['Vary'], 'Accept-Encoding')
+        self.assertEqual(resp['Content-Type'], 'application/octet-stream')
+        body = b''.join(resp.streaming_content)
+        self.assertEqual(int(resp['Content-Length']), len(body))
+        self.assertLess(len(body), len(content))
+        self.assertEqual(gzip.decompress(body), content)
+
+    @override_settings(FILE_DOWNLOAD_BLOCK_SIZE=1000)
+    def test_gzip_not_accepted(self):
+        '''
+        gzipを受け取れないクライアントには、展開しながら返す
+        '''
+
+        content = b'hello.\n' * 1000
+        f1 = self.create_compressed(content, 'hello.log')
+
+        req = self.req_factory.get('/')
+        req.user = AnonymousUser()
+        resp = BlobView.as_view()(req, key=f1.key)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertFalse(resp.has_header('Content-Encoding'))
+        self.assertEqual(resp['Vary'], 'Accept-Encoding')
+        self.assertEqual(resp['Content-Type'], 'application/octet-stream')
+        msg = EmailMessage()
+        msg['Content-Disposition'] = resp['Content-Disposition']
+        self.assertEqual(msg.get_content_disposition(), 'attachment')
+        self.assertEqual(msg.get_filename(), 'hello.log')
+        self.assertEqual(int(resp['Content-Length']), len(content))
+        self.assertEqual(b''.join(resp.streaming_content), content)
+
     def test_invalid(self):
         content = b'hello.'
         key = upload_blob(io.BytesIO(content), self.user_shimon.username)
@@ -349,6 +698,873 @@ class BlobViewTest(ObjectStorageTestCase):
         self.assertEqual(resp.status_code, 405)
 
 
+class PrefetchTest(ObjectStorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.storage = get_storage()
+        self.req_factory = RequestFactory()
+
+    def test_blocks(self):
+        content = random.Random(0).randbytes(10500)
+        self.storage.put('a', content)
+
+        blocks = list(prefetch(self.storage, 'a', len(content), 1000, 3))
+        self.assertEqual([len(b) for b in blocks], [1000] * 10 + [500])
+        self.assertEqual(b''.join(blocks), content)
+
+    def test_empty(self):
+        self.storage.put('a', b'')
+        self.assertEqual(list(prefetch(self.storage, 'a', 0, 1000, 3)), [])
+
+    def test_close(self):
+        '''
+        途中で閉じても、残りの読み出しを待たない
+        '''
+
+        content = random.Random(0).randbytes(10000)
+        self.storage.put('a', content)
+
+        blocks = prefetch(self.storage, 'a', len(content), 100, 2)
+        self.assertEqual(next(blocks), content[:100])
+        blocks.close()
+
+    def test_not_found(self):
+        '''
+        ないブロブは、読み始める前に分かる
+        '''
+
+        with self.assertRaises(NotFound):
+            prefetch(self.storage, 'a', 1000, 100, 2)
+
+    @skipUnless(import_string(settings.FILE_STORAGE) is S3Storage, 'not using S3Storage')
+    @override_settings(FILE_DOWNLOAD_PREFETCH_MIN_SIZE=4096,
+                       FILE_DOWNLOAD_PREFETCH_BLOCK_SIZE=1000,
+                       FILE_DOWNLOAD_PREFETCH_DEPTH=3)
+    def test_blob_view(self):
+        content = random.Random(0).randbytes(10500)
+        key = upload_blob(io.BytesIO(content), 'shimon')
+        lastmod = datetime.datetime.fromisoformat('2023-11-04T12:00:00Z')
+        UploadedFile.objects.create_from_s3(key, 'shimon', 'a.bin', lastmod)
+
+        req = self.req_factory.get('/')
+        req.user = AnonymousUser()
+        resp = BlobView.as_view()(req, key=key)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(int(resp['Content-Length']), len(content))
+        msg = EmailMessage()
+        msg['Content-Disposition'] = resp['Content-Disposition']
+        self.assertEqual(msg.get_filename(), 'a.bin')
+        chunks = list(resp.streaming_content)
+        self.assertEqual(len(chunks), 11)
+        self.assertEqual(b''.join(chunks), content)
+
+    @skipUnless(import_string(settings.FILE_STORAGE) is S3Storage, 'not using S3Storage')
+    @override_settings(FILE_DOWNLOAD_PREFETCH_MIN_SIZE=0,
+                       FILE_DOWNLOAD_PREFETCH_BLOCK_SIZE=2,
+                       FILE_DOWNLOAD_PREFETCH_DEPTH=3)
+    def test_blob_view_not_found(self):
+        '''
+        ブロブがなければ、200を返す前に404にする
+        '''
+
+        key = upload_blob(io.BytesIO(b'hello.'), 'shimon')
+        lastmod = datetime.datetime.fromisoformat('2023-11-04T12:00:00Z')
+        UploadedFile.objects.create_from_s3(key, 'shimon', 'a.bin', lastmod)
+        self.storage.delete(str(key))
+
+        req = self.req_factory.get('/')
+        req.user = AnonymousUser()
+        with self.assertRaises(Http404):
+            BlobView.as_view()(req, key=key)
+
+
+S3_ONLY = skipUnless(import_string(settings.FILE_STORAGE) is S3Storage, 'not using S3Storage')
+
+
+class BlobCacheTest(ObjectStorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache_settings = override_settings(FILE_CACHE_DIR=self.tmpdir.name)
+        self.cache_settings.enable()
+        self.storage = get_storage()
+        self.req_factory = RequestFactory()
+        registry.clear()
+
+    def tearDown(self):
+        self.cache_settings.disable()
+        self.tmpdir.cleanup()
+        super().tearDown()
+
+    def create(self, content, fname='a.bin'):
+        key = upload_blob(io.BytesIO(content), 'shimon')
+        lastmod = datetime.datetime.fromisoformat('2023-11-04T12:00:00Z')
+        return UploadedFile.objects.create_from_s3(key, 'shimon', fname, lastmod)
+
+    def get(self, key, **headers):
+        req = self.req_factory.get('/', headers=headers)
+        req.user = AnonymousUser()
+        resp = BlobView.as_view()(req, key=key)
+        if resp.streaming:
+            return resp, b''.join(resp.streaming_content)
+        return resp, resp.content
+
+    @S3_ONLY
+    def test_hit(self):
+        content = random.Random(0).randbytes(5000)
+        f = self.create(content)
+
+        resp, body = self.get(f.key)
+        self.assertEqual(body, content)
+        self.assertNotIn('Accept-Ranges', resp)
+        # 返し終えたときには入っている
+        with open(os.path.join(self.tmpdir.name, str(f.key)), 'rb') as cached:
+            self.assertEqual(cached.read(), content)
+
+        resp, body = self.get(f.key)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp['Accept-Ranges'], 'bytes')
+        self.assertEqual(int(resp['Content-Length']), len(content))
+        msg = EmailMessage()
+        msg['Content-Disposition'] = resp['Content-Disposition']
+        self.assertEqual(msg.get_filename(), 'a.bin')
+        self.assertEqual(body, content)
+
+        samples = registry.collect()
+        self.assertEqual(samples[('sbts_blob_cache_requests_total', (('result', 'miss'),))], 1)
+        self.assertEqual(samples[('sbts_blob_cache_requests_total', (('result', 'hit'),))], 1)
+        self.assertEqual(samples[('sbts_blob_cache_fills_total', ())], 1)
+        self.assertEqual(samples[('sbts_download_bytes_total', ())], 2 * len(content))
+
+    def test_tee(self):
+        '''
+        返すために読んだものを入れ、保存先から読み直さない
+        '''
+
+        content = random.Random(0).randbytes(5000)
+        self.storage.put('a', content)
+        blob = blob_cache.tee(self.storage.open('a'), 'a')
+        self.storage.delete('a')
+        with blob:
+            self.assertEqual(blob.read(1000), content[:1000])
+            self.assertIsNone(blob_cache.open('a'))
+            # 入れている途中は、同じキーを重ねて入れない
+            self.assertIs(blob_cache.tee(blob, 'a'), blob)
+            self.assertEqual(blob.read(), content[1000:])
+        with blob_cache.open('a') as cached:
+            self.assertEqual(cached.read(), content)
+        self.assertEqual(registry.collect()[('sbts_blob_cache_fills_total', ())], 1)
+
+    def test_tee_close(self):
+        '''
+        途中で閉じたら入れない
+        '''
+
+        self.storage.put('a', bytes(5000))
+        with blob_cache.tee(self.storage.open('a'), 'a') as blob:
+            blob.read(1000)
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+        # 次に読まれたときに入れる
+        blob_cache.fill(self.storage, 'a')
+        self.assertEqual(os.listdir(self.tmpdir.name), ['a'])
+
+    @S3_ONLY
+    def test_range(self):
+        content = random.Random(0).randbytes(5000)
+        f = self.create(content)
+        self.get(f.key)
+
+        resp, body = self.get(f.key, Range='bytes=100-199')
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp['Content-Range'], 'bytes 100-199/5000')
+        self.assertEqual(int(resp['Content-Length']), 100)
+        self.assertEqual(body, content[100:200])
+
+        resp, body = self.get(f.key, Range='bytes=-10')
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp['Content-Range'], 'bytes 4990-4999/5000')
+        self.assertEqual(body, content[-10:])
+
+        resp, body = self.get(f.key, Range='bytes=4000-')
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(body, content[4000:])
+
+        resp, body = self.get(f.key, Range='bytes=5000-')
+        self.assertEqual(resp.status_code, 416)
+        self.assertEqual(resp['Content-Range'], 'bytes */5000')
+
+        # 複数の範囲は受け付けず、全体を返す
+        resp, body = self.get(f.key, Range='bytes=0-1,3-4')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(body, content)
+
+        samples = registry.collect()
+        self.assertEqual(samples[('sbts_download_requests_total', (('status', '206'),))], 3)
+        self.assertEqual(samples[('sbts_download_requests_total', (('status', '416'),))], 1)
+
+    @S3_ONLY
+    def test_compressed(self):
+        '''
+        圧縮したまま入れ、受け取れないクライアントには展開して返す
+        '''
+
+        content = b'hello.\n' * 1000
+        f = self.create(content, 'hello.log')
+        self.assertEqual(f.encoding, compression.GZIP)
+        self.get(f.key)
+
+        resp, body = self.get(f.key, Accept_Encoding='gzip')
+        self.assertEqual(resp['Content-Encoding'], 'gzip')
+        self.assertEqual(resp['Vary'], 'Accept-Encoding')
+        self.assertEqual(gzip.decompress(body), content)
+
+        resp, body = self.get(f.key)
+        self.assertNotIn('Content-Encoding', resp)
+        self.assertEqual(body, content)
+        samples = registry.collect()
+        self.assertEqual(samples[('sbts_blob_cache_requests_total', (('result', 'hit'),))], 2)
+
+    @override_settings(FILE_STORAGE='sbts.file.storage.LocalStorage')
+    def test_local_storage(self):
+        '''
+        ローカルに保存したブロブはキャッシュしない
+        '''
+
+        get_storage().create()
+        content = b'hello.'
+        f = self.create(content, 'hello.txt')
+        resp, body = self.get(f.key)
+        self.assertEqual(body, content)
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+
+    @S3_ONLY
+    @override_settings(FILE_CACHE_MAX_FILE_SIZE=100)
+    def test_max_file_size(self):
+        f = self.create(random.Random(0).randbytes(101))
+        self.get(f.key)
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+
+    @override_settings(FILE_CACHE_MAX_SIZE=2500)
+    def test_evict(self):
+        '''
+        使ったのが古い順に追い出す
+        '''
+
+        keys = []
+        for i in range(3):
+            key = str(uuid.uuid4())
+            self.storage.put(key, bytes(1000))
+            blob_cache.fill(self.storage, key)
+            # 次に入れるものとmtimeを区別する
+            os.utime(blob_cache.path(key), (i, i))
+            keys.append(key)
+            if i == 1:
+                # 最初に入れたものを使う
+                blob_cache.open(keys[0]).close()
+
+        self.assertEqual(sorted(os.listdir(self.tmpdir.name)), sorted([keys[0], keys[2]]))
+        samples = registry.collect()
+        self.assertEqual(samples[('sbts_blob_cache_evictions_total', ())], 1)
+        self.assertEqual(samples[('sbts_blob_cache_evicted_bytes_total', ())], 1000)
+
+    def test_fill_not_found(self):
+        with self.assertLogs('sbts.file.cache', 'ERROR'):
+            blob_cache.fill(self.storage, uuid.uuid4())
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+        self.assertEqual(registry.collect()[('sbts_blob_cache_fill_errors_total', ())], 1)
+
+    def test_discard_on_delete(self):
+        f = self.create(b'hello.')
+        path = blob_cache.path(f.key)
+        blob_cache.fill(self.storage, f.key)
+        self.assertTrue(os.path.exists(path))
+        f.delete()
+        self.assertFalse(os.path.exists(path))
+
+
+class MetadataCacheTest(ObjectStorageTestCase):
+    def setUp(self):
+        super().setUp()
+        metadata_cache.clear()
+        registry.clear()
+        self.req_factory = RequestFactory()
+
+    def tearDown(self):
+        metadata_cache.clear()
+        super().tearDown()
+
+    def create(self, content=b'hello.', fname='hello.txt'):
+        key = upload_blob(io.BytesIO(content), 'shimon')
+        lastmod = datetime.datetime.fromisoformat('2023-11-04T12:00:00Z')
+        return UploadedFile.objects.create_from_s3(key, 'shimon', fname, lastmod)
+
+    def download(self, key):
+        req = self.req_factory.get('/')
+        req.user = AnonymousUser()
+        resp = BlobView.as_view()(req, key=key)
+        return b''.join(resp.streaming_content)
+
+    def test_repeat_download(self):
+        f = self.create()
+        self.assertEqual(self.download(f.key), b'hello.')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.download(f.key), b'hello.')
+
+        meta = metadata_cache.get(f.key)
+        self.assertEqual((meta.name, meta.size, meta.last_modified, meta.encoding),
+                         (f.name, f.size, f.last_modified, f.encoding))
+        samples = registry.collect()
+        self.assertEqual(samples[('sbts_metadata_cache_requests_total', (('result', 'miss'),))], 1)
+        self.assertEqual(samples[('sbts_metadata_cache_requests_total', (('result', 'hit'),))], 2)
+
+    def test_not_found(self):
+        '''
+        ないキーも覚え、作ったら捨てる
+        '''
+
+        key = upload_blob(io.BytesIO(b'hello.'), 'shimon')
+        with self.assertRaises(Http404):
+            self.download(key)
+        with self.assertNumQueries(0), self.assertRaises(Http404):
+            self.download(key)
+
+        lastmod = datetime.datetime.fromisoformat('2023-11-04T12:00:00Z')
+        UploadedFile.objects.create_from_s3(key, 'shimon', 'hello.txt', lastmod)
+        self.assertEqual(self.download(key), b'hello.')
+
+    def test_delete(self):
+        f = self.create()
+        key = f.key
+        metadata_cache.get(key)
+        f.delete()
+        with self.assertRaises(UploadedFile.DoesNotExist):
+            metadata_cache.get(key)
+
+    @override_settings(FILE_METADATA_CACHE_TTL=0)
+    def test_expired(self):
+        f = self.create()
+        metadata_cache.get(f.key)
+        with self.assertNumQueries(1):
+            metadata_cache.get(f.key)
+
+    @override_settings(FILE_METADATA_CACHE_SIZE=2)
+    def test_bounded(self):
+        files = [self.create(fname=f'{i}.txt') for i in range(3)]
+        metadata_cache.get(files[0].key)
+        metadata_cache.get(files[1].key)
+        # 最近使ったものは残す
+        metadata_cache.get(files[0].key)
+        metadata_cache.get(files[2].key)
+
+        self.assertEqual(list(metadata_cache.entries),
+                         [str(files[0].key), str(files[2].key)])
+        samples = registry.collect()
+        self.assertEqual(samples[('sbts_metadata_cache_entries', ())], 2)
+        self.assertEqual(samples[('sbts_metadata_cache_bytes', ())], metadata_cache.nbytes)
+        self.assertGreater(metadata_cache.nbytes, 0)
+
+        metadata_cache.clear()
+        self.assertEqual(registry.collect()[('sbts_metadata_cache_bytes', ())], 0)
+
+
+@override_settings(FILE_RESTORE_POLL_INTERVAL=0)
+class TieringTest(ObjectStorageTestCase):
+    def setUp(self):
+        super().setUp()
+        metadata_cache.clear()
+        registry.clear()
+        self.req_factory = RequestFactory()
+        self.storage = get_storage()
+
+    def tearDown(self):
+        metadata_cache.clear()
+        super().tearDown()
+
+    def create(self, content=b'hello.', fname='hello.txt', days=0):
+        key = upload_blob(io.BytesIO(content), 'shimon')
+        lastmod = datetime.datetime.fromisoformat('2023-11-04T12:00:00Z')
+        f = UploadedFile.objects.create_from_s3(key, 'shimon', fname, lastmod)
+        # プレビューを作るジョブは、移す前に済ませる
+        self.run_jobs()
+        UploadedFile.objects.filter(key=key).update(
+            last_accessed=f.last_accessed - datetime.timedelta(days=days))
+        f.refresh_from_db()
+        return f
+
+    def get(self, view, **kwargs):
+        req = self.req_factory.get('/', kwargs.pop('data', {}))
+        req.user = AnonymousUser()
+        return view.as_view()(req, **kwargs)
+
+    def run_jobs(self):
+        while run_one():
+            pass
+
+    def move_cold_blobs(self, *args):
+        stdout = io.StringIO()
+        call_command('move_cold_blobs', *args, days=30, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_move(self):
+        old = self.create(fname='old.txt', days=31)
+        new = self.create(fname='new.txt', days=29)
+
+        self.assertEqual(self.move_cold_blobs(), f'{old.key} old.txt\n')
+        old.refresh_from_db()
+        new.refresh_from_db()
+        self.assertEqual(old.tier, UploadedFile.COLD)
+        self.assertEqual(new.tier, UploadedFile.HOT)
+        with self.assertRaises(Archived):
+            self.storage.open(str(old.key))
+        self.assertEqual(registry.collect()[('sbts_blob_cold_moves_total', ())], 1)
+        self.assertEqual(self.move_cold_blobs(), '')
+
+    def test_move_recheck(self):
+        '''
+        選んだあとでダウンロードされたり、戻すように頼まれたりしたブロ
+        ブは移さない
+        '''
+
+        used = self.create(fname='used.txt', days=31)
+        restoring = self.create(fname='restoring.txt', days=31)
+        files = list(tiering.cold_files(30))
+        self.assertEqual(len(files), 2)
+        UploadedFile.objects.filter(key=used.key).update(last_accessed=timezone.now())
+        UploadedFile.objects.filter(key=restoring.key).update(tier=UploadedFile.RESTORING)
+
+        for f in files:
+            self.assertFalse(tiering.move_to_cold(f, 30))
+        self.assertEqual(UploadedFile.objects.get(key=used.key).tier, UploadedFile.HOT)
+        self.assertEqual(UploadedFile.objects.get(key=restoring.key).tier,
+                         UploadedFile.RESTORING)
+        for f in files:
+            self.storage.check(str(f.key))
+        self.assertNotIn(('sbts_blob_cold_moves_total', ()), registry.collect())
+
+    def test_dry_run(self):
+        f = self.create(days=31)
+        self.assertEqual(self.move_cold_blobs('--dry-run'), f'{f.key} hello.txt\n')
+        f.refresh_from_db()
+        self.assertEqual(f.tier, UploadedFile.HOT)
+
+    def test_restore_on_download(self):
+        '''
+        移したブロブは202を返して戻し、戻し終えたら返す
+        '''
+
+        f = self.create(days=31)
+        self.move_cold_blobs()
+
+        resp = self.get(BlobView, key=f.key)
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(resp['Retry-After'], str(settings.FILE_RESTORE_RETRY_AFTER))
+        self.assertEqual(resp['Cache-Control'], 'no-store')
+        # 戻している間は、ジョブを増やさない
+        self.assertEqual(self.get(BlobView, key=f.key).status_code, 202)
+        self.assertEqual(Job.objects.filter(name=restore_blob.task_name).count(), 1)
+        f.refresh_from_db()
+        self.assertEqual(f.tier, UploadedFile.RESTORING)
+
+        self.run_jobs()
+        f.refresh_from_db()
+        self.assertEqual(f.tier, UploadedFile.HOT)
+        self.assertGreater(f.last_accessed, timezone.now() - datetime.timedelta(minutes=1))
+        resp = self.get(BlobView, key=f.key)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(b''.join(resp.streaming_content), b'hello.')
+
+        samples = registry.collect()
+        self.assertEqual(samples[('sbts_download_requests_total', (('status', '202'),))], 2)
+        self.assertEqual(samples[('sbts_blob_restores_total', (('result', 'requested'),))], 1)
+        self.assertEqual(samples[('sbts_blob_restores_total', (('result', 'completed'),))], 1)
+
+    def test_restore_failed(self):
+        '''
+        戻すジョブが失敗して終わっても、次のダウンロードで登録し直す
+        '''
+
+        f = self.create(days=31)
+        self.move_cold_blobs()
+        self.assertEqual(self.get(BlobView, key=f.key).status_code, 202)
+        Job.objects.filter(name=restore_blob.task_name).update(status=Job.FAILED)
+
+        with self.assertLogs('sbts.file.tiering', 'WARNING'):
+            self.assertEqual(self.get(BlobView, key=f.key).status_code, 202)
+        self.assertEqual(Job.objects.filter(name=restore_blob.task_name,
+                                            status=Job.PENDING).count(), 1)
+        self.run_jobs()
+        f.refresh_from_db()
+        self.assertEqual(f.tier, UploadedFile.HOT)
+
+    def test_stale_restoring(self):
+        '''
+        別のプロセスが戻し終えていれば、キャッシュが古くても返す
+        '''
+
+        f = self.create()
+        UploadedFile.objects.filter(key=f.key).update(tier=UploadedFile.RESTORING)
+        self.assertEqual(metadata_cache.get(f.key).tier, UploadedFile.RESTORING)
+        UploadedFile.objects.filter(key=f.key).update(tier=UploadedFile.HOT)
+
+        resp = self.get(BlobView, key=f.key)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(b''.join(resp.streaming_content), b'hello.')
+        self.assertEqual(UploadedFile.objects.get(key=f.key).tier, UploadedFile.HOT)
+        self.assertFalse(Job.objects.filter(name=restore_blob.task_name).exists())
+        self.assertEqual(metadata_cache.get(f.key).tier, UploadedFile.HOT)
+
+    def test_stale_metadata(self):
+        '''
+        移したことをまだ知らなくても、保存先から読めなければ戻す
+        '''
+
+        f = self.create()
+        metadata_cache.get(f.key)
+        self.storage.archive(str(f.key))
+
+        self.assertEqual(self.get(BlobView, key=f.key).status_code, 202)
+        self.run_jobs()
+        self.assertEqual(self.get(BlobView, key=f.key).status_code, 200)
+
+    @override_settings(FILE_DOWNLOAD_OFFLOAD='x-accel-redirect')
+    def test_stale_metadata_offload(self):
+        '''
+        前段のWebサーバーに任せるときも、移したことに気づく
+        '''
+
+        f = self.create()
+        metadata_cache.get(f.key)
+        self.storage.archive(str(f.key))
+
+        self.assertEqual(self.get(BlobView, key=f.key).status_code, 202)
+        self.run_jobs()
+        resp = self.get(BlobView, key=f.key)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('X-Accel-Redirect', resp)
+
+    @S3_ONLY
+    @override_settings(FILE_DOWNLOAD_PREFETCH_MIN_SIZE=0,
+                       FILE_DOWNLOAD_PREFETCH_BLOCK_SIZE=2,
+                       FILE_DOWNLOAD_PREFETCH_DEPTH=3)
+    def test_stale_metadata_prefetch(self):
+        '''
+        先読みするときも、200を返す前に移したことに気づく
+        '''
+
+        f = self.create()
+        metadata_cache.get(f.key)
+        self.storage.archive(str(f.key))
+
+        self.assertEqual(self.get(BlobView, key=f.key).status_code, 202)
+        self.run_jobs()
+        resp = self.get(BlobView, key=f.key)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(b''.join(resp.streaming_content), b'hello.')
+
+    def test_touch(self):
+        '''
+        最後にダウンロードされた日時は、古いときだけ書く
+        '''
+
+        f = self.create(days=2)
+        b''.join(self.get(BlobView, key=f.key).streaming_content)
+        accessed = UploadedFile.objects.get(key=f.key).last_accessed
+        self.assertGreater(accessed, f.last_accessed)
+
+        with self.assertNumQueries(0):
+            b''.join(self.get(BlobView, key=f.key).streaming_content)
+        self.assertEqual(UploadedFile.objects.get(key=f.key).last_accessed, accessed)
+
+    def test_archive_view(self):
+        hot = self.create(fname='hot.txt')
+        cold = self.create(fname='cold.txt', days=31)
+        self.move_cold_blobs()
+
+        resp = self.get(ArchiveView, data={'key': [hot.key, cold.key]})
+        self.assertEqual(resp.status_code, 202)
+        self.run_jobs()
+        resp = self.get(ArchiveView, data={'key': [hot.key, cold.key]})
+        self.assertEqual(resp.status_code, 200)
+        with zipfile.ZipFile(io.BytesIO(b''.join(resp.streaming_content))) as zf:
+            self.assertEqual(zf.read('cold.txt'), b'hello.')
+
+
+class CachingProxy:
+    '''
+    CDNなどの共有キャッシュの代わり。Cache-Controlがpublicで
+    max-ageが残っているレスポンスを、Varyのヘッダーの値ごとに保存し、
+    同じリクエストにはDjangoに送らずに返す。
+    '''
+
+    def __init__(self, client):
+        self.client = client
+        # パス -> [(Varyのヘッダーと値, 期限, ステータス, ヘッダー, ボディ)]
+        self.store = {}
+        self.origin_requests = 0
+
+    def get(self, path, **headers):
+        now = time.monotonic()
+        for vary, expires, status, resp_headers, body in self.store.get(path, []):
+            if expires > now and all(headers.get(h) == v for h, v in vary):
+                return status, resp_headers, body
+
+        self.origin_requests += 1
+        resp = self.client.get(path, headers=headers)
+        body = b''.join(resp.streaming_content) if resp.streaming else resp.content
+        resp_headers = dict(resp.headers)
+        directives = [d.strip() for d in resp.get('Cache-Control', '').split(',')]
+        max_age = next((int(d.removeprefix('max-age=')) for d in directives
+                        if d.startswith('max-age=')), 0)
+        if resp.status_code == 200 and 'public' in directives and max_age > 0:
+            vary_headers = [h.strip() for h in resp.get('Vary', '').split(',') if h.strip()]
+            vary = [(h, headers.get(h)) for h in vary_headers]
+            self.store.setdefault(path, []).append(
+                (vary, now + max_age, resp.status_code, resp_headers, body))
+        return resp.status_code, resp_headers, body
+
+
+class BlobViewCachingTest(ObjectStorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.req_factory = RequestFactory()
+        registry.clear()
+
+    def create(self, content, fname):
+        key = upload_blob(io.BytesIO(content), 'shimon')
+        lastmod = datetime.datetime.fromisoformat('2023-11-04T12:00:00Z')
+        return UploadedFile.objects.create_from_s3(key, 'shimon', fname, lastmod)
+
+    def get(self, key, **headers):
+        req = self.req_factory.get('/', headers=headers)
+        req.user = AnonymousUser()
+        return BlobView.as_view()(req, key=key)
+
+    def test_headers(self):
+        f = self.create(b'hello.', 'hello.txt')
+        resp = self.get(f.key)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(resp['ETag'], f'"{f.key}"')
+        self.assertNotIn('Vary', resp)
+        b''.join(resp.streaming_content)
+
+    @override_settings(FILE_BLOB_CACHE_CONTROL='private, max-age=31536000, immutable')
+    def test_private(self):
+        f = self.create(b'hello.', 'hello.txt')
+        resp = self.get(f.key)
+        self.assertEqual(resp['Cache-Control'], 'private, max-age=31536000, immutable')
+        b''.join(resp.streaming_content)
+
+    def test_compressed_etag(self):
+        '''
+        圧縮したまま返すときと、展開して返すときでETagを変える
+        '''
+
+        f = self.create(b'hello.\n' * 1000, 'hello.log')
+        self.assertEqual(f.encoding, compression.GZIP)
+
+        resp = self.get(f.key, Accept_Encoding='gzip')
+        self.assertEqual(resp['ETag'], f'"{f.key}.gzip"')
+        self.assertEqual(resp['Vary'], 'Accept-Encoding')
+        b''.join(resp.streaming_content)
+        resp = self.get(f.key)
+        self.assertEqual(resp['ETag'], f'"{f.key}"')
+        self.assertEqual(resp['Vary'], 'Accept-Encoding')
+        b''.join(resp.streaming_content)
+
+    def test_not_modified(self):
+        f = self.create(b'hello.', 'hello.txt')
+
+        resp = self.get(f.key, If_None_Match=f'"other", W/"{f.key}"')
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.content, b'')
+        self.assertEqual(resp['ETag'], f'"{f.key}"')
+        self.assertEqual(resp['Cache-Control'], 'public, max-age=31536000, immutable')
+
+        resp = self.get(f.key, If_None_Match='"other"')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(b''.join(resp.streaming_content), b'hello.')
+
+        samples = registry.collect()
+        self.assertEqual(samples[('sbts_download_requests_total', (('status', '304'),))], 1)
+
+    def test_not_modified_deleted(self):
+        '''
+        消したブロブは、ETagが一致しても404
+        '''
+
+        f = self.create(b'hello.', 'hello.txt')
+        key = f.key
+        f.delete()
+        with self.assertRaises(Http404):
+            self.get(key, If_None_Match=f'"{key}"')
+
+    def test_proxy(self):
+        '''
+        2回目からは、共有キャッシュがDjangoに送らずに返す
+        '''
+
+        proxy = CachingProxy(self.client)
+        plain = self.create(b'hello.', 'hello.txt')
+        content = b'hello.\n' * 1000
+        compressed = self.create(content, 'hello.log')
+
+        url = reverse('page:file:blob', kwargs={'key': plain.key})
+        for _ in range(3):
+            status, _, body = proxy.get(url)
+            self.assertEqual(status, 200)
+            self.assertEqual(body, b'hello.')
+        self.assertEqual(proxy.origin_requests, 1)
+
+        # Accept-Encodingごとに別々に保存する
+        url = reverse('page:file:blob', kwargs={'key': compressed.key})
+        for _ in range(3):
+            status, headers, body = proxy.get(url, **{'Accept-Encoding': 'gzip'})
+            self.assertEqual(headers['Content-Encoding'], 'gzip')
+            self.assertEqual(gzip.decompress(body), content)
+            status, headers, body = proxy.get(url)
+            self.assertNotIn('Content-Encoding', headers)
+            self.assertEqual(body, content)
+        self.assertEqual(proxy.origin_requests, 3)
+
+
+class OffloadProxy:
+    '''
+    前段のWebサーバーの代わり。nginxのように、X-Accel-Redirectの先を
+    FILE_DOWNLOAD_ACCEL_*_PREFIXのinternalなlocationとして読み、Apache
+    のmod_xsendfileのように、X-Sendfileのファイルを読む。Content-Type
+    とContent-Dispositionはアプリケーションのレスポンスのものを使う。
+    '''
+
+    def __init__(self, resp):
+        self.app_response = resp
+        self.headers = {
+            'Content-Type': resp['Content-Type'],
+            'Content-Disposition': resp['Content-Disposition'],
+        }
+        if resp.has_header('X-Sendfile'):
+            self.content = self.read_file(resp['X-Sendfile'])
+        elif resp.has_header('X-Accel-Redirect'):
+            self.content = self.accel_redirect(resp['X-Accel-Redirect'])
+        else:
+            raise AssertionError('not offloaded')
+        self.headers['Content-Length'] = str(len(self.content))
+
+    def read_file(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def accel_redirect(self, location):
+        local = settings.FILE_DOWNLOAD_ACCEL_LOCAL_PREFIX
+        s3 = settings.FILE_DOWNLOAD_ACCEL_S3_PREFIX
+        if location.startswith(local):
+            return self.read_file(
+                os.path.join(settings.FILE_STORAGE_DIR, location[len(local):]))
+        if location.startswith(s3):
+            url = f'{settings.S3_ENDPOINT}/{location[len(s3):]}'
+            with urllib.request.urlopen(url) as f:
+                return f.read()
+        raise AssertionError(f'unknown location: {location}')
+
+
+class BlobViewOffloadTest(ObjectStorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.req_factory = RequestFactory()
+
+    def create_file(self, content, fname):
+        key = upload_blob(io.BytesIO(content), 'shimon')
+        lastmod = datetime.datetime.fromisoformat('2023-11-04T12:00:00Z')
+        return UploadedFile.objects.create_from_s3(key, 'shimon', fname, lastmod)
+
+    def get(self, key):
+        req = self.req_factory.get('/', HTTP_ACCEPT_ENCODING='gzip')
+        req.user = AnonymousUser()
+        return BlobView.as_view()(req, key=key)
+
+    def assertOffloaded(self, resp, content, fname):
+        # ボディはアプリケーションを通らない
+        self.assertEqual(resp.status_code, 200)
+        self.assertFalse(resp.streaming)
+        self.assertEqual(resp.content, b'')
+
+        proxy = OffloadProxy(resp)
+        self.assertEqual(proxy.content, content)
+        self.assertEqual(proxy.headers['Content-Type'], 'application/octet-stream')
+        self.assertEqual(int(proxy.headers['Content-Length']), len(content))
+        msg = EmailMessage()
+        msg['Content-Disposition'] = proxy.headers['Content-Disposition']
+        self.assertEqual(msg.get_content_disposition(), 'attachment')
+        self.assertEqual(msg.get_filename(), fname)
+
+    @override_settings(FILE_STORAGE='sbts.file.storage.LocalStorage',
+                       FILE_DOWNLOAD_OFFLOAD='x-sendfile')
+    def test_x_sendfile(self):
+        content = random.Random(0).randbytes(4096)
+        f1 = self.create_file(content, 'ファイル.bin')
+
+        resp = self.get(f1.key)
+        self.assertEqual(resp['X-Sendfile'], get_storage().local_path(str(f1.key)))
+        self.assertOffloaded(resp, content, 'ファイル.bin')
+
+    @override_settings(FILE_STORAGE='sbts.file.storage.LocalStorage',
+                       FILE_DOWNLOAD_OFFLOAD='x-accel-redirect')
+    def test_x_accel_redirect_local(self):
+        content = random.Random(0).randbytes(4096)
+        f1 = self.create_file(content, 'a.bin')
+
+        resp = self.get(f1.key)
+        self.assertEqual(resp['X-Accel-Redirect'], f'/_blobs/{f1.key}')
+        self.assertOffloaded(resp, content, 'a.bin')
+
+    @skipUnless(import_string(settings.FILE_STORAGE) is S3Storage, 'not using S3Storage')
+    @override_settings(FILE_DOWNLOAD_OFFLOAD='x-accel-redirect')
+    def test_x_accel_redirect_s3(self):
+        content = random.Random(0).randbytes(4096)
+        f1 = self.create_file(content, 'a.bin')
+
+        resp = self.get(f1.key)
+        self.assertTrue(resp['X-Accel-Redirect'].startswith(
+            f'/_s3/{settings.S3_BUCKET_FILE}/{f1.key}?'))
+        self.assertOffloaded(resp, content, 'a.bin')
+
+    @skipUnless(import_string(settings.FILE_STORAGE) is S3Storage, 'not using S3Storage')
+    @override_settings(FILE_DOWNLOAD_OFFLOAD='x-sendfile')
+    def test_x_sendfile_s3(self):
+        '''
+        S3のブロブはX-Sendfileで任せられないので、これまで通り返す
+        '''
+
+        f1 = self.create_file(b'hello.', 'a.txt')
+
+        resp = self.get(f1.key)
+        self.assertFalse(resp.has_header('X-Sendfile'))
+        self.assertEqual(b''.join(resp.streaming_content), b'hello.')
+
+    @override_settings(FILE_STORAGE='sbts.file.storage.LocalStorage',
+                       FILE_DOWNLOAD_OFFLOAD='x-accel-redirect')
+    def test_compressed(self):
+        '''
+        圧縮したブロブは任せない
+        '''
+
+        content = b'hello.\n' * 1000
+        f1 = self.create_file(content, 'hello.log')
+        self.assertEqual(f1.encoding, compression.GZIP)
+
+        resp = self.get(f1.key)
+        self.assertFalse(resp.has_header('X-Accel-Redirect'))
+        self.assertEqual(resp['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(b''.join(resp.streaming_content)), content)
+
+    @override_settings(FILE_DOWNLOAD_OFFLOAD='x-accel-redirect')
+    def test_not_found(self):
+        with self.assertRaises(Http404):
+            self.get(uuid.UUID('6b1ec55f-3e41-4780-aa71-0fbbbe4e0d5d'))
+
+
 class UploadViewTest(ObjectStorageTestCase):
     @classmethod
     def setUpTestData(cls):
@@ -390,9 +1606,8 @@ class UploadViewTest(ObjectStorageTestCase):
         o1 = S3Uploader.objects.first()
         self.assertQuerySetEqual(S3Uploader.objects.all(), [o1])
 
-        s3client = boto3.client('s3', endpoint_url=settings.S3_ENDPOINT)
-        s3obj = s3client.get_object(Bucket=settings.S3_BUCKET_FILE, Key=str(o1.key))
-        self.assertEqual(s3obj['Body'].read(), content)
+        blob = get_storage().open(str(o1.key))
+        self.assertEqual(blob.read(), content)
 
         self.assertEqual(json.loads(resp.content)['key'], str(o1.key))
         self.assertEqual(resp.status_code, 200)
@@ -414,9 +1629,8 @@ class UploadViewTest(ObjectStorageTestCase):
         o1 = S3Uploader.objects.first()
         self.assertQuerySetEqual(S3Uploader.objects.all(), [o1])
 
-        s3client = boto3.client('s3', endpoint_url=settings.S3_ENDPOINT)
-        s3obj = s3client.get_object(Bucket=settings.S3_BUCKET_FILE, Key=str(o1.key))
-        self.assertEqual(s3obj['Body'].read(), content)
+        blob = get_storage().open(str(o1.key))
+        self.assertEqual(blob.read(), content)
 
         self.assertEqual(json.loads(resp.content)['key'], str(o1.key))
         self.assertEqual(resp.status_code, 200)
@@ -438,9 +1652,8 @@ class UploadViewTest(ObjectStorageTestCase):
         o1 = S3Uploader.objects.first()
         self.assertQuerySetEqual(S3Uploader.objects.all(), [o1])
 
-        s3client = boto3.client('s3', endpoint_url=settings.S3_ENDPOINT)
-        s3obj = s3client.get_object(Bucket=settings.S3_BUCKET_FILE, Key=str(o1.key))
-        self.assertEqual(s3obj['Body'].read(), content)
+        blob = get_storage().open(str(o1.key))
+        self.assertEqual(blob.read(), content)
 
         self.assertEqual(json.loads(resp.content)['key'], str(o1.key))
         self.assertEqual(resp.status_code, 200)
@@ -462,9 +1675,8 @@ class UploadViewTest(ObjectStorageTestCase):
         o1 = S3Uploader.objects.first()
         self.assertQuerySetEqual(S3Uploader.objects.all(), [o1])
 
-        s3client = boto3.client('s3', endpoint_url=settings.S3_ENDPOINT)
-        s3obj = s3client.get_object(Bucket=settings.S3_BUCKET_FILE, Key=str(o1.key))
-        self.assertEqual(s3obj['Body'].read(), content)
+        blob = get_storage().open(str(o1.key))
+        self.assertEqual(blob.read(), content)
 
         self.assertEqual(json.loads(resp.content)['key'], str(o1.key))
         self.assertEqual(resp.status_code, 200)
@@ -538,3 +1750,222 @@ class UploadViewTest(ObjectStorageTestCase):
         req.user = self.user_shimon
         resp = UploadView.as_view()(req)
         self.assertEqual(resp.status_code, 405)
+
+
+class ArchiveViewTest(ObjectStorageTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.user_shimon = User.objects.create_user(
+            'shimon', 'shimon@example.com', 'pw')
+
+    def setUp(self):
+        super().setUp()
+        self.req_factory = RequestFactory()
+
+    def create_file(self, content, fname):
+        key = upload_blob(io.BytesIO(content), self.user_shimon.username)
+        lastmod = datetime.datetime.fromisoformat('2023-11-04T12:00:00Z')
+        return UploadedFile.objects.create_from_s3(
+            key, self.user_shimon.username, fname, lastmod)
+
+    def test_ok(self):
+        f1 = self.create_file(b'hello.', 'hello.txt')
+        f2 = self.create_file(b'', 'empty.txt')
+        f3_content = random.Random(0).randbytes(settings.FILE_DOWNLOAD_BLOCK_SIZE + 1)
+        f3 = self.create_file(f3_content, 'ファイル.bin')
+
+        req = self.req_factory.get('/', {'key': [f1.key, f2.key, f3.key]})
+        req.user = AnonymousUser()
+        resp = ArchiveView.as_view()(req)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp['Content-Type'], 'application/zip')
+        self.assertTrue(resp.streaming)
+        with zipfile.ZipFile(io.BytesIO(b''.join(resp.streaming_content))) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.namelist(), ['hello.txt', 'empty.txt', 'ファイル.bin'])
+            self.assertEqual(
+                {i.compress_type for i in zf.infolist()}, {zipfile.ZIP_STORED})
+            self.assertEqual(zf.read('hello.txt'), b'hello.')
+            self.assertEqual(zf.read('empty.txt'), b'')
+            self.assertEqual(zf.read('ファイル.bin'), f3_content)
+
+    def test_compressed(self):
+        '''
+        圧縮して保存したファイルは、展開してZIPに入れる
+        '''
+
+        content = b'hello.\n' * 1000
+        f1 = self.create_file(content, 'hello.log')
+        self.assertEqual(f1.encoding, compression.GZIP)
+
+        req = self.req_factory.get('/', {'key': [f1.key]})
+        req.user = AnonymousUser()
+        resp = ArchiveView.as_view()(req)
+
+        with zipfile.ZipFile(io.BytesIO(b''.join(resp.streaming_content))) as zf:
+            self.assertEqual(zf.read('hello.log'), content)
+
+    def test_same_name(self):
+        '''
+        同名のファイルには番号を付けて区別する
+        '''
+
+        f1 = self.create_file(b'1', 'a.txt')
+        f2 = self.create_file(b'2', 'a.txt')
+        f3 = self.create_file(b'3', 'dir/a.txt')
+
+        req = self.req_factory.get('/', {'key': [f1.key, f2.key, f3.key]})
+        req.user = AnonymousUser()
+        resp = ArchiveView.as_view()(req)
+
+        with zipfile.ZipFile(io.BytesIO(b''.join(resp.streaming_content))) as zf:
+            self.assertEqual(zf.namelist(), ['a.txt', 'a (2).txt', 'dir_a.txt'])
+            self.assertEqual(zf.read('a (2).txt'), b'2')
+
+    def test_invalid_key(self):
+        f1 = self.create_file(b'hello.', 'hello.txt')
+
+        req = self.req_factory.get('/', {'key': [f1.key, '6b1ec55f-3e41-4780-aa71-0fbbbe4e0d5d']})
+        req.user = AnonymousUser()
+        with self.assertRaises(Http404):
+            ArchiveView.as_view()(req)
+
+    def test_malformed_key(self):
+        req = self.req_factory.get('/', {'key': ['invalid']})
+        req.user = AnonymousUser()
+        resp = ArchiveView.as_view()(req)
+        self.assertEqual(resp.status_code, 400)
+
+    def test_no_key(self):
+        req = self.req_factory.get('/')
+        req.user = AnonymousUser()
+        resp = ArchiveView.as_view()(req)
+        self.assertEqual(resp.status_code, 400)
+
+    @override_settings(FILE_ARCHIVE_MAX_FILES=1)
+    def test_too_many(self):
+        f1 = self.create_file(b'1', 'a.txt')
+        f2 = self.create_file(b'2', 'b.txt')
+
+        req = self.req_factory.get('/', {'key': [f1.key, f2.key]})
+        req.user = AnonymousUser()
+        resp = ArchiveView.as_view()(req)
+        self.assertEqual(resp.status_code, 400)
+
+    def test_post(self):
+        req = self.req_factory.post('/')
+        req.user = AnonymousUser()
+        resp = ArchiveView.as_view()(req)
+        self.assertEqual(resp.status_code, 405)
+
+
+class PreviewTest(ObjectStorageTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.user_shimon = User.objects.create_user(
+            'shimon', 'shimon@example.com', 'pw')
+
+    def setUp(self):
+        super().setUp()
+        self.req_factory = RequestFactory()
+
+    def create_file(self, content, fname):
+        key = upload_blob(io.BytesIO(content), self.user_shimon.username)
+        lastmod = datetime.datetime.fromisoformat('2023-11-04T12:00:00Z')
+        return UploadedFile.objects.create_from_s3(
+            key, self.user_shimon.username, fname, lastmod)
+
+    def get_preview(self, key):
+        req = self.req_factory.get('/')
+        req.user = AnonymousUser()
+        return PreviewView.as_view()(req, key=key)
+
+    def test_enqueued(self):
+        '''
+        create_from_s3と同じトランザクションでプレビューのジョブを登録
+        し、ワーカーが実行する
+        '''
+
+        f1 = self.create_file(b'hello.', 'hello.txt')
+        job = Job.objects.get()
+        self.assertEqual(job.name, 'sbts.file.tasks.generate_preview')
+        self.assertEqual(job.args, {'key': str(f1.key)})
+
+        self.assertTrue(run_one())
+        f1.refresh_from_db()
+        self.assertEqual(f1.preview, 'text/plain; charset=utf-8')
+        self.assertQuerySetEqual(Job.objects.all(), [])
+
+    def test_text(self):
+        f1 = self.create_file('こんにちは\n'.encode(), 'hello.txt')
+        generate_preview(f1.key)
+
+        f1.refresh_from_db()
+        self.assertEqual(f1.preview, 'text/plain; charset=utf-8')
+        resp = self.get_preview(f1.key)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp['Content-Type'], 'text/plain; charset=utf-8')
+        self.assertEqual(resp['Cache-Control'], settings.FILE_PREVIEW_CACHE_CONTROL)
+        self.assertEqual(b''.join(resp.streaming_content), 'こんにちは\n'.encode())
+
+    @override_settings(FILE_PREVIEW_TEXT_SIZE=16)
+    def test_long_text(self):
+        '''
+        長いテキストは、先頭を行の区切りで切り出す
+        '''
+
+        f1 = self.create_file(b'line 1\nline 2\nline 3\n', 'log.txt')
+        generate_preview(f1.key)
+
+        resp = self.get_preview(f1.key)
+        self.assertEqual(b''.join(resp.streaming_content), b'line 1\nline 2\n')
+
+    @override_settings(FILE_PREVIEW_TEXT_SIZE=16)
+    def test_compressed_text(self):
+        f1 = self.create_file(b'line 1\n' * 1000, 'log.txt')
+        self.assertEqual(f1.encoding, compression.GZIP)
+        generate_preview(f1.key)
+
+        resp = self.get_preview(f1.key)
+        self.assertEqual(b''.join(resp.streaming_content), b'line 1\nline 1\n')
+
+    def test_binary(self):
+        '''
+        画像でもテキストでもなければプレビューは作らない
+        '''
+
+        f1 = self.create_file(b'\0\1\2\3', 'a.bin')
+        generate_preview(f1.key)
+
+        f1.refresh_from_db()
+        self.assertEqual(f1.preview, '')
+        with self.assertRaises(Http404):
+            self.get_preview(f1.key)
+
+    def test_empty(self):
+        f1 = self.create_file(b'', 'empty.txt')
+        generate_preview(f1.key)
+
+        f1.refresh_from_db()
+        self.assertEqual(f1.preview, '')
+
+    @skipIf(Image is None, 'Pillow is not installed')
+    def test_image(self):
+        img = io.BytesIO()
+        Image.new('RGB', (1024, 512), 'red').save(img, 'PNG')
+        f1 = self.create_file(img.getvalue(), 'screenshot.png')
+        generate_preview(f1.key)
+
+        f1.refresh_from_db()
+        self.assertEqual(f1.preview, 'image/jpeg')
+        resp = self.get_preview(f1.key)
+        self.assertEqual(resp['Content-Type'], 'image/jpeg')
+        with Image.open(io.BytesIO(b''.join(resp.streaming_content))) as thumb:
+            self.assertEqual(thumb.size, (256, 128))
+
+    def test_invalid(self):
+        with self.assertRaises(Http404):
+            self.get_preview(uuid.UUID('6b1ec55f-3e41-4780-aa71-0fbbbe4e0d5d'))
@@ -0,0 +1,128 @@
+'''
+ダウンロードされなくなったブロブを安い保存先(コールドストレージ)に移
+し、ダウンロードされたら戻す。
+
+move_cold_blobsで、FILE_COLD_AFTER_DAYS日ダウンロードされていないブ
+ロブを移す。移したブロブはすぐには読めないので、BlobViewは戻すジョブ
+を登録して202を返し、クライアントにはRetry-Afterのあとで取りに来させ
+る。
+'''
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+import datetime
+import logging
+
+from sbts.task.models import Job
+
+from . import metrics
+from .metacache import metadata_cache
+from .models import UploadedFile, access_time
+from .storage import get_storage
+
+
+logger = logging.getLogger(__name__)
+
+
+def touch(meta):
+    '''
+    BlobMetaのブロブがダウンロードされたことを記録する。書き込みを減
+    らすため、FILE_LAST_ACCESSED_RESOLUTION秒より古いときだけ書く。
+    '''
+
+    now = access_time()
+    threshold = now - datetime.timedelta(seconds=settings.FILE_LAST_ACCESSED_RESOLUTION)
+    if meta.last_accessed >= threshold:
+        return
+    UploadedFile.objects.filter(key=meta.key, last_accessed__lt=threshold) \
+        .update(last_accessed=now)
+    # 次のダウンロードで、また書かないようにする
+    metadata_cache.replace(meta._replace(last_accessed=now))
+
+
+def cold_files(days, now=None):
+    now = now or timezone.now()
+    return UploadedFile.objects.filter(
+        tier=UploadedFile.HOT,
+        last_accessed__lt=now - datetime.timedelta(days=days),
+    ).order_by('last_accessed')
+
+
+def move_to_cold(file, days, now=None, storage=None):
+    '''
+    fileのブロブをコールドストレージに移し、移したらTrueを返す。選ん
+    だあとでダウンロードされたり、戻すように頼まれたりして、もう
+    cold_filesに入らなければ移さない。
+
+    移している間は行をロックするので、同じブロブのダウンロードは、最
+    後にダウンロードされた日時を書くところで待ち、移し終えてから戻す
+    ジョブを登録する。
+    '''
+
+    storage = storage or get_storage()
+    with transaction.atomic():
+        if not cold_files(days, now).select_for_update().filter(key=file.key).exists():
+            return False
+        storage.archive(str(file.key))
+        UploadedFile.objects.filter(key=file.key).update(tier=UploadedFile.COLD)
+    metadata_cache.invalidate(file.key)
+    metrics.COLD_MOVES.inc()
+    return True
+
+
+def request_restore(key, archived=False):
+    '''
+    keyのブロブを戻すジョブを登録し、まだ読めなければTrueを返す。すで
+    に戻している途中なら登録しない。戻すジョブがTASK_MAX_ATTEMPTS回失
+    敗して終わっていれば、登録し直す。
+
+    データベースではもう戻し終えていれば、このプロセスのキャッシュが
+    古いので、消してFalseを返す。archivedが真なら、保存先から読めな
+    かったので、データベースでHOTでも戻す。
+    '''
+
+    # tasksはこのモジュールに依存するので、ここで読み込む
+    from .tasks import restore_blob
+
+    tiers = [UploadedFile.COLD, UploadedFile.HOT] if archived else [UploadedFile.COLD]
+    with transaction.atomic():
+        requested = UploadedFile.objects.filter(key=key, tier__in=tiers) \
+            .update(tier=UploadedFile.RESTORING) > 0
+        if requested:
+            tier = UploadedFile.RESTORING
+        else:
+            # 同時に登録し直さないように、行をロックしてから確かめる
+            tier = UploadedFile.objects.select_for_update().filter(key=key) \
+                .values_list('tier', flat=True).first()
+            requested = tier == UploadedFile.RESTORING and not Job.objects.filter(
+                name=restore_blob.task_name, args={'key': str(key)},
+                status__in=[Job.PENDING, Job.RUNNING]).exists()
+            if requested:
+                logger.warning('restore job for %s has failed; enqueueing again', key)
+        if requested:
+            restore_blob.enqueue(key=str(key))
+    if requested or tier != UploadedFile.RESTORING:
+        metadata_cache.invalidate(key)
+    if requested:
+        metrics.RESTORES.inc(result='requested')
+    return tier == UploadedFile.RESTORING
+
+
+def restore(key, storage=None):
+    '''
+    keyのブロブを戻す。戻し終えたらTrue、まだ途中ならFalseを返す。
+    '''
+
+    if not UploadedFile.objects.filter(key=key).exists():
+        # 戻している間に消された
+        return True
+    storage = storage or get_storage()
+    if not storage.restore(str(key)):
+        return False
+    UploadedFile.objects.filter(key=key).update(
+        tier=UploadedFile.HOT, last_accessed=access_time())
+    metadata_cache.invalidate(key)
+    metrics.RESTORES.inc(result='completed')
+    return True
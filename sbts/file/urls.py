@@ -1,10 +1,13 @@
 from django.urls import path
 
-from .views import BlobView, UploadView
+from .views import ArchiveView, BlobView, PreviewView, SignedBlobView, UploadView
 
 
 app_name = 'file'
 urlpatterns = [
     path('blobs/<uuid:key>/', BlobView.as_view(), name='blob'),
+    path('blobs/<uuid:key>/preview/', PreviewView.as_view(), name='preview'),
+    path('blobs/signed/<str:token>/', SignedBlobView.as_view(), name='signed_blob'),
     path('blobs/', UploadView.as_view(), name='upload'),
+    path('archive/', ArchiveView.as_view(), name='archive'),
 ]
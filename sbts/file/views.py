@@ -1,15 +1,35 @@
 from django.conf import settings
-from django.core.exceptions import ObjectDoesNotExist
-from django.http import FileResponse, Http404
+from django.core import signing
+from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
+from django.http import FileResponse, Http404, HttpResponse, \
+    HttpResponseBadRequest, HttpResponseNotModified, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.cache import patch_vary_headers
+from django.utils.http import content_disposition_header, parse_etags
 from django.views import View
 from rest_framework.parsers import BaseParser
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-import boto3
 import io
+import os
+import re
+import time
+import urllib.parse
+import uuid
+import zipfile
 
+from sbts.core.metrics import registry
+
+from . import compression
+from . import metrics
+from . import tiering
+from .cache import blob_cache
+from .metacache import metadata_cache
 from .models import UploadedFile, upload_blob
+from .prefetch import prefetch
+from .previews import preview_key
+from .storage import Archived, LimitedReader, NotFound, get_storage, unsign
 
 
 class StreamParser(BaseParser):
@@ -33,24 +53,437 @@ class UploadView(StreamRequestView):
         return Response({'key': key})
 
 
+def parse_range(header, size):
+    '''
+    Rangeヘッダーの範囲を[first, last)で返す。ヘッダーがないか、範囲が
+    1つでなければNoneを返し、全体を返させる。満たせない範囲なら
+    ValueErrorを送出する。
+    '''
+
+    m = re.fullmatch(r'bytes=(\d*)-(\d*)', (header or '').strip())
+    if m is None or m.groups() == ('', ''):
+        return None
+    first, last = m.groups()
+    if first == '':
+        # 末尾のlast bytes
+        n = int(last)
+        if n == 0 or size == 0:
+            raise ValueError(header)
+        return max(size - n, 0), size
+    first = int(first)
+    last = size if last == '' else min(int(last) + 1, size)
+    if first >= size or first >= last:
+        raise ValueError(header)
+    return first, last
+
+
+def etag_matches(header, etag):
+    '''
+    If-None-Matchのヘッダーがetagに一致するか。If-None-Matchは弱い比
+    較をする。
+    '''
+
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    return etag.removeprefix('W/') in (
+        tag.removeprefix('W/') for tag in parse_etags(header))
+
+
 class BlobView(View):
+    '''
+    ブロブを返す。圧縮して保存したブロブは、クライアントが受け取れれ
+    ばContent-Encodingを付けてそのまま返し、受け取れなければ展開しな
+    がら返す。
+
+    FILE_DOWNLOAD_OFFLOADを設定すると、圧縮していないブロブは、権限
+    とブロブがあることの確認だけをして、送信は前段のWebサーバーに内部
+    リダイレクトで任せる。
+
+    ブロブはキーごとに変わらないので、FILE_BLOB_CACHE_CONTROLで長期間
+    キャッシュさせ、If-None-Matchには304を返す。
+
+    FILE_CACHE_DIRを設定すると、S3のブロブは最初に読まれたときにロー
+    カルディスクにコピーし、次からはそこから範囲(Range)付きで返す。
+
+    コールドストレージに移したブロブは、戻すジョブを登録して202を返
+    す。
+    '''
+
+    replica_reads = True
+
     def get(self, request, *args, **kwargs):
-        s3client = boto3.client('s3', endpoint_url=settings.S3_ENDPOINT)
-        try:
-            fname = UploadedFile.objects.get(key=kwargs['key']).name
-            s3obj = s3client.get_object(
-                Bucket=settings.S3_BUCKET_FILE,
-                Key=str(kwargs['key']))
-        except (ObjectDoesNotExist,
-                s3client.exceptions.NoSuchKey,
-                s3client.exceptions.InvalidObjectState):
-            raise Http404()
+        start = time.perf_counter()
+        storage = get_storage()
+        cached = None
+        try:
+            file = metadata_cache.get(kwargs['key'])
+        except ObjectDoesNotExist:
+            raise self.not_found()
+        tiering.touch(file)
+
+        etag = self.etag(request, file)
+        if etag_matches(request.headers.get('If-None-Match'), etag):
+            metrics.DOWNLOAD_REQUESTS.inc(status='304')
+            return self.patch_caching(HttpResponseNotModified(), file, etag)
+        if file.tier != UploadedFile.HOT:
+            if tiering.request_restore(file.key):
+                return self.restoring()
+            # 戻し終えたことが、まだキャッシュに反映されていなかった
+            file = file._replace(tier=UploadedFile.HOT)
+
+        try:
+            offload = self.offload(storage, file)
+            if offload is not None:
+                # 前段のWebサーバーは、なかったり移したりしたブロブを
+                # 202にできないので、任せる前に確かめる
+                storage.check(str(file.key))
+            caching = offload is None and blob_cache.cacheable(storage, file)
+            if caching:
+                cached = blob_cache.open(file.key)
+            # キャッシュに入れるブロブは、読んだものを入れるので先読み
+            # しない
+            prefetching = offload is None and not caching \
+                and self.prefetches(storage, file)
+            if prefetching:
+                blocks = prefetch(storage, str(file.key), file.size,
+                                  settings.FILE_DOWNLOAD_PREFETCH_BLOCK_SIZE,
+                                  settings.FILE_DOWNLOAD_PREFETCH_DEPTH)
+            elif offload is None and cached is None:
+                blob = storage.open(str(kwargs['key']))
+        except Archived:
+            # 移したことがまだキャッシュに反映されていない
+            tiering.request_restore(file.key, archived=True)
+            return self.restoring()
+        except NotFound:
+            raise self.not_found()
+
+        if offload is not None:
+            metrics.DOWNLOAD_REQUESTS.inc(status='200')
+            # Content-TypeとContent-Dispositionは前段のWebサーバーがそ
+            # のまま使い、Content-Lengthはリダイレクト先から決まる
+            resp = HttpResponse(content_type='application/octet-stream')
+            resp['Content-Disposition'] = content_disposition_header(True, file.name)
+            header, location = offload
+            resp[header] = location
+            metrics.DOWNLOAD_BYTES.inc(file.size)
+            return self.patch_caching(resp, file, etag)
+
+        if caching and cached is None:
+            blob = blob_cache.tee(blob, file.key)
+
+        if cached is not None:
+            resp = self.cached_response(request, file, cached)
+        elif prefetching:
+            resp = StreamingHttpResponse(blocks, content_type='application/octet-stream')
+            resp['Content-Disposition'] = content_disposition_header(True, file.name)
+            resp['Content-Length'] = file.size
+        elif file.encoding and not compression.accepts(request, file.encoding):
+            resp = StreamingHttpResponse(
+                self.decode(blob, file.encoding),
+                content_type='application/octet-stream')
+            resp['Content-Disposition'] = content_disposition_header(True, file.name)
+            resp['Content-Length'] = file.size
+        else:
+            resp = FileResponse(
+                blob.file,
+                content_type='application/octet-stream',
+                as_attachment=True,
+                filename=file.name,
+            )
+            resp['Content-Length'] = blob.size
+            if file.encoding:
+                resp['Content-Encoding'] = file.encoding
+        metrics.DOWNLOAD_REQUESTS.inc(status=str(resp.status_code))
+        if resp.status_code < 400:
+            self.patch_caching(resp, file, etag)
 
+        if not resp.streaming:
+            return resp
+        if isinstance(getattr(resp, 'file_to_stream', None), io.BufferedReader):
+            # ローカルのファイルは、wsgi.file_wrapperがos.sendfileで送
+            # れるように、ボディを包まずにそのまま渡す
+            metrics.DOWNLOAD_TTFB_SECONDS.observe(time.perf_counter() - start)
+            metrics.DOWNLOAD_BYTES.inc(int(resp['Content-Length']))
+        else:
+            resp.streaming_content = self.measure(resp.streaming_content, start)
+        return resp
+
+    def not_found(self):
+        metrics.DOWNLOAD_REQUESTS.inc(status='404')
+        return Http404()
+
+    def restoring(self):
+        metrics.DOWNLOAD_REQUESTS.inc(status='202')
+        return restoring_response()
+
+    def etag(self, request, file):
+        '''
+        強いETag。ブロブはキーごとに変わらないので、キーから作る。圧縮
+        したまま返すときと展開して返すときはバイト列が違うので、区別す
+        る。
+        '''
+
+        if file.encoding and compression.accepts(request, file.encoding):
+            return f'"{file.key}.{file.encoding}"'
+        return f'"{file.key}"'
+
+    def patch_caching(self, resp, file, etag):
+        resp['ETag'] = etag
+        resp['Cache-Control'] = settings.FILE_BLOB_CACHE_CONTROL
+        if file.encoding:
+            patch_vary_headers(resp, ['Accept-Encoding'])
+        return resp
+
+    def cached_response(self, request, file, cached):
+        '''
+        キャッシュのファイルから返す。保存したままのブロブなので、範囲
+        (Range)を1つだけ受け付ける。
+        '''
+
+        if file.encoding and not compression.accepts(request, file.encoding):
+            resp = StreamingHttpResponse(
+                self.decode(cached, file.encoding),
+                content_type='application/octet-stream')
+            resp['Content-Disposition'] = content_disposition_header(True, file.name)
+            resp['Content-Length'] = file.size
+            return resp
+
+        size = os.fstat(cached.fileno()).st_size
+        try:
+            byte_range = parse_range(request.headers.get('Range'), size)
+        except ValueError:
+            cached.close()
+            resp = HttpResponse(status=416)
+            resp['Content-Range'] = f'bytes */{size}'
+            return resp
+
+        if byte_range is None:
+            body, length = cached, size
+        else:
+            first, last = byte_range
+            cached.seek(first)
+            body, length = LimitedReader(cached, last - first), last - first
         resp = FileResponse(
-            s3obj['Body'],
+            body,
+            status=200 if byte_range is None else 206,
             content_type='application/octet-stream',
             as_attachment=True,
-            filename=fname,
+            filename=file.name,
         )
-        resp['Content-Length'] = s3obj['ContentLength']
+        resp['Content-Length'] = length
+        resp['Accept-Ranges'] = 'bytes'
+        if byte_range is not None:
+            resp['Content-Range'] = f'bytes {first}-{last - 1}/{size}'
+        if file.encoding:
+            resp['Content-Encoding'] = file.encoding
+        return resp
+
+    def offload(self, storage, file):
+        '''
+        前段のWebサーバーに任せるなら、内部リダイレクトのヘッダーの名
+        前と値を返す。
+
+        前段のWebサーバーはContent-Encodingを付けられないので、圧縮し
+        たブロブは任せない。X-Sendfileはファイルしか送れないので、S3に
+        保存したブロブは任せない。
+        '''
+
+        mode = settings.FILE_DOWNLOAD_OFFLOAD
+        if mode is None or file.encoding:
+            return None
+
+        name = str(file.key)
+        path = storage.local_path(name)
+        if mode == 'x-sendfile':
+            if path is None:
+                return None
+            return 'X-Sendfile', path
+        elif mode == 'x-accel-redirect':
+            if path is not None:
+                return 'X-Accel-Redirect', settings.FILE_DOWNLOAD_ACCEL_LOCAL_PREFIX + name
+            # 署名付きURLを、S3に中継するlocationに付け替える
+            url = urllib.parse.urlsplit(
+                storage.presign(name, settings.FILE_DOWNLOAD_PRESIGN_EXPIRES))
+            return 'X-Accel-Redirect', \
+                f'{settings.FILE_DOWNLOAD_ACCEL_S3_PREFIX}{url.path.lstrip("/")}?{url.query}'
+        raise ImproperlyConfigured(f'unknown FILE_DOWNLOAD_OFFLOAD: {mode!r}')
+
+    def prefetches(self, storage, file):
+        '''
+        範囲に分けて並行して読むか。ローカルのファイルはos.sendfileで
+        送れるので読まない。圧縮したブロブは保存した大きさが分からない
+        ので、1回のGETで読む。
+        '''
+
+        return (settings.FILE_DOWNLOAD_PREFETCH_DEPTH > 0
+                and not file.encoding
+                and file.size >= settings.FILE_DOWNLOAD_PREFETCH_MIN_SIZE
+                and storage.local_path(str(file.key)) is None)
+
+    def measure(self, chunks, start):
+        first = True
+        try:
+            for chunk in chunks:
+                if first:
+                    metrics.DOWNLOAD_TTFB_SECONDS.observe(time.perf_counter() - start)
+                    first = False
+                metrics.DOWNLOAD_BYTES.inc(len(chunk))
+                yield chunk
+        finally:
+            registry.flush_if_due()
+
+    def decode(self, body, encoding):
+        try:
+            src = compression.open_blob(body, encoding)
+            while chunk := src.read(settings.FILE_DOWNLOAD_BLOCK_SIZE):
+                yield chunk
+        finally:
+            body.close()
+
+
+class PreviewView(View):
+    '''
+    サムネイルやテキストの抜粋を返す。プレビューは作り直さないので、
+    長期間キャッシュさせる。
+    '''
+
+    def get(self, request, *args, **kwargs):
+        try:
+            file = UploadedFile.objects.get(key=kwargs['key'])
+            if not file.preview:
+                raise Http404()
+            blob = get_storage().open(preview_key(file.key))
+        except (ObjectDoesNotExist, NotFound):
+            raise Http404()
+
+        resp = FileResponse(blob.file, content_type=file.preview)
+        resp['Content-Length'] = blob.size
+        resp['Cache-Control'] = settings.FILE_PREVIEW_CACHE_CONTROL
+        return resp
+
+
+class SignedBlobView(View):
+    '''
+    LocalStorage.presignで作ったURLのブロブを、保存したまま返す。S3の
+    署名付きURLと同じく、圧縮して保存したブロブは展開しない。
+    '''
+
+    def get(self, request, *args, **kwargs):
+        try:
+            blob = get_storage().open(unsign(kwargs['token']))
+        except (signing.BadSignature, NotFound):
+            raise Http404()
+
+        resp = FileResponse(blob.file, content_type='application/octet-stream')
+        resp['Content-Length'] = blob.size
+        return resp
+
+
+class ZipStream:
+    '''
+    zipfile.ZipFileの書き込み先。シークできないので、zipfileはデータ記
+    述子を使って書く。書かれたデータはdrainで取り出すまで保持する。
+    '''
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def archive_names(files):
+    '''
+    ZIP内のファイル名を返す。パス区切りは置き換え、同名のファイルには
+    番号を付けて区別する。
+    '''
+
+    used = set()
+    for f in files:
+        name = f.name.replace('/', '_').replace('\\', '_')
+        stem, ext = os.path.splitext(name)
+        n = 1
+        while name in used:
+            n += 1
+            name = f'{stem} ({n}){ext}'
+        used.add(name)
+        yield name
+
+
+def restoring_response():
+    '''
+    コールドストレージのブロブを戻している間、Retry-Afterのあとで取り
+    に来させる。
+    '''
+
+    resp = HttpResponse(status=202)
+    resp['Retry-After'] = settings.FILE_RESTORE_RETRY_AFTER
+    # 戻し終えたら内容を返すので、キャッシュさせない
+    resp['Cache-Control'] = 'no-store'
+    return resp
+
+
+class ArchiveView(View):
+    '''
+    指定した複数のファイルを、1つのZIPにまとめて返す。ストレージから読んだ分
+    だけ無圧縮(store)でZIPに書いてすぐに送るので、一時ファイルを使わ
+    ず、メモリ使用量はファイルの大きさによらない。
+    '''
+
+    def get(self, request, *args, **kwargs):
+        try:
+            keys = [uuid.UUID(k) for k in request.GET.getlist('key')]
+        except ValueError:
+            return HttpResponseBadRequest()
+        if not keys or len(keys) > settings.FILE_ARCHIVE_MAX_FILES:
+            return HttpResponseBadRequest()
+
+        files = UploadedFile.objects.in_bulk(keys)
+        if len(files) != len(set(keys)):
+            raise Http404()
+
+        # 指定された順に並べる(重複は除く)
+        files = [files[k] for k in dict.fromkeys(keys)]
+        cold = [f.key for f in files
+                if f.tier != UploadedFile.HOT and tiering.request_restore(f.key)]
+        if cold:
+            return restoring_response()
+        resp = StreamingHttpResponse(self.stream(files),
+                                     content_type='application/zip')
+        resp['Content-Disposition'] = 'attachment; filename="files.zip"'
         return resp
+
+    def stream(self, files):
+        storage = get_storage()
+        out = ZipStream()
+
+        with zipfile.ZipFile(out, 'w', compression=zipfile.ZIP_STORED) as zf:
+            for f, name in zip(files, archive_names(files)):
+                zinfo = zipfile.ZipInfo(
+                    name, timezone.localtime(f.last_modified).timetuple()[:6])
+                zinfo.compress_type = zipfile.ZIP_STORED
+                force_zip64 = f.size >= zipfile.ZIP64_LIMIT
+
+                body = storage.open(str(f.key))
+                try:
+                    src = compression.open_blob(body, f.encoding)
+                    with zf.open(zinfo, 'w', force_zip64=force_zip64) as dest:
+                        while chunk := src.read(settings.FILE_DOWNLOAD_BLOCK_SIZE):
+                            dest.write(chunk)
+                            yield out.drain()
+                finally:
+                    body.close()
+
+        # データ記述子と中央ディレクトリ
+        yield out.drain()
@@ -10,6 +10,8 @@ from django.core.exceptions import PermissionDenied, ObjectDoesNotExist, \
 from django.test import RequestFactory, TestCase
 from django.urls import reverse
 
+from sbts.core.synthetic import DataGenerator, copy_insert
+from sbts.core.test_utils import QueryGuardMixin
 from .templatetags.pretty_filters import pretty_nbytes
 from .views import TicketPageView, TicketView, TicketDetailPageView, \
     CommentView, FilePageView, FileView, TopPageView
@@ -1536,3 +1538,90 @@ class TopPageViewTest(TestCase):
         req.user = AnonymousUser()
         resp = TopPageView.as_view()(req)
         self.assertEqual(resp.status_code, 405)
+
+
+class PageQueryGuardTest(QueryGuardMixin, TestCase):
+    '''
+    ページのビューの問い合わせの回数がデータの量によらないこと、一覧
+    の問い合わせが索引を使えることを確認する。
+    '''
+
+    def setUp(self):
+        super().setUp()
+        self.req_factory = RequestFactory()
+
+    def seed(self, n):
+        gen = DataGenerator(seed=n, comment_max_length=100)
+        tickets = list(gen.tickets(n))
+        copy_insert(Ticket, tickets)
+        copy_insert(Comment, gen.comments([(t.key, t.created_at) for t in tickets], n * 10))
+        copy_insert(UploadedFile, gen.files(n))
+        return tickets
+
+    def get(self, view, **kwargs):
+        req = self.req_factory.get('/')
+        req.user = AnonymousUser()
+        resp = view.as_view()(req, **kwargs)
+        resp.render()
+        self.assertEqual(resp.status_code, 200)
+        return resp
+
+    def test_file_page_queries(self):
+        for n in [1, 50]:
+            with self.subTest(n=n):
+                self.seed(n)
+                with self.assertMaxQueries(1):
+                    self.get(FilePageView)
+
+    def test_ticket_page_queries(self):
+        '''
+        最終変更日をチケットごとに問い合わせない
+        '''
+
+        for n in [1, 50]:
+            with self.subTest(n=n):
+                self.seed(n)
+                with self.assertMaxQueries(1):
+                    self.get(TicketPageView)
+
+    def test_ticket_detail_page_queries(self):
+        for n in [1, 50]:
+            with self.subTest(n=n):
+                tickets = self.seed(n)
+                with self.assertMaxQueries(2):
+                    self.get(TicketDetailPageView, key=tickets[0].key)
+
+    def test_assert_max_queries(self):
+        with self.assertRaises(AssertionError):
+            with self.assertMaxQueries(1):
+                list(Ticket.objects.all())
+                list(Comment.objects.all())
+
+    def test_file_page_plan(self):
+        self.seed(50)
+        resp = self.get(FilePageView)
+        self.assertNoSeqScan(resp.context_data['file_list'],
+                             [UploadedFile._meta.db_table])
+
+    def test_ticket_page_plan(self):
+        self.seed(50)
+        resp = self.get(TicketPageView)
+        self.assertNoSeqScan(resp.context_data['ticket_list'],
+                             [Ticket._meta.db_table, Comment._meta.db_table])
+
+    def test_ticket_detail_page_plan(self):
+        tickets = self.seed(50)
+        resp = self.get(TicketDetailPageView, key=tickets[0].key)
+        self.assertNoSeqScan(Ticket.objects.filter(key=tickets[0].key),
+                             [Ticket._meta.db_table])
+        self.assertNoSeqScan(resp.context_data['comment_list'],
+                             [Comment._meta.db_table])
+
+    def test_assert_no_seqscan(self):
+        '''
+        索引のない列での絞り込みは失敗する
+        '''
+
+        with self.assertRaises(AssertionError):
+            self.assertNoSeqScan(Comment.objects.filter(username='shimon'),
+                                 [Comment._meta.db_table])
@@ -16,4 +16,5 @@ urlpatterns = [
     path('api/page/tickets/', TicketView.as_view(), name='ticket'),
     path('api/page/comments/', CommentView.as_view(), name='comment'),
     path('api/file/', include('sbts.file.urls')),
+    path('api/ticket/', include('sbts.ticket.urls')),
 ]
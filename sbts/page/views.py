@@ -41,6 +41,7 @@ class TopPageView(TemplateView):
 
 
 class FilePageView(BaseFilePageView):
+    replica_reads = True
     template_name = 'page/file.html'
 
     def get_context_data(self, **kwargs):
@@ -57,6 +58,8 @@ class FilePageView(BaseFilePageView):
 
 
 class FileView(LoginRequiredView):
+    pins_primary = True
+
     def post(self, request, *args, **kwargs):
         UploadedFile.objects.create_from_s3(
             key=request.POST['blobkey'],
@@ -68,15 +71,18 @@ class FileView(LoginRequiredView):
 
 
 class TicketPageView(BaseTicketPageView):
+    replica_reads = True
     template_name = 'page/ticket.html'
 
     def get_context_data(self, **kwargs):
         ctx = super().get_context_data(**kwargs)
-        ctx['ticket_list'] = Ticket.objects.sorted_tickets()
+        ctx['ticket_list'] = Ticket.objects.sorted_tickets_with_lastmod()
         return ctx
 
 
 class TicketView(LoginRequiredView):
+    pins_primary = True
+
     def post(self, request, *args, **kwargs):
         now = timezone.now()
         Ticket.objects.create_cleanly(key=uuid.uuid4(),
@@ -87,6 +93,7 @@ class TicketView(LoginRequiredView):
 
 
 class TicketDetailPageView(BaseTicketPageView):
+    replica_reads = True
     template_name = 'page/ticket_detail.html'
 
     def get_context_data(self, **kwargs):
@@ -99,6 +106,8 @@ class TicketDetailPageView(BaseTicketPageView):
 
 
 class CommentView(LoginRequiredView):
+    pins_primary = True
+
     def post(self, request, *args, **kwargs):
         now = timezone.now()
         t = Ticket.objects.get(key=request.POST['key'])
@@ -11,9 +11,11 @@ ALLOWED_HOSTS = []
 
 
 INSTALLED_APPS = [
+    'sbts.core.apps.CoreConfig',
     'sbts.page.apps.PageConfig',
     'sbts.file.apps.FileConfig',
     'sbts.ticket.apps.TicketConfig',
+    'sbts.task.apps.TaskConfig',
     'rest_framework',
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -23,15 +25,36 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'sbts.core.middleware.PerfMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'sbts.core.middleware.CompressionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'sbts.core.replica.ReplicaMiddleware',
+    'sbts.core.middleware.ProfileMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+COMPRESSION_CONTENT_TYPES = ['text/html', 'application/json']
+COMPRESSION_MIN_SIZE = 1024
+COMPRESSION_BROTLI_QUALITY = 5  # 既定の11は、動的なレスポンスには遅い
+PERF_SLOW_REQUEST_MS = 500
+PERF_SLOW_DB_QUERIES = 100
+PERF_LOG_SAMPLE_RATE = 0.0  # 遅くないリクエストを記録する割合
+PERF_LOG_MAX_SPANS = 100
+PERF_PROFILE_DIR = None  # 管理者がX-Profileヘッダーで計測を求めたときの出力先
+# 複数のプロセスで動かす場合は、プロセスごとのメトリクスを書き出すディ
+# レクトリを指定する
+METRICS_DIR = None
+METRICS_FLUSH_INTERVAL = 5.0
+# /metricsを読めるクライアントのアドレス(REMOTE_ADDR)。スタッフのユー
+# ザーは、どこからでも読める
+METRICS_ALLOWED_NETWORKS = os.environ.get(
+    'SBTS_METRICS_ALLOWED_NETWORKS', '127.0.0.1/32,::1/128').split(',')
+
 ROOT_URLCONF = 'sbts.public.urls'
 
 TEMPLATES = [
@@ -62,6 +85,18 @@ DATABASES = {
     }
 }
 
+# 読み取り専用のレプリカ。pg_service.confのサービス名を、
+# SBTS_DB_REPLICASにカンマ区切りで書く
+for service in os.environ.get('SBTS_DB_REPLICAS', '').split(','):
+    if service.strip():
+        DATABASES[f'replica_{service.strip()}'] = {
+            'ENGINE': 'django.db.backends.postgresql',
+            'OPTIONS': {
+                'service': service.strip(),
+            },
+        }
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+
 # TODO: Django 4.2ではテストでpg_service.confを利用できない。現状は、
 # 不完全な対処だが、回避策で直接設定している。
 # https://docs.djangoproject.com/en/4.2/ref/databases/#postgresql-connection-settings
@@ -75,8 +110,30 @@ if 'test' in sys.argv:
             'PASSWORD': 'pw',
             'HOST': 'pg',
             'PORT': 5432,
-        }
+        },
+        # 同じデータベースへの別の接続。レプリカのテストで
+        # DATABASE_REPLICASに入れて使う
+        'replica': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': 'postgres',
+            'USER': 'postgres',
+            'PASSWORD': 'pw',
+            'HOST': 'pg',
+            'PORT': 5432,
+            'TEST': {
+                'MIRROR': 'default',
+            },
+        },
     }
+    DATABASE_REPLICAS = []
+
+
+DATABASE_ROUTERS = ['sbts.core.replica.ReplicaRouter']
+DATABASE_REPLICA_APP_LABELS = ['file', 'ticket']  # レプリカから読むモデル
+DATABASE_REPLICA_CHECK_INTERVAL = 10  # 秒。レプリカを確かめる間隔
+DATABASE_REPLICA_RETRY_SECONDS = 30  # 使えなかったレプリカを選ばない時間
+DATABASE_REPLICA_MAX_LAG = 5  # 秒。これより遅れたレプリカは選ばない
+DATABASE_PRIMARY_PIN_SECONDS = 10  # POSTしたユーザーがプライマリから読む時間
 
 
 AUTH_PASSWORD_VALIDATORS = [
@@ -103,15 +160,102 @@ USE_TZ = True
 
 
 STATIC_URL = '/static/'
+# collectstaticの集め先。内容のハッシュを付けた名前のファイルと、前もっ
+# て圧縮した.gzと.brを置き、StaticViewが返す
+STATIC_ROOT = os.environ.get('SBTS_STATIC_ROOT', '/home/app/var/sbts/static')
+# ハッシュを付けた名前のファイルのCache-Control
+STATIC_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'sbts.core.staticfiles.CompressedManifestStaticFilesStorage',
+    },
+}
+# テストではcollectstaticしないので、マニフェストを使わない
+if 'test' in sys.argv:
+    STORAGES['staticfiles'] = {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    }
 
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 
+# ブロブの保存先。SBTS_FILE_STORAGE=localなら、S3を使わずに
+# FILE_STORAGE_DIRに保存する
+FILE_STORAGE = {
+    's3': 'sbts.file.storage.S3Storage',
+    'local': 'sbts.file.storage.LocalStorage',
+}[os.environ.get('SBTS_FILE_STORAGE', 's3')]
+FILE_STORAGE_DIR = os.environ.get('SBTS_FILE_STORAGE_DIR', '/home/app/var/sbts/blobs')
 S3_BUCKET_FILE = 'sbtsfile'
-S3_ENDPOINT = os.environ['SBTS_S3_ENDPOINT']
-S3_CHUNK_SIZE = 8 * (1024 ** 2)  # 8MiB
+# アーカイブしたブロブを移すバケット。Noneなら移さずにストレージクラ
+# スだけ変える
+S3_BUCKET_FILE_COLD = 'sbtsfilecold'
+S3_ENDPOINT = os.environ.get('SBTS_S3_ENDPOINT')
+S3_CHUNK_SIZE = 8 * (1024 ** 2)  # 8MiB。ローカルに保存するときも、この大きさずつ書く
+S3_MAX_POOL_CONNECTIONS = 16
 S3_INVALID_ENDPOINT = 'http://invalid:9000'  # for tests
+FILE_DOWNLOAD_BLOCK_SIZE = 1024 ** 2  # 1MiB
+# FILE_DOWNLOAD_PREFETCH_MIN_SIZE以上のブロブは、BLOCK_SIZEずつの範囲
+# に分けて、DEPTH個先まで並行して読む。DEPTHが0なら先読みしない。
+# MinIOやS3で測って速くなると確かめるまでは、先読みしない
+FILE_DOWNLOAD_PREFETCH_MIN_SIZE = 32 * (1024 ** 2)  # 32MiB
+FILE_DOWNLOAD_PREFETCH_BLOCK_SIZE = 8 * (1024 ** 2)  # 8MiB
+FILE_DOWNLOAD_PREFETCH_DEPTH = 0
+# BlobViewの送信を前段のWebサーバーに任せる。Noneなら任せない。
+# 'x-accel-redirect'(nginx)か'x-sendfile'(Apacheのmod_xsendfileなど)
+FILE_DOWNLOAD_OFFLOAD = None
+# X-Accel-Redirectの先。nginxのinternalなlocationで、ローカルの保存先
+# のディレクトリと、S3への中継にする
+FILE_DOWNLOAD_ACCEL_LOCAL_PREFIX = '/_blobs/'
+FILE_DOWNLOAD_ACCEL_S3_PREFIX = '/_s3/'
+FILE_DOWNLOAD_PRESIGN_EXPIRES = 60
+# S3のブロブを、読まれたときにFILE_CACHE_DIRにコピーしておき、次から
+# はそこから返す。Noneならキャッシュしない。全体がMAX_SIZEを超えたら、
+# 使ったのが古い順に消す
+FILE_CACHE_DIR = os.environ.get('SBTS_FILE_CACHE_DIR')
+FILE_CACHE_MAX_SIZE = 10 * (1024 ** 3)  # 10GiB
+FILE_CACHE_MAX_FILE_SIZE = 1024 ** 3  # 1GiB。これより大きいブロブはキャッシュしない
+# BlobViewが使うUploadedFileの属性を、プロセスごとにSIZE件まで覚えて
+# おく。0なら覚えない。ないキーは、他のプロセスで作られることがあるの
+# で、NEGATIVE_TTLだけ覚える
+FILE_METADATA_CACHE_SIZE = 10000
+FILE_METADATA_CACHE_TTL = 60  # 秒
+FILE_METADATA_CACHE_NEGATIVE_TTL = 5  # 秒
+# move_cold_blobsで、COLD_AFTER_DAYS日ダウンロードされていないブロブ
+# を安い保存先に移す。S3ではS3_BUCKET_FILE_COLDに移してストレージク
+# ラスをCOLD_STORAGE_CLASSにし、ローカルではCOLD_STORAGE_DIR(Noneなら
+# 保存先の.cold)に移す。COLD_STORAGE_CLASSがNoneならストレージクラスは
+# 変えない。MinIOは'GLACIER'などを受け付けないので、AWSでだけ設定する
+FILE_COLD_AFTER_DAYS = 180
+FILE_COLD_STORAGE_CLASS = os.environ.get('SBTS_FILE_COLD_STORAGE_CLASS') or None
+FILE_COLD_STORAGE_DIR = os.environ.get('SBTS_FILE_COLD_STORAGE_DIR')
+# 移したブロブがダウンロードされたら、ジョブで戻し、それまでは202を返
+# す。S3では、RESTORE_DAYS日だけ一時的に読めるようにしてからコピーし
+# 直すので、戻し終えたかをPOLL_INTERVAL秒ごとに確かめる
+FILE_RESTORE_TIER = 'Standard'
+FILE_RESTORE_DAYS = 7
+FILE_RESTORE_POLL_INTERVAL = 15 * 60
+FILE_RESTORE_RETRY_AFTER = 60
+# 最後にダウンロードされた日時は、この秒数ごとにしか書かない
+FILE_LAST_ACCESSED_RESOLUTION = 24 * 60 * 60
+FILE_ARCHIVE_MAX_FILES = 100
+FILE_COMPRESSION = True
+FILE_COMPRESSION_LEVEL = 6
+FILE_COMPRESSION_MIN_SIZE = 1024
+FILE_COMPRESSION_SAMPLE_SIZE = 64 * 1024  # 64KiB
+FILE_COMPRESSION_MAX_RATIO = 0.8  # 試しに圧縮して、これより縮まなければそのまま保存
+FILE_PREVIEW_THUMBNAIL_SIZE = (256, 256)
+FILE_PREVIEW_IMAGE_MAX_SIZE = 32 * (1024 ** 2)  # 32MiB
+FILE_PREVIEW_TEXT_SIZE = 4096
+FILE_PREVIEW_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# ブロブはキーごとに変わらないので、共有キャッシュにも長期間置かせる。
+# CDNなどに置かせないなら'private, max-age=31536000, immutable'にする
+FILE_BLOB_CACHE_CONTROL = 'public, max-age=31536000, immutable'
 
 
 # TODO: テスト時は無効にすべき。現状は、不完全だが回避策的な分岐をして
@@ -120,10 +264,27 @@ if 'test' not in sys.argv:
     LOGGING = {
         'version': 1,
         'disable_existing_loggers': False,
+        'formatters': {
+            # 1行のJSONをそのまま書く
+            'message': {
+                'format': '%(message)s',
+            },
+        },
         'handlers': {
             'console': {
                 'class': 'logging.StreamHandler'
-            }
+            },
+            'perf': {
+                'class': 'logging.StreamHandler',
+                'formatter': 'message',
+            },
+        },
+        'loggers': {
+            'sbts.perf': {
+                'handlers': ['perf'],
+                'level': 'INFO',
+                'propagate': False,
+            },
         },
         'root': {
             'handlers': ['console'],
@@ -153,6 +314,21 @@ REST_FRAMEWORK = {
     'COMPACT_JSON': False,
     'EXCEPTION_HANDLER': 'sbts.public.utils.uncaught_exception_handler',
 }
+API_BULK_CREATE_MAX_ITEMS = 1000
+TICKET_EXPORT_CHUNK_SIZE = 2000
+
+
+TASK_MAX_ATTEMPTS = 5
+TASK_RETRY_BACKOFF = 10  # 秒。失敗するたびに2倍
+TASK_RETRY_BACKOFF_MAX = 3600
+TASK_VISIBILITY_TIMEOUT = 300
+TASK_POLL_INTERVAL = 1.0
+
+
+# ticket_commentの月ごとのパーティションを、MONTHS_AHEAD月先まで前もっ
+# て作っておく。ワーカーがINTERVAL秒ごとに確かめる
+COMMENT_PARTITION_MONTHS_AHEAD = 3
+COMMENT_PARTITION_INTERVAL = 24 * 60 * 60
 
 
 TOPPAGE_TEXT = 'トップページ'
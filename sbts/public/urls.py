@@ -1,6 +1,12 @@
+from django.conf import settings
 from django.urls import include, path
 
+from sbts.core.views import MetricsView, StaticView
+
 
 urlpatterns = [
     path('', include('sbts.page.urls')),
+    path('metrics', MetricsView.as_view(), name='metrics'),
+    path(f'{settings.STATIC_URL.lstrip("/")}<path:path>', StaticView.as_view(),
+         name='static'),
 ]
@@ -0,0 +1,11 @@
+from django.apps import AppConfig
+from django.utils.module_loading import autodiscover_modules
+
+
+class TaskConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'sbts.task'
+
+    def ready(self):
+        # 各アプリのtasksモジュールで@taskを登録する
+        autodiscover_modules('tasks')
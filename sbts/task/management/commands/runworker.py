@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+import signal
+import time
+
+from sbts.task.tasks import run_one
+
+
+class Command(BaseCommand):
+    help = 'ジョブを取り出して実行し続ける。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--burst', action='store_true',
+                            help='実行できるジョブがなくなったら終了する')
+
+    def handle(self, *args, **options):
+        self.stopping = False
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        while not self.stopping:
+            # リクエストの前後と同じように、古くなった接続を閉じる
+            close_old_connections()
+            if run_one():
+                continue
+            if options['burst']:
+                break
+            time.sleep(settings.TASK_POLL_INTERVAL)
+
+    def stop(self, signum, frame):
+        # 実行中のジョブは最後まで実行してから終了する
+        self.stopping = True
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.7 on 2026-10-19 17:20
+
+from django.db import migrations, models
+import sbts.core.models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('key', models.UUIDField(default=uuid.uuid4, primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=255)),
+                ('args', models.JSONField(blank=True)),
+                ('status', models.IntegerField(choices=[(0, 'Pending'), (1, 'Running'), (2, 'Failed')])),
+                ('attempts', models.IntegerField(default=0)),
+                ('max_attempts', models.IntegerField()),
+                ('run_at', models.DateTimeField()),
+                ('locked_until', models.DateTimeField(blank=True, default=None, null=True)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField()),
+            ],
+            options={
+                'default_manager_name': 'objects',
+                'indexes': [models.Index(fields=['status', 'run_at'], name='task_job_status_run_at_idx')],
+            },
+            bases=(models.Model, sbts.core.models.CleanOpeModelMixin),
+        ),
+    ]
@@ -0,0 +1,125 @@
+from django.conf import settings
+from django.db import models, transaction
+from django.utils import timezone
+
+import datetime
+import uuid
+
+from sbts.core.models import CleanOpeManagerMixin, CleanOpeModelMixin
+
+
+class Job(models.Model, CleanOpeModelMixin):
+    '''
+    ワーカー(manage.py runworker)が実行する処理。呼び出し側のトランザ
+    クション内で登録すれば、その変更と一緒に確定する。
+    '''
+
+    class Manager(models.Manager, CleanOpeManagerMixin):
+        def enqueue(self, name, args, delay=0):
+            now = timezone.now()
+            return self.create_cleanly(
+                name=name,
+                args=args,
+                status=Job.PENDING,
+                max_attempts=settings.TASK_MAX_ATTEMPTS,
+                run_at=now + datetime.timedelta(seconds=delay),
+                created_at=now)
+
+        def claim(self):
+            '''
+            実行できるジョブを1つ取り出して実行中にする。なければNone。
+
+            実行中のまま可視性タイムアウトを過ぎたジョブは、ワーカーが
+            落ちたものとみなして再び取り出す。試行回数の上限に達してい
+            れば、ワーカーごと落とすジョブを繰り返さないように、失敗と
+            して残す。SKIP LOCKEDで、他のワーカーが取り出し中の行は待
+            たずに飛ばす。
+            '''
+
+            now = timezone.now()
+            with transaction.atomic():
+                while True:
+                    job = self.select_for_update(skip_locked=True).filter(
+                        models.Q(status=Job.PENDING, run_at__lte=now)
+                        | models.Q(status=Job.RUNNING, locked_until__lte=now)
+                    ).order_by('run_at').first()
+                    if job is None:
+                        return None
+                    if job.status == Job.PENDING or job.attempts < job.max_attempts:
+                        break
+                    job.status = Job.FAILED
+                    job.locked_until = None
+                    job.last_error = 'visibility timeout exceeded'
+                    job.save_cleanly()
+
+                job.status = Job.RUNNING
+                job.attempts += 1
+                job.locked_until = now + datetime.timedelta(
+                    seconds=settings.TASK_VISIBILITY_TIMEOUT)
+                job.save_cleanly()
+                return job
+
+    class Meta:
+        default_manager_name = 'objects'
+        indexes = [
+            models.Index(fields=['status', 'run_at'], name='task_job_status_run_at_idx'),
+        ]
+
+    objects = Manager()
+
+    PENDING = 0
+    RUNNING = 1
+    FAILED = 2
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (FAILED, 'Failed'),
+    ]
+
+    key = models.UUIDField(primary_key=True, default=uuid.uuid4)
+    name = models.CharField(max_length=255)
+    args = models.JSONField(blank=True)
+    status = models.IntegerField(choices=STATUS_CHOICES)
+    attempts = models.IntegerField(default=0)
+    max_attempts = models.IntegerField()
+    run_at = models.DateTimeField()
+    locked_until = models.DateTimeField(null=True, blank=True, default=None)
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField()
+
+    def leased(self):
+        '''
+        このワーカーが取り出したままのジョブ。可視性タイムアウトを過ぎ
+        て他のワーカーが取り出し直していれば、attemptsが変わっている。
+        '''
+
+        return Job.objects.filter(key=self.key, status=Job.RUNNING, attempts=self.attempts)
+
+    def finish(self):
+        '''
+        成功したジョブを消す。他のワーカーが取り出し直していれば、そち
+        らに任せて何もしない。
+        '''
+
+        return self.leased().delete()[0] > 0
+
+    def retry_or_fail(self, error):
+        '''
+        失敗したジョブを、指数的に間隔をあけて再実行する。試行回数の上
+        限に達したら失敗として残す。他のワーカーが取り出し直していれば、
+        何もしない。
+        '''
+
+        self.last_error = error
+        self.locked_until = None
+        if self.attempts >= self.max_attempts:
+            self.status = Job.FAILED
+        else:
+            backoff = min(settings.TASK_RETRY_BACKOFF * 2 ** (self.attempts - 1),
+                          settings.TASK_RETRY_BACKOFF_MAX)
+            self.status = Job.PENDING
+            self.run_at = timezone.now() + datetime.timedelta(seconds=backoff)
+        self.full_clean()
+        return self.leased().update(
+            status=self.status, run_at=self.run_at,
+            locked_until=None, last_error=error) > 0
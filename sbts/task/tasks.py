@@ -0,0 +1,45 @@
+'''
+ジョブとして実行する関数の登録。
+'''
+
+import logging
+import traceback
+
+from .models import Job
+
+
+logger = logging.getLogger(__name__)
+
+registry = {}
+
+
+def task(func):
+    '''
+    関数をジョブとして登録する。func.enqueue(**kwargs)で、呼び出しを
+    ジョブとして登録できる。引数はJSONにできる値に限る。
+    '''
+
+    name = f'{func.__module__}.{func.__qualname__}'
+    registry[name] = func
+    func.task_name = name
+    func.enqueue = lambda **kwargs: Job.objects.enqueue(name, kwargs)
+    return func
+
+
+def run_one():
+    '''
+    ジョブを1つ実行する。実行できるジョブがなければFalseを返す。
+    '''
+
+    job = Job.objects.claim()
+    if job is None:
+        return False
+
+    try:
+        registry[job.name](**job.args)
+    except Exception:
+        logger.exception('job %s (%s) failed', job.key, job.name)
+        job.retry_or_fail(traceback.format_exc())
+    else:
+        job.finish()
+    return True
@@ -0,0 +1,148 @@
+import datetime
+
+from django.db.models import F
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from .models import Job
+from .tasks import run_one, task
+
+
+calls = []
+
+
+@task
+def record(value):
+    calls.append(value)
+
+
+@task
+def fail(value):
+    raise RuntimeError(value)
+
+
+class JobTest(TestCase):
+    def setUp(self):
+        super().setUp()
+        calls.clear()
+
+    def test_enqueue_and_run(self):
+        job = record.enqueue(value='a')
+        self.assertEqual(job.name, 'sbts.task.tests.record')
+        self.assertEqual(job.status, Job.PENDING)
+
+        self.assertTrue(run_one())
+        self.assertEqual(calls, ['a'])
+        # 成功したジョブは消える
+        self.assertQuerySetEqual(Job.objects.all(), [])
+
+    def test_empty(self):
+        self.assertFalse(run_one())
+
+    def test_order(self):
+        '''
+        実行予定日時の早い順に実行する
+        '''
+
+        j1 = record.enqueue(value='a')
+        j2 = record.enqueue(value='b')
+        Job.objects.filter(key=j2.key).update(run_at=j1.run_at - datetime.timedelta(seconds=1))
+
+        self.assertTrue(run_one())
+        self.assertTrue(run_one())
+        self.assertFalse(run_one())
+        self.assertEqual(calls, ['b', 'a'])
+
+    def test_not_yet(self):
+        '''
+        実行予定日時より前には実行しない
+        '''
+
+        job = record.enqueue(value='a')
+        Job.objects.filter(key=job.key).update(run_at=timezone.now() + datetime.timedelta(minutes=1))
+
+        self.assertFalse(run_one())
+        self.assertEqual(calls, [])
+
+    @override_settings(TASK_RETRY_BACKOFF=10, TASK_MAX_ATTEMPTS=3)
+    def test_retry(self):
+        '''
+        失敗したら間隔を倍にしながら再実行し、上限に達したら失敗として
+        残す
+        '''
+
+        job = fail.enqueue(value='oops')
+
+        before = timezone.now()
+        self.assertTrue(run_one())
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.PENDING)
+        self.assertEqual(job.attempts, 1)
+        self.assertIn('RuntimeError: oops', job.last_error)
+        self.assertGreaterEqual(job.run_at, before + datetime.timedelta(seconds=10))
+        self.assertFalse(run_one())
+
+        Job.objects.filter(key=job.key).update(run_at=timezone.now())
+        before = timezone.now()
+        self.assertTrue(run_one())
+        job.refresh_from_db()
+        self.assertEqual(job.attempts, 2)
+        self.assertGreaterEqual(job.run_at, before + datetime.timedelta(seconds=20))
+
+        Job.objects.filter(key=job.key).update(run_at=timezone.now())
+        self.assertTrue(run_one())
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertEqual(job.attempts, 3)
+        self.assertFalse(run_one())
+
+    def test_visibility_timeout(self):
+        '''
+        実行中のまま可視性タイムアウトを過ぎたジョブは、再び取り出す
+        '''
+
+        job = record.enqueue(value='a')
+        claimed = Job.objects.claim()
+        self.assertEqual(claimed.key, job.key)
+        self.assertEqual(claimed.status, Job.RUNNING)
+        self.assertIsNone(Job.objects.claim())
+
+        Job.objects.filter(key=job.key).update(locked_until=timezone.now())
+        self.assertTrue(run_one())
+        self.assertEqual(calls, ['a'])
+
+    @override_settings(TASK_MAX_ATTEMPTS=2)
+    def test_visibility_timeout_max_attempts(self):
+        '''
+        ワーカーごと落ちたジョブは、試行回数の上限に達したら失敗として
+        残す
+        '''
+
+        job = record.enqueue(value='a')
+        for _ in range(2):
+            self.assertEqual(Job.objects.claim().key, job.key)
+            Job.objects.filter(key=job.key).update(locked_until=timezone.now())
+
+        self.assertFalse(run_one())
+        self.assertEqual(calls, [])
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertEqual(job.attempts, 2)
+
+    def test_lost_lease(self):
+        '''
+        他のワーカーが取り出し直したジョブは、消したり書き換えたりしない
+        '''
+
+        job = record.enqueue(value='a')
+        claimed = Job.objects.claim()
+        Job.objects.filter(key=job.key).update(attempts=F('attempts') + 1)
+
+        self.assertFalse(claimed.finish())
+        self.assertFalse(claimed.retry_or_fail('oops'))
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.RUNNING)
+        self.assertEqual(job.attempts, 2)
+        self.assertEqual(job.last_error, '')
+        # 取り出し直したワーカーは消せる
+        self.assertTrue(job.finish())
@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from sbts.ticket.partitions import create_partitions
+from sbts.ticket.tasks import schedule_partitions
+
+
+class Command(BaseCommand):
+    help = ('先の月のコメントのパーティションを作る。そのあとはワーカー'
+            'が定期的に作るように、ジョブを登録する。')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months', type=int,
+                            default=settings.COMMENT_PARTITION_MONTHS_AHEAD,
+                            help='今月から何か月先まで作るか')
+        parser.add_argument('--no-schedule', action='store_true',
+                            help='ジョブを登録しない')
+
+    def handle(self, *args, **options):
+        for name in create_partitions(options['months']):
+            self.stdout.write(f'created {name}')
+        if not options['no_schedule']:
+            schedule_partitions(delay=settings.COMMENT_PARTITION_INTERVAL)
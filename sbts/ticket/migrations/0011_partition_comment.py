@@ -0,0 +1,128 @@
+import datetime
+
+from django.db import migrations
+
+
+# sbts.ticket.partitionsを変えてもこのマイグレーションの結果が変わら
+# ないように、必要なものを写しておく
+
+TABLE = 'ticket_comment'
+OLD_TABLE = 'ticket_comment_old'
+DEFAULT_PARTITION = 'ticket_comment_default'
+MONTHS_AHEAD = 3
+
+
+def month_start(dt):
+    dt = dt.astimezone(datetime.timezone.utc)
+    return datetime.datetime(dt.year, dt.month, 1, tzinfo=datetime.timezone.utc)
+
+
+def next_month(start):
+    if start.month == 12:
+        return start.replace(year=start.year + 1, month=1)
+    return start.replace(month=start.month + 1)
+
+
+def months(first, last):
+    start = month_start(first)
+    while start <= last:
+        yield start
+        start = next_month(start)
+
+
+def future_month(now, months_ahead):
+    start = month_start(now)
+    for _ in range(months_ahead):
+        start = next_month(start)
+    return start
+
+
+def rebuild(connection, partitioned):
+    '''
+    ticket_commentを作り直し、partitionedなら月ごとのパーティションに、
+    そうでなければ普通のテーブルにする。主キー以外の制約、索引、トリ
+    ガーは、PostgreSQLが出力した定義のまま作り直す。
+    '''
+
+    qn = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT conname, contype, pg_get_constraintdef(oid) FROM pg_constraint "
+            "WHERE conrelid = %s::regclass AND contype <> 'n' ORDER BY conname",
+            [TABLE])
+        constraints = cursor.fetchall()
+        cursor.execute(
+            'SELECT c.relname, pg_get_indexdef(i.indexrelid) '
+            'FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid '
+            'WHERE i.indrelid = %s::regclass AND NOT EXISTS ('
+            '  SELECT FROM pg_constraint WHERE conrelid = i.indrelid AND conindid = i.indexrelid) '
+            'ORDER BY c.relname',
+            [TABLE])
+        indexes = [(name, definition.replace(' ON ONLY ', ' ON ', 1))
+                   for name, definition in cursor.fetchall()]
+        cursor.execute(
+            'SELECT tgname, pg_get_triggerdef(oid) FROM pg_trigger '
+            'WHERE tgrelid = %s::regclass AND NOT tgisinternal ORDER BY tgname',
+            [TABLE])
+        triggers = cursor.fetchall()
+
+        for name, _ in indexes:
+            cursor.execute(f'DROP INDEX {qn(name)}')
+        for name, _, _ in constraints:
+            cursor.execute(f'ALTER TABLE {TABLE} DROP CONSTRAINT {qn(name)}')
+
+        cursor.execute(f'ALTER TABLE {TABLE} RENAME TO {OLD_TABLE}')
+        cursor.execute(
+            f'CREATE TABLE {TABLE} (LIKE {OLD_TABLE} INCLUDING DEFAULTS)'
+            + (' PARTITION BY RANGE (created_at)' if partitioned else ''))
+
+        pk_columns = ['key', 'created_at'] if partitioned else ['key']
+        for name, contype, definition in constraints:
+            if contype == 'p':
+                definition = f'PRIMARY KEY ({", ".join(qn(col) for col in pk_columns)})'
+            cursor.execute(f'ALTER TABLE {TABLE} ADD CONSTRAINT {qn(name)} {definition}')
+        for _, definition in indexes:
+            cursor.execute(definition)
+
+        if partitioned:
+            cursor.execute(f'CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {TABLE} DEFAULT')
+            cursor.execute(f'SELECT min(created_at) FROM {OLD_TABLE}')
+            first, = cursor.fetchone()
+            now = datetime.datetime.now(datetime.timezone.utc)
+            for start in months(min(first or now, now), future_month(now, MONTHS_AHEAD)):
+                cursor.execute(
+                    f'CREATE TABLE {TABLE}_p{start:%Y%m} PARTITION OF {TABLE} '
+                    f"FOR VALUES FROM ('{start.isoformat()}') "
+                    f"TO ('{next_month(start).isoformat()}')")
+
+        cursor.execute(f'INSERT INTO {TABLE} SELECT * FROM {OLD_TABLE}')
+        for _, definition in triggers:
+            cursor.execute(definition)
+        cursor.execute(f'DROP TABLE {OLD_TABLE}')
+
+
+def partition(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    rebuild(schema_editor.connection, partitioned=True)
+
+
+def unpartition(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    rebuild(schema_editor.connection, partitioned=False)
+
+
+class Migration(migrations.Migration):
+    '''
+    ticket_commentを、created_atで月ごとに範囲パーティションにする。
+    行をすべて写すので、大きなテーブルでは書き込みを止めて実行する。
+    '''
+
+    dependencies = [
+        ('ticket', '0010_ticket_comment_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition, unpartition),
+    ]
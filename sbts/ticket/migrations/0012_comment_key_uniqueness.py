@@ -0,0 +1,86 @@
+from django.db import migrations
+
+
+# パーティションにしたticket_commentの主キーは(key, created_at)なの
+# で、keyだけの一意性はticket_comment_keyで確かめる。行を入れたり消し
+# たりするトリガーで、ticket_commentのkeyと同じものを持たせる
+FORWARD = [
+    'CREATE TABLE ticket_comment_key (key uuid PRIMARY KEY)',
+    'INSERT INTO ticket_comment_key SELECT key FROM ticket_comment',
+    '''
+    CREATE FUNCTION ticket_comment_key_insert() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        INSERT INTO ticket_comment_key VALUES (NEW.key);
+        RETURN NULL;
+    END
+    $$
+    ''',
+    '''
+    CREATE FUNCTION ticket_comment_key_delete() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        DELETE FROM ticket_comment_key WHERE key = OLD.key;
+        RETURN NULL;
+    END
+    $$
+    ''',
+    '''
+    CREATE FUNCTION ticket_comment_key_update() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        UPDATE ticket_comment_key SET key = NEW.key WHERE key = OLD.key;
+        RETURN NULL;
+    END
+    $$
+    ''',
+    '''
+    CREATE FUNCTION ticket_comment_key_truncate() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        TRUNCATE ticket_comment_key;
+        RETURN NULL;
+    END
+    $$
+    ''',
+    'CREATE TRIGGER ticket_comment_key_insert AFTER INSERT ON ticket_comment '
+    'FOR EACH ROW EXECUTE FUNCTION ticket_comment_key_insert()',
+    'CREATE TRIGGER ticket_comment_key_delete AFTER DELETE ON ticket_comment '
+    'FOR EACH ROW EXECUTE FUNCTION ticket_comment_key_delete()',
+    'CREATE TRIGGER ticket_comment_key_update AFTER UPDATE OF key ON ticket_comment '
+    'FOR EACH ROW WHEN (OLD.key <> NEW.key) EXECUTE FUNCTION ticket_comment_key_update()',
+    'CREATE TRIGGER ticket_comment_key_truncate AFTER TRUNCATE ON ticket_comment '
+    'FOR EACH STATEMENT EXECUTE FUNCTION ticket_comment_key_truncate()',
+]
+
+BACKWARD = [
+    'DROP TRIGGER ticket_comment_key_truncate ON ticket_comment',
+    'DROP TRIGGER ticket_comment_key_update ON ticket_comment',
+    'DROP TRIGGER ticket_comment_key_delete ON ticket_comment',
+    'DROP TRIGGER ticket_comment_key_insert ON ticket_comment',
+    'DROP FUNCTION ticket_comment_key_truncate()',
+    'DROP FUNCTION ticket_comment_key_update()',
+    'DROP FUNCTION ticket_comment_key_delete()',
+    'DROP FUNCTION ticket_comment_key_insert()',
+    'DROP TABLE ticket_comment_key',
+]
+
+
+def run(statements):
+    def apply(apps, schema_editor):
+        if schema_editor.connection.vendor != 'postgresql':
+            return
+        for sql in statements:
+            schema_editor.execute(sql)
+    return apply
+
+
+class Migration(migrations.Migration):
+    '''
+    パーティションにしたticket_commentでも、keyの重複をデータベース
+    で防ぐ。モデルの検査だけでは、同時に同じkeyを入れると防げない。
+    '''
+
+    dependencies = [
+        ('ticket', '0011_partition_comment'),
+    ]
+
+    operations = [
+        migrations.RunPython(run(FORWARD), run(BACKWARD)),
+    ]
@@ -0,0 +1,202 @@
+'''
+コメント(ticket_comment)の、created_atでの月ごとの範囲パーティション。
+
+PostgreSQLの宣言的パーティションでは、主キーにパーティションキーを含
+める必要があるので、主キーは(key, created_at)にする。Djangoからはこれ
+まで通りkeyを主キーとして扱う。keyの一意性は、モデルの検査に加えて、
+トリガーで同じkeyを持たせるticket_comment_keyの主キーで確かめる。
+
+月ごとのパーティションはticket_comment_pYYYYMMで、どれにも入らない行
+はticket_comment_defaultに入る。create_partitionsで、先の月のパーティ
+ションを前もって作っておく。デフォルトのパーティションに入った行があ
+れば、作るときに移す。
+'''
+
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+import datetime
+
+
+TABLE = 'ticket_comment'
+OLD_TABLE = 'ticket_comment_old'
+DEFAULT_PARTITION = 'ticket_comment_default'
+KEY_TABLE = 'ticket_comment_key'
+
+
+def month_start(dt):
+    dt = dt.astimezone(datetime.timezone.utc)
+    return datetime.datetime(dt.year, dt.month, 1, tzinfo=datetime.timezone.utc)
+
+
+def next_month(start):
+    if start.month == 12:
+        return start.replace(year=start.year + 1, month=1)
+    return start.replace(month=start.month + 1)
+
+
+def months(first, last):
+    '''
+    firstの月からlastの月までの、各月の初めの日時。
+    '''
+
+    start = month_start(first)
+    while start <= last:
+        yield start
+        start = next_month(start)
+
+
+def future_month(now, months_ahead):
+    start = month_start(now)
+    for _ in range(months_ahead):
+        start = next_month(start)
+    return start
+
+
+def partition_name(start):
+    return f'{TABLE}_p{start:%Y%m}'
+
+
+def bounds(start):
+    return (f"FOR VALUES FROM ('{start.isoformat()}') "
+            f"TO ('{next_month(start).isoformat()}')")
+
+
+def is_partitioned(cursor):
+    cursor.execute(
+        'SELECT EXISTS (SELECT FROM pg_partitioned_table WHERE partrelid = %s::regclass)',
+        [TABLE])
+    return cursor.fetchone()[0]
+
+
+def partitions(cursor):
+    cursor.execute(
+        'SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+        'WHERE i.inhparent = %s::regclass ORDER BY c.relname',
+        [TABLE])
+    return [name for name, in cursor.fetchall()]
+
+
+def create_partitions(months_ahead, now=None, using=DEFAULT_DB_ALIAS):
+    '''
+    今月からmonths_ahead月先までの、まだないパーティションを作り、作っ
+    たパーティションの名前を返す。パーティションにしていなければ何も
+    しない。
+    '''
+
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    last = future_month(now, months_ahead)
+    created = []
+    conn = connections[using]
+    with conn.cursor() as cursor:
+        if not is_partitioned(cursor):
+            return created
+        for start in months(now, last):
+            name = partition_name(start)
+            with transaction.atomic(using=using):
+                # 起動時のコマンドとワーカーのジョブが同時に作ることがあ
+                # るので、ロックを取ってから確かめる
+                cursor.execute('SELECT pg_advisory_xact_lock(%s::regclass::oid::bigint)',
+                               [TABLE])
+                if name in partitions(cursor):
+                    continue
+                attach_partition(cursor, start)
+            created.append(name)
+    return created
+
+
+def attach_partition(cursor, start):
+    '''
+    startの月のパーティションを作る。デフォルトのパーティションにその
+    月の行があれば、移してから付ける。
+    '''
+
+    name = partition_name(start)
+    cursor.execute(f'CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS)')
+    cursor.execute(
+        f'WITH moved AS (DELETE FROM {DEFAULT_PARTITION} '
+        f'WHERE created_at >= %s AND created_at < %s RETURNING *) '
+        f'INSERT INTO {name} SELECT * FROM moved',
+        [start, next_month(start)])
+    # 付ける前のテーブルにはトリガーがないので、消したときに
+    # KEY_TABLEから消えたkeyを入れ直す
+    cursor.execute(f'INSERT INTO {KEY_TABLE} SELECT key FROM {name}')
+    cursor.execute(f'ALTER TABLE {TABLE} ATTACH PARTITION {name} {bounds(start)}')
+
+
+def definitions(cursor):
+    '''
+    ticket_commentの、主キー以外の制約、制約によらない索引、トリガー
+    を、(名前, 作るSQL)のリストで返す。作るSQLはPostgreSQLが出力した
+    ものなので、演算子クラスや部分索引の条件もそのまま作り直せる。
+    '''
+
+    # NOT NULLはCREATE TABLE ... LIKEで写す
+    cursor.execute(
+        "SELECT conname, contype, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE conrelid = %s::regclass AND contype <> 'n' ORDER BY conname",
+        [TABLE])
+    constraints = cursor.fetchall()
+    cursor.execute(
+        'SELECT c.relname, pg_get_indexdef(i.indexrelid) '
+        'FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid '
+        'WHERE i.indrelid = %s::regclass AND NOT EXISTS ('
+        '  SELECT FROM pg_constraint WHERE conrelid = i.indrelid AND conindid = i.indexrelid) '
+        'ORDER BY c.relname',
+        [TABLE])
+    # パーティションの索引はON ONLYで出力されるが、作り直すときは各
+    # パーティションにも作る
+    indexes = [(name, definition.replace(' ON ONLY ', ' ON ', 1))
+               for name, definition in cursor.fetchall()]
+    cursor.execute(
+        'SELECT tgname, pg_get_triggerdef(oid) FROM pg_trigger '
+        'WHERE tgrelid = %s::regclass AND NOT tgisinternal ORDER BY tgname',
+        [TABLE])
+    triggers = cursor.fetchall()
+    return constraints, indexes, triggers
+
+
+def rebuild(connection, partitioned, months_ahead=3):
+    '''
+    ticket_commentを作り直し、partitionedなら月ごとのパーティションに、
+    そうでなければ普通のテーブルにする。主キー以外の制約、索引、トリ
+    ガーは同じ名前と定義で作り直し、行は新しいテーブルに写す。パーティ
+    ションにできない制約(created_atを含まない一意制約など)があれば、
+    PostgreSQLのエラーで失敗する。マイグレーションとベンチマーク用。
+    '''
+
+    qn = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        constraints, indexes, triggers = definitions(cursor)
+        # 新しいテーブルで同じ名前を使うために、先に消す
+        for name, _ in indexes:
+            cursor.execute(f'DROP INDEX {qn(name)}')
+        for name, _, _ in constraints:
+            cursor.execute(f'ALTER TABLE {TABLE} DROP CONSTRAINT {qn(name)}')
+
+        cursor.execute(f'ALTER TABLE {TABLE} RENAME TO {OLD_TABLE}')
+        cursor.execute(
+            f'CREATE TABLE {TABLE} (LIKE {OLD_TABLE} INCLUDING DEFAULTS)'
+            + (' PARTITION BY RANGE (created_at)' if partitioned else ''))
+
+        pk_columns = ['key', 'created_at'] if partitioned else ['key']
+        for name, contype, definition in constraints:
+            if contype == 'p':
+                definition = f'PRIMARY KEY ({", ".join(qn(col) for col in pk_columns)})'
+            cursor.execute(f'ALTER TABLE {TABLE} ADD CONSTRAINT {qn(name)} {definition}')
+        for _, definition in indexes:
+            cursor.execute(definition)
+
+        if partitioned:
+            cursor.execute(f'CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {TABLE} DEFAULT')
+            cursor.execute(f'SELECT min(created_at) FROM {OLD_TABLE}')
+            first, = cursor.fetchone()
+            now = datetime.datetime.now(datetime.timezone.utc)
+            for start in months(min(first or now, now), future_month(now, months_ahead)):
+                cursor.execute(
+                    f'CREATE TABLE {partition_name(start)} PARTITION OF {TABLE} {bounds(start)}')
+
+        cursor.execute(f'INSERT INTO {TABLE} SELECT * FROM {OLD_TABLE}')
+        # 写した行では発火させない
+        for _, definition in triggers:
+            cursor.execute(definition)
+        cursor.execute(f'DROP TABLE {OLD_TABLE}')
@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.db import transaction
+
+from sbts.task.models import Job
+from sbts.task.tasks import task
+
+from . import partitions
+
+
+@task
+def create_comment_partitions():
+    '''
+    先の月のコメントのパーティションを作り、
+    COMMENT_PARTITION_INTERVAL秒後にまた実行する。
+    '''
+
+    partitions.create_partitions(settings.COMMENT_PARTITION_MONTHS_AHEAD)
+    schedule_partitions(delay=settings.COMMENT_PARTITION_INTERVAL)
+
+
+def schedule_partitions(delay=0):
+    '''
+    create_comment_partitionsのジョブがまだ待っていなければ登録する。
+    '''
+
+    name = create_comment_partitions.task_name
+    with transaction.atomic():
+        if not Job.objects.filter(name=name, status=Job.PENDING).exists():
+            Job.objects.enqueue(name, {}, delay=delay)
@@ -1,8 +1,28 @@
+import csv
 import datetime
+import io
+import json
+import threading
+import uuid
 
-from django.test import TestCase
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
 
-from .models import Ticket
+from rest_framework.test import APIRequestFactory
+
+from sbts.core.models import BulkValidationError
+from sbts.core.test_utils import QueryGuardMixin, explain, plan_nodes
+from sbts.task.models import Job
+from sbts.task.tasks import run_one
+
+from . import partitions
+from .models import Ticket, Comment
+from .tasks import create_comment_partitions
+from .views import TicketListView, TicketBulkView, CommentListView, \
+    CommentBulkView, TicketExportView
 
 
 class TicketSortedTicketsTest(TestCase):
@@ -146,3 +166,621 @@ class TicketLastmodTest(TestCase):
         t1.comment_set.create_cleanly(comment='b', created_at=t1_c2_dt, username='shimon')
 
         self.assertEqual(t1.lastmod, t1_c1_dt)
+
+
+class CommentBulkCreateCleanlyTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        t1_dt = datetime.datetime.fromisoformat('2023-10-23T23:20:00Z')
+        cls.t1 = Ticket.objects.create_cleanly(title='ticket 1', created_at=t1_dt)
+        t2_dt = datetime.datetime.fromisoformat('2023-10-24T23:20:00Z')
+        cls.t2 = Ticket.objects.create_cleanly(title='ticket 2', created_at=t2_dt)
+
+    def make_comments(self, n, ticket):
+        c_dt = datetime.datetime.fromisoformat('2023-10-25T09:00:00Z')
+        return [Comment(comment=str(i), created_at=c_dt + datetime.timedelta(seconds=i),
+                        username='shimon', ticket=ticket)
+                for i in range(n)]
+
+    def test_ok(self):
+        comments = self.make_comments(3, self.t1)
+        Comment.objects.bulk_create_cleanly(comments)
+
+        self.assertQuerySetEqual(self.t1.sorted_comments(), comments)
+
+    def test_related_manager(self):
+        '''
+        RelatedManagerから呼ぶと、外部キーは自動で設定される
+        '''
+
+        comments = self.make_comments(2, None)
+        self.t2.comment_set.bulk_create_cleanly(comments)
+
+        self.assertQuerySetEqual(self.t2.sorted_comments(), comments)
+        self.assertQuerySetEqual(self.t1.sorted_comments(), [])
+
+    def test_batch_queries(self):
+        '''
+        検査の問い合わせは1行ごとではなくbatch_size件ごとにまとめる
+        '''
+
+        comments = self.make_comments(5, self.t1)
+        # 3バッチ × (外部キーの検査、主キーの検査、挿入)
+        with self.assertNumQueries(9):
+            Comment.objects.bulk_create_cleanly(comments, batch_size=2)
+
+        self.assertEqual(self.t1.comment_set.count(), 5)
+
+    def test_invalid_rows(self):
+        '''
+        1行でも不正なら何も挿入せず、行ごとのエラーを送出する
+        '''
+
+        existing = self.t1.comment_set.create_cleanly(
+            comment='x', created_at=datetime.datetime.fromisoformat('2023-10-25T00:00:00Z'),
+            username='shimon')
+        comments = self.make_comments(6, self.t1)
+        comments[1].comment = ''
+        comments[2].ticket_id = uuid.UUID('6b1ec55f-3e41-4780-aa71-0fbbbe4e0d5d')
+        comments[3].key = existing.key
+        comments[5].key = comments[4].key
+
+        with self.assertRaises(BulkValidationError) as cm:
+            Comment.objects.bulk_create_cleanly(comments, batch_size=4)
+
+        self.assertEqual(sorted(cm.exception.row_errors), [1, 2, 3, 5])
+        dicts = cm.exception.message_dicts()
+        self.assertEqual(len(dicts), 6)
+        self.assertEqual(dicts[0], {})
+        self.assertIn('comment', dicts[1])
+        self.assertIn('ticket', dicts[2])
+        self.assertIn('key', dicts[3])
+        self.assertEqual(dicts[4], {})
+        self.assertIn('key', dicts[5])
+        self.assertQuerySetEqual(Comment.objects.all(), [existing])
+
+
+class TicketListViewTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.user_shimon = User.objects.create_user(
+            'shimon', 'shimon@example.com', 'pw')
+
+    def setUp(self):
+        super().setUp()
+        self.req_factory = APIRequestFactory()
+
+    def test_get_anon(self):
+        '''
+        一覧は未ログインでも取得できる
+        '''
+
+        t1_dt = datetime.datetime.fromisoformat('2023-10-23T23:20:00Z')
+        t1 = Ticket.objects.create_cleanly(title='ticket 1', created_at=t1_dt)
+        t2_dt = datetime.datetime.fromisoformat('2023-10-24T23:00:00Z')
+        t2 = Ticket.objects.create_cleanly(title='ticket 2', created_at=t2_dt)
+
+        req = self.req_factory.get('/')
+        req.user = AnonymousUser()
+        resp = TicketListView.as_view()(req)
+        resp.render()
+
+        self.assertEqual(resp.status_code, 200)
+        tickets = json.loads(resp.content)['tickets']
+        self.assertEqual([t['key'] for t in tickets], [str(t2.key), str(t1.key)])
+        self.assertEqual(tickets[0]['title'], t2.title)
+
+    def test_post_anon(self):
+        '''
+        未ログインはチケット作成不可
+        '''
+
+        req = self.req_factory.post('/', {'title': 't1'}, format='json')
+        req.user = AnonymousUser()
+        resp = TicketListView.as_view()(req)
+        resp.render()
+
+        self.assertEqual(resp.status_code, 403)
+        self.assertQuerySetEqual(Ticket.objects.all(), [])
+
+    def test_post_ok(self):
+        req = self.req_factory.post('/', {'title': 't1'}, format='json')
+        req.user = self.user_shimon
+        resp = TicketListView.as_view()(req)
+        resp.render()
+
+        self.assertEqual(resp.status_code, 200)
+        t1 = Ticket.objects.get(title='t1')
+        self.assertEqual(json.loads(resp.content)['key'], str(t1.key))
+
+    def test_post_empty_title(self):
+        '''
+        create_cleanlyと同じ検査で弾かれる
+        '''
+
+        req = self.req_factory.post('/', {'title': ''}, format='json')
+        req.user = self.user_shimon
+        resp = TicketListView.as_view()(req)
+        resp.render()
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertQuerySetEqual(Ticket.objects.all(), [])
+
+    def test_post_no_title(self):
+        req = self.req_factory.post('/', {}, format='json')
+        req.user = self.user_shimon
+        resp = TicketListView.as_view()(req)
+        resp.render()
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertQuerySetEqual(Ticket.objects.all(), [])
+
+
+class TicketBulkViewTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.user_shimon = User.objects.create_user(
+            'shimon', 'shimon@example.com', 'pw')
+
+    def setUp(self):
+        super().setUp()
+        self.req_factory = APIRequestFactory()
+
+    def test_ok(self):
+        data = {'tickets': [{'title': 'a'}, {'title': 'b'}, {'title': 'c'}]}
+        req = self.req_factory.post('/', data, format='json')
+        req.user = self.user_shimon
+        resp = TicketBulkView.as_view()(req)
+        resp.render()
+
+        self.assertEqual(resp.status_code, 200)
+        keys = json.loads(resp.content)['keys']
+        self.assertEqual([Ticket.objects.get(key=k).title for k in keys], ['a', 'b', 'c'])
+        # 送った順に作成日時が並ぶ
+        self.assertEqual([t.title for t in Ticket.objects.sorted_tickets()], ['c', 'b', 'a'])
+
+    def test_invalid_row(self):
+        '''
+        1行でも不正なら何も作成しない
+        '''
+
+        data = {'tickets': [{'title': 'a'}, {'title': ''}, {'title': 't' * 256}]}
+        req = self.req_factory.post('/', data, format='json')
+        req.user = self.user_shimon
+        resp = TicketBulkView.as_view()(req)
+        resp.render()
+
+        self.assertEqual(resp.status_code, 400)
+        errors = json.loads(resp.content)
+        self.assertEqual(errors[0], {})
+        self.assertIn('title', errors[1])
+        self.assertIn('title', errors[2])
+        self.assertQuerySetEqual(Ticket.objects.all(), [])
+
+    @override_settings(API_BULK_CREATE_MAX_ITEMS=2)
+    def test_too_many(self):
+        data = {'tickets': [{'title': 'a'}, {'title': 'b'}, {'title': 'c'}]}
+        req = self.req_factory.post('/', data, format='json')
+        req.user = self.user_shimon
+        resp = TicketBulkView.as_view()(req)
+        resp.render()
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertQuerySetEqual(Ticket.objects.all(), [])
+
+    def test_anon(self):
+        data = {'tickets': [{'title': 'a'}]}
+        req = self.req_factory.post('/', data, format='json')
+        req.user = AnonymousUser()
+        resp = TicketBulkView.as_view()(req)
+        resp.render()
+
+        self.assertEqual(resp.status_code, 403)
+        self.assertQuerySetEqual(Ticket.objects.all(), [])
+
+
+class CommentListViewTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.user_shimon = User.objects.create_user(
+            'shimon', 'shimon@example.com', 'pw')
+        t1_dt = datetime.datetime.fromisoformat('2023-10-23T23:20:00Z')
+        cls.t1 = Ticket.objects.create_cleanly(title='ticket', created_at=t1_dt)
+
+    def setUp(self):
+        super().setUp()
+        self.req_factory = APIRequestFactory()
+
+    def test_get(self):
+        t1_c1_dt = datetime.datetime.fromisoformat('2023-10-24T09:00:00Z')
+        t1_c1 = self.t1.comment_set.create_cleanly(comment='a', created_at=t1_c1_dt, username='shimon')
+        t1_c2_dt = datetime.datetime.fromisoformat('2023-10-24T08:00:00Z')
+        t1_c2 = self.t1.comment_set.create_cleanly(comment='b', created_at=t1_c2_dt, username='shimon')
+
+        req = self.req_factory.get('/')
+        req.user = AnonymousUser()
+        resp = CommentListView.as_view()(req, key=self.t1.key)
+        resp.render()
+
+        self.assertEqual(resp.status_code, 200)
+        comments = json.loads(resp.content)['comments']
+        self.assertEqual([c['key'] for c in comments], [str(t1_c2.key), str(t1_c1.key)])
+
+    def test_get_invalid_ticket(self):
+        req = self.req_factory.get('/')
+        req.user = AnonymousUser()
+        resp = CommentListView.as_view()(req, key=uuid.UUID('6b1ec55f-3e41-4780-aa71-0fbbbe4e0d5d'))
+        resp.render()
+
+        self.assertEqual(resp.status_code, 404)
+
+    def test_post_ok(self):
+        req = self.req_factory.post('/', {'comment': 'c'}, format='json')
+        req.user = self.user_shimon
+        resp = CommentListView.as_view()(req, key=self.t1.key)
+        resp.render()
+
+        self.assertEqual(resp.status_code, 200)
+        c1 = self.t1.comment_set.get()
+        self.assertEqual(json.loads(resp.content)['key'], str(c1.key))
+        self.assertEqual(c1.comment, 'c')
+        self.assertEqual(c1.username, self.user_shimon.username)
+
+    def test_post_too_long_comment(self):
+        req = self.req_factory.post('/', {'comment': 'c' * 65536}, format='json')
+        req.user = self.user_shimon
+        resp = CommentListView.as_view()(req, key=self.t1.key)
+        resp.render()
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertQuerySetEqual(Comment.objects.all(), [])
+
+
+class CommentBulkViewTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.user_shimon = User.objects.create_user(
+            'shimon', 'shimon@example.com', 'pw')
+        t1_dt = datetime.datetime.fromisoformat('2023-10-23T23:20:00Z')
+        cls.t1 = Ticket.objects.create_cleanly(title='ticket 1', created_at=t1_dt)
+        t2_dt = datetime.datetime.fromisoformat('2023-10-24T23:20:00Z')
+        cls.t2 = Ticket.objects.create_cleanly(title='ticket 2', created_at=t2_dt)
+
+    def setUp(self):
+        super().setUp()
+        self.req_factory = APIRequestFactory()
+
+    def test_ok(self):
+        data = {'comments': [
+            {'ticket': str(self.t1.key), 'comment': 'a'},
+            {'ticket': str(self.t2.key), 'comment': 'b'},
+            {'ticket': str(self.t1.key), 'comment': 'c'},
+        ]}
+        req = self.req_factory.post('/', data, format='json')
+        req.user = self.user_shimon
+        resp = CommentBulkView.as_view()(req)
+        resp.render()
+
+        self.assertEqual(resp.status_code, 200)
+        keys = json.loads(resp.content)['keys']
+        self.assertEqual([Comment.objects.get(key=k).comment for k in keys], ['a', 'b', 'c'])
+        self.assertEqual([c.comment for c in self.t1.sorted_comments()], ['a', 'c'])
+        self.assertEqual([c.comment for c in self.t2.sorted_comments()], ['b'])
+
+    def test_invalid_ticket(self):
+        '''
+        存在しないチケットを含むなら何も作成しない
+        '''
+
+        data = {'comments': [
+            {'ticket': str(self.t1.key), 'comment': 'a'},
+            {'ticket': '6b1ec55f-3e41-4780-aa71-0fbbbe4e0d5d', 'comment': 'b'},
+            {'ticket': 'invalid', 'comment': 'c'},
+        ]}
+        req = self.req_factory.post('/', data, format='json')
+        req.user = self.user_shimon
+        resp = CommentBulkView.as_view()(req)
+        resp.render()
+
+        self.assertEqual(resp.status_code, 400)
+        errors = json.loads(resp.content)
+        self.assertEqual(errors[0], {})
+        self.assertIn('ticket', errors[1])
+        self.assertIn('ticket', errors[2])
+        self.assertQuerySetEqual(Comment.objects.all(), [])
+
+    def test_empty_comment(self):
+        data = {'comments': [
+            {'ticket': str(self.t1.key), 'comment': ''},
+        ]}
+        req = self.req_factory.post('/', data, format='json')
+        req.user = self.user_shimon
+        resp = CommentBulkView.as_view()(req)
+        resp.render()
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertQuerySetEqual(Comment.objects.all(), [])
+
+    def test_anon(self):
+        data = {'comments': [
+            {'ticket': str(self.t1.key), 'comment': 'a'},
+        ]}
+        req = self.req_factory.post('/', data, format='json')
+        req.user = AnonymousUser()
+        resp = CommentBulkView.as_view()(req)
+        resp.render()
+
+        self.assertEqual(resp.status_code, 403)
+        self.assertQuerySetEqual(Comment.objects.all(), [])
+
+
+class TicketExportViewTest(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.req_factory = RequestFactory()
+
+    def create_tickets(self):
+        t1_dt = datetime.datetime.fromisoformat('2023-10-23T23:20:00Z')
+        t1 = Ticket.objects.create_cleanly(title='ticket 1', created_at=t1_dt)
+        t1_c1_dt = datetime.datetime.fromisoformat('2023-10-25T09:00:00Z')
+        t1.comment_set.create_cleanly(comment='a', created_at=t1_c1_dt, username='shimon')
+        t1_c2_dt = datetime.datetime.fromisoformat('2023-10-24T09:00:00Z')
+        t1.comment_set.create_cleanly(comment='b', created_at=t1_c2_dt, username='shimon')
+        t2_dt = datetime.datetime.fromisoformat('2023-10-24T23:00:00Z')
+        t2 = Ticket.objects.create_cleanly(title='ticket, "2"', created_at=t2_dt)
+        return t1, t2
+
+    def test_ndjson(self):
+        t1, t2 = self.create_tickets()
+
+        req = self.req_factory.get('/')
+        req.user = AnonymousUser()
+        resp = TicketExportView.as_view()(req)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.streaming)
+        self.assertEqual(resp['Content-Type'], 'application/x-ndjson; charset=utf-8')
+        rows = [json.loads(line) for line in b''.join(resp.streaming_content).decode().splitlines()]
+        self.assertEqual([r['key'] for r in rows], [str(t2.key), str(t1.key)])
+        self.assertEqual(rows[0]['title'], t2.title)
+        self.assertEqual(datetime.datetime.fromisoformat(rows[0]['lastmod_at']), t2.lastmod)
+        self.assertEqual(datetime.datetime.fromisoformat(rows[1]['lastmod_at']), t1.lastmod)
+
+    @override_settings(TICKET_EXPORT_CHUNK_SIZE=1)
+    def test_csv(self):
+        t1, t2 = self.create_tickets()
+
+        req = self.req_factory.get('/', {'format': 'csv'})
+        req.user = AnonymousUser()
+        resp = TicketExportView.as_view()(req)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp['Content-Type'], 'text/csv; charset=utf-8')
+        content = b''.join(resp.streaming_content).decode()
+        rows = list(csv.reader(io.StringIO(content)))
+        self.assertEqual(rows[0], ['key', 'title', 'created_at', 'lastmod_at'])
+        self.assertEqual([r[0] for r in rows[1:]], [str(t2.key), str(t1.key)])
+        self.assertEqual(rows[1][1], t2.title)
+        self.assertEqual(datetime.datetime.fromisoformat(rows[2][3]), t1.lastmod)
+
+    def test_csv_empty(self):
+        req = self.req_factory.get('/', {'format': 'csv'})
+        req.user = AnonymousUser()
+        resp = TicketExportView.as_view()(req)
+
+        self.assertEqual(b''.join(resp.streaming_content), b'key,title,created_at,lastmod_at\r\n')
+
+    def test_invalid_format(self):
+        req = self.req_factory.get('/', {'format': 'xml'})
+        req.user = AnonymousUser()
+        resp = TicketExportView.as_view()(req)
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_post(self):
+        req = self.req_factory.post('/')
+        req.user = AnonymousUser()
+        resp = TicketExportView.as_view()(req)
+
+        self.assertEqual(resp.status_code, 405)
+
+
+class CommentPartitionTest(QueryGuardMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        t1_dt = datetime.datetime.fromisoformat('2023-10-23T23:20:00Z')
+        self.t1 = Ticket.objects.create_cleanly(title='ticket', created_at=t1_dt)
+
+    def partition_of(self, comment):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT tableoid::regclass::text FROM ticket_comment WHERE key = %s',
+                           [comment.key])
+            return cursor.fetchone()[0]
+
+    def test_partitioned(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        with connection.cursor() as cursor:
+            self.assertTrue(partitions.is_partitioned(cursor))
+            names = partitions.partitions(cursor)
+        self.assertIn(partitions.DEFAULT_PARTITION, names)
+        for start in partitions.months(now, partitions.future_month(now, 3)):
+            self.assertIn(partitions.partition_name(start), names)
+
+        c1 = self.t1.comment_set.create_cleanly(comment='a', created_at=now, username='shimon')
+        self.assertEqual(self.partition_of(c1), partitions.partition_name(partitions.month_start(now)))
+
+    def test_create_partitions(self):
+        '''
+        デフォルトのパーティションに入った行は、その月のパーティション
+        を作るときに移す
+        '''
+
+        c1_dt = datetime.datetime.fromisoformat('2040-02-10T00:00:00Z')
+        c1 = self.t1.comment_set.create_cleanly(comment='a', created_at=c1_dt, username='shimon')
+        self.assertEqual(self.partition_of(c1), partitions.DEFAULT_PARTITION)
+
+        now = datetime.datetime.fromisoformat('2040-01-31T00:00:00Z')
+        created = partitions.create_partitions(2, now=now)
+        self.assertEqual(created, ['ticket_comment_p204001', 'ticket_comment_p204002',
+                                   'ticket_comment_p204003'])
+        self.assertEqual(self.partition_of(c1), 'ticket_comment_p204002')
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            self.t1.comment_set.create(key=c1.key, comment='b', created_at=self.t1.created_at,
+                                       username='shimon')
+        self.assertEqual(partitions.create_partitions(2, now=now), [])
+        self.assertQuerySetEqual(self.t1.sorted_comments(), [c1])
+
+    def test_duplicate_key(self):
+        '''
+        主キーに日時を含めても、キーの重複は検査で防ぐ
+        '''
+
+        c1_dt = datetime.datetime.fromisoformat('2023-10-24T09:00:00Z')
+        c1 = self.t1.comment_set.create_cleanly(comment='a', created_at=c1_dt, username='shimon')
+        with self.assertRaises(ValidationError):
+            self.t1.comment_set.create_cleanly(
+                key=c1.key, comment='b', created_at=c1_dt + datetime.timedelta(days=90),
+                username='shimon')
+
+    def test_duplicate_key_in_database(self):
+        '''
+        検査を通らずに入れても、キーの重複はデータベースが防ぐ
+        '''
+
+        c1_dt = datetime.datetime.fromisoformat('2023-10-24T09:00:00Z')
+        c1 = self.t1.comment_set.create_cleanly(comment='a', created_at=c1_dt, username='shimon')
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Comment.objects.create(key=c1.key, comment='b', ticket=self.t1, username='shimon',
+                                   created_at=c1_dt + datetime.timedelta(days=90))
+
+        # 消したキーと、別のパーティションに移したキーは使える
+        Comment.objects.filter(key=c1.key).update(
+            created_at=c1_dt + datetime.timedelta(days=60))
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Comment.objects.create(key=c1.key, comment='b', ticket=self.t1, username='shimon',
+                                   created_at=c1_dt)
+        c1.delete()
+        Comment.objects.create(key=c1.key, comment='b', ticket=self.t1, username='shimon',
+                               created_at=c1_dt)
+
+    def test_pruning(self):
+        '''
+        created_atの範囲での問い合わせは、その月のパーティションだけを
+        読む
+        '''
+
+        start = datetime.datetime.fromisoformat('2023-10-01T00:00:00Z')
+        partitions.create_partitions(0, now=start)
+        plan = explain(Comment.objects.filter(
+            created_at__gte=start, created_at__lt=start + datetime.timedelta(days=7)))
+        relations = {node['Relation Name'] for node in plan_nodes(plan)
+                     if 'Relation Name' in node}
+        self.assertEqual(relations, {'ticket_comment_p202310'})
+
+    def test_sorted_comments_plan(self):
+        self.assertNoSeqScan(self.t1.sorted_comments(), [Comment._meta.db_table])
+
+    def rebuild(self, partitioned):
+        with connection.cursor() as cursor:
+            # 遅延した外部キーの検査が残っていると、テーブルを変えられない
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+            partitions.rebuild(connection, partitioned)
+            cursor.execute('SET CONSTRAINTS ALL DEFERRED')
+
+    def test_rebuild(self):
+        '''
+        作り直しても、制約と索引とトリガーの定義は変わらない
+        '''
+
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE INDEX comment_username_idx ON ticket_comment '
+                           "(username text_pattern_ops) WHERE username <> ''")
+            cursor.execute('ALTER TABLE ticket_comment ADD CONSTRAINT comment_username_check '
+                           "CHECK (username <> '')")
+            before = partitions.definitions(cursor)
+        c1_dt = datetime.datetime.fromisoformat('2023-10-24T09:00:00Z')
+        c1 = self.t1.comment_set.create_cleanly(comment='a', created_at=c1_dt, username='shimon')
+
+        self.rebuild(False)
+        with connection.cursor() as cursor:
+            self.assertFalse(partitions.is_partitioned(cursor))
+        self.rebuild(True)
+        with connection.cursor() as cursor:
+            self.assertTrue(partitions.is_partitioned(cursor))
+            self.assertEqual(partitions.definitions(cursor), before)
+            self.assertIn(partitions.partition_name(partitions.month_start(c1_dt)),
+                          partitions.partitions(cursor))
+        self.assertQuerySetEqual(self.t1.sorted_comments(), [c1])
+
+    def test_rebuild_unique(self):
+        '''
+        パーティションにできない一意制約があれば、黙って消さずに失敗する
+        '''
+
+        self.rebuild(False)
+        with connection.cursor() as cursor:
+            cursor.execute('ALTER TABLE ticket_comment ADD CONSTRAINT comment_key_username_uniq '
+                           'UNIQUE (key, username)')
+        with self.assertRaises(DatabaseError), transaction.atomic():
+            self.rebuild(True)
+
+    def test_command(self):
+        stdout = io.StringIO()
+        call_command('create_comment_partitions', months=240, stdout=stdout)
+        self.assertIn('created ticket_comment_p', stdout.getvalue())
+
+        name = create_comment_partitions.task_name
+        self.assertEqual(Job.objects.filter(name=name).count(), 1)
+        call_command('create_comment_partitions', months=240, stdout=io.StringIO())
+        self.assertEqual(Job.objects.filter(name=name).count(), 1)
+
+    def test_task(self):
+        '''
+        ジョブは実行したあとに、次の実行を登録する
+        '''
+
+        create_comment_partitions.enqueue()
+        self.assertTrue(run_one())
+        job = Job.objects.get(name=create_comment_partitions.task_name)
+        self.assertEqual(job.status, Job.PENDING)
+        self.assertGreater(job.run_at, datetime.datetime.now(datetime.timezone.utc))
+
+
+class ConcurrentPartitionTest(TransactionTestCase):
+    '''
+    別の接続から同時にパーティションを作る。
+    '''
+
+    def tearDown(self):
+        with connection.cursor() as cursor:
+            for name in partitions.partitions(cursor):
+                if name.startswith('ticket_comment_p2050'):
+                    cursor.execute(f'DROP TABLE {name}')
+        super().tearDown()
+
+    def test_concurrent(self):
+        now = datetime.datetime.fromisoformat('2050-01-01T00:00:00Z')
+        barrier = threading.Barrier(2)
+        results = []
+
+        def create():
+            try:
+                barrier.wait()
+                results.append(partitions.create_partitions(11, now=now))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=create) for _ in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(results), 2)
+        self.assertEqual(sorted(results[0] + results[1]),
+                         [f'ticket_comment_p2050{m:02}' for m in range(1, 13)])
@@ -0,0 +1,14 @@
+from django.urls import path
+
+from .views import TicketListView, TicketBulkView, CommentListView, \
+    CommentBulkView, TicketExportView
+
+
+app_name = 'ticket'
+urlpatterns = [
+    path('tickets/', TicketListView.as_view(), name='tickets'),
+    path('tickets/bulk/', TicketBulkView.as_view(), name='ticket_bulk'),
+    path('tickets/export/', TicketExportView.as_view(), name='ticket_export'),
+    path('tickets/<uuid:key>/comments/', CommentListView.as_view(), name='comments'),
+    path('comments/bulk/', CommentBulkView.as_view(), name='comment_bulk'),
+]
@@ -0,0 +1,204 @@
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.http import HttpResponseBadRequest, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.views import View
+from rest_framework import exceptions
+from rest_framework.permissions import IsAuthenticatedOrReadOnly
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+import csv
+import datetime
+import io
+import uuid
+
+from sbts.core.models import BulkValidationError
+
+from .models import Ticket, Comment
+
+
+def get_str(data, name):
+    if not isinstance(data, dict):
+        raise exceptions.ParseError('JSON object expected')
+    value = data.get(name)
+    if not isinstance(value, str):
+        raise exceptions.ValidationError({name: ['string expected']})
+    return value
+
+
+def get_items(data, name):
+    if not isinstance(data, dict):
+        raise exceptions.ParseError('JSON object expected')
+    items = data.get(name)
+    if not isinstance(items, list):
+        raise exceptions.ValidationError({name: ['list expected']})
+    if len(items) > settings.API_BULK_CREATE_MAX_ITEMS:
+        raise exceptions.ValidationError(
+            {name: [f'at most {settings.API_BULK_CREATE_MAX_ITEMS} items']})
+    return items
+
+
+def as_api_error(e):
+    '''
+    モデルの検査エラーを、REST APIのエラー(400)に変換する。一括作成の
+    場合は、各行のエラー(エラーのない行は空辞書)を並べる。
+    '''
+
+    if isinstance(e, BulkValidationError):
+        return exceptions.ValidationError(e.message_dicts())
+    return exceptions.ValidationError(e.message_dict)
+
+
+class TicketApiView(APIView):
+    permission_classes = [IsAuthenticatedOrReadOnly]
+
+
+class TicketListView(TicketApiView):
+    def get(self, request, format=None):
+        tickets = Ticket.objects.sorted_tickets().values(
+            'key', 'title', 'created_at')
+        return Response({'tickets': list(tickets)})
+
+    def post(self, request, format=None):
+        try:
+            ticket = Ticket.objects.create_cleanly(
+                key=uuid.uuid4(),
+                title=get_str(request.data, 'title'),
+                created_at=timezone.now())
+        except ValidationError as e:
+            raise as_api_error(e)
+        return Response({'key': ticket.key})
+
+
+class TicketBulkView(TicketApiView):
+    def post(self, request, format=None):
+        now = timezone.now()
+        tickets = [
+            # 同じ日時だと並び順が定まらないので、送られてきた順に1マ
+            # イクロ秒ずつずらす
+            Ticket(key=uuid.uuid4(),
+                   title=get_str(item, 'title'),
+                   created_at=now + datetime.timedelta(microseconds=i))
+            for i, item in enumerate(get_items(request.data, 'tickets'))
+        ]
+
+        try:
+            Ticket.objects.bulk_create_cleanly(tickets)
+        except ValidationError as e:
+            raise as_api_error(e)
+
+        return Response({'keys': [t.key for t in tickets]})
+
+
+class CommentListView(TicketApiView):
+    def get(self, request, format=None, **kwargs):
+        ticket = get_object_or_404(Ticket, key=kwargs['key'])
+        comments = ticket.sorted_comments().values(
+            'key', 'username', 'comment', 'created_at')
+        return Response({'comments': list(comments)})
+
+    def post(self, request, format=None, **kwargs):
+        ticket = get_object_or_404(Ticket, key=kwargs['key'])
+        try:
+            comment = ticket.comment_set.create_cleanly(
+                key=uuid.uuid4(),
+                comment=get_str(request.data, 'comment'),
+                created_at=timezone.now(),
+                username=request.user.username)
+        except ValidationError as e:
+            raise as_api_error(e)
+        return Response({'key': comment.key})
+
+
+class CommentBulkView(TicketApiView):
+    '''
+    複数のチケットへのコメントをまとめて作成する。すべて成功するか、何
+    も作成しないかのどちらかになる。
+    '''
+
+    def post(self, request, format=None):
+        now = timezone.now()
+        comments = [
+            # 同じ日時だと並び順が定まらないので、送られてきた順に1マ
+            # イクロ秒ずつずらす
+            Comment(key=uuid.uuid4(),
+                    comment=get_str(item, 'comment'),
+                    created_at=now + datetime.timedelta(microseconds=i),
+                    username=request.user.username,
+                    ticket_id=get_str(item, 'ticket'))
+            for i, item in enumerate(get_items(request.data, 'comments'))
+        ]
+
+        try:
+            Comment.objects.bulk_create_cleanly(comments)
+        except ValidationError as e:
+            raise as_api_error(e)
+
+        return Response({'keys': [c.key for c in comments]})
+
+
+class TicketExportView(View):
+    '''
+    チケットの一覧を最終変更日時付きで、NDJSON(既定)またはCSVで返す。
+    サーバーサイドカーソルから読んだ分だけ順に送るので、チケットの数
+    によらずメモリ使用量は一定で、問い合わせの完了を待たずに送り始め
+    られる。
+    '''
+
+    FIELDS = ['key', 'title', 'created_at', 'lastmod_at']
+    CONTENT_TYPES = {
+        'ndjson': 'application/x-ndjson; charset=utf-8',
+        'csv': 'text/csv; charset=utf-8',
+    }
+
+    def get(self, request, *args, **kwargs):
+        fmt = request.GET.get('format', 'ndjson')
+        if fmt not in self.CONTENT_TYPES:
+            return HttpResponseBadRequest()
+
+        encode = self.encode_ndjson if fmt == 'ndjson' else self.encode_csv
+        resp = StreamingHttpResponse(encode(self.rows()),
+                                     content_type=self.CONTENT_TYPES[fmt])
+        resp['Content-Disposition'] = f'attachment; filename="tickets.{fmt}"'
+        return resp
+
+    def rows(self):
+        chunk_size = settings.TICKET_EXPORT_CHUNK_SIZE
+        # autocommitのままだとPostgreSQLのサーバーサイドカーソルが
+        # WITH HOLDになり、DECLAREした時点で結果全体が実体化される。
+        # トランザクション内で読み出して、最初の行をすぐに返す。
+        with transaction.atomic():
+            qs = Ticket.objects.sorted_tickets_with_lastmod().values_list(*self.FIELDS)
+            chunk = []
+            for row in qs.iterator(chunk_size=chunk_size):
+                chunk.append(row)
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+    def encode_ndjson(self, chunks):
+        encoder = DjangoJSONEncoder(ensure_ascii=False)
+        for chunk in chunks:
+            yield ''.join(
+                encoder.encode(dict(zip(self.FIELDS, row))) + '\n' for row in chunk)
+
+    def encode_csv(self, chunks):
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(self.FIELDS)
+        for chunk in chunks:
+            writer.writerows(
+                (key, title, created_at.isoformat(), lastmod_at.isoformat())
+                for key, title, created_at, lastmod_at in chunk)
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+        # チケットがない場合も見出しは返す
+        if buf.tell():
+            yield buf.getvalue()